@@ -0,0 +1,91 @@
+"""-------------------------------------------------------------------
+Benchmarks routing file names to pipelines with runner.router against
+scanning the patterns one at a time, as run_pipeline used to.  The
+synthetic names mix raw files, processed files to plot and unrouted
+files of every registered pipeline.
+
+Usage:
+    python benchmarks/file_routing.py [--files 100000] [--repeat 3]
+-------------------------------------------------------------------"""
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+project_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, os.path.join(project_dir, 'lambda_function'))
+
+from pipelines.runner import location_map, router, routes
+
+name_templates = [
+    'tracker.{site}.{date}.{time}.tar.gz',
+    'buoy.{site}.00.{date}.{time}.waves.csv',
+    'buoy.{site}.00.{date}.{time}.imu.bin',
+    'lidar.{site}.00.{date}.{time}.sta.7z',
+    'buoy.{site}.00.{date}.{time}.zip',
+    '{date}_{time}.{site}.hpl',
+    'buoy.{site}.a0.{date}.{time}.10m.a2e.nc',
+    'lidar.{site}.a0.{date}.{time}.sta.a2e.nc',
+    'buoy.{site}.00.{date}.{time}.log',
+]
+
+
+def make_names(num_files: int):
+    rng = random.Random(0)
+    return [
+        rng.choice(name_templates).format(site=rng.choice(['z05', 'z06', 'nwtc']),
+                                          date=f'2021{rng.randint(1, 12):02d}{rng.randint(1, 28):02d}',
+                                          time=f'{rng.randint(0, 235959):06d}')
+        for i in range(num_files)
+    ]
+
+
+def scan_patterns(name, pipeline_patterns, plotting_patterns, location_patterns):
+    # Sequential first-match scan over each table
+    location = next((key for key, pattern in location_patterns if pattern.match(name)), None)
+    pipeline_dir = next((key for key, pattern in pipeline_patterns if pattern.match(name)), None)
+    method = 'run'
+    if pipeline_dir is None:
+        pipeline_dir = next((key for key, pattern in plotting_patterns if pattern.match(name)), None)
+        method = 'run_plots' if pipeline_dir else 'run'
+    return pipeline_dir, method, location
+
+
+def best_time(func, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=100000, help='The number of file names to route.')
+    parser.add_argument('--repeat', type=int, default=3, help='The number of times to time each method.')
+    args = parser.parse_args()
+
+    names = make_names(args.files)
+    pipeline_patterns = [(r.pipeline, re.compile(r.pattern)) for r in routes if r.method == 'run']
+    plotting_patterns = [(r.pipeline, re.compile(r.pattern)) for r in routes if r.method == 'run_plots']
+    location_patterns = [(key, re.compile(pattern)) for key, pattern in location_map.items()]
+
+    scan, scanned = best_time(lambda: [scan_patterns(name, pipeline_patterns, plotting_patterns, location_patterns)
+                                       for name in names], args.repeat)
+    single, routed = best_time(lambda: [router.route(name) for name in names], args.repeat)
+    many, routed_many = best_time(lambda: router.route_many(names), args.repeat)
+
+    assert routed == routed_many
+    differences = sum(a != b for a, b in zip(scanned, routed))
+
+    print(f'{len(names)} file names, {len(set(names))} distinct')
+    for label, seconds in [('sequential scan', scan), ('router.route', single), ('router.route_many', many)]:
+        print(f'{label:18} {seconds * 1000:10.1f} ms {len(names) / seconds:12.0f} names/s')
+    print(f'{differences} names routed differently from the sequential scan')
+
+
+if __name__ == '__main__':
+    main()
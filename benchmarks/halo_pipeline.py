@@ -0,0 +1,213 @@
+"""-------------------------------------------------------------------
+Benchmarks the stages of the Halo lidar pipeline on a synthetic .hpl file:
+reading the file, standardizing and customizing the dataset, QC, writing
+the netCDF output and plotting.  Each stage is timed and its peak Python
+memory is traced, and the fastest of the repeats is appended to a JSON
+history with the commit it ran on.  The results are compared with the
+last run in the history at the same size, and slowdowns beyond the
+tolerance are reported as regressions.
+
+Usage:
+    python benchmarks/halo_pipeline.py [--rays 4500] [--gates 720]
+        [--repeat 3] [--history path] [--tolerance 0.2] [--check]
+        [--pipeline-config path] [--storage-config path]
+-------------------------------------------------------------------"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+from typing import Dict, List, Optional
+
+project_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+lambda_dir = os.path.join(project_dir, 'lambda_function')
+pipelines_dir = os.path.join(lambda_dir, 'pipelines')
+sys.path.insert(0, lambda_dir)
+
+from synthetic_hpl import write_hpl
+
+# The history of the runs on this machine, which isn't committed
+DEFAULT_HISTORY = os.path.join(project_dir, 'benchmarks', 'results', 'halo_pipeline.json')
+
+# Changes smaller than these are noise, however large they are relative to
+# a short stage
+MIN_CHANGES = {'Wall_Seconds': 0.05, 'Traced_Peak_MB': 1}
+
+
+def run_stages(pipeline, filename: str, output_dir: str) -> Dict:
+    """-------------------------------------------------------------------
+    Run a .hpl file through the stages of the pipeline, the same way
+    IngestPipeline.run does, with each stage instrumented.
+
+    Args:
+        pipeline (Pipeline):    The Halo lidar pipeline.
+        filename (str):         The .hpl file.
+        output_dir (str):       The directory to write the netCDF file to.
+
+    Returns:
+        Dict: The instrumentation record of the run.
+    -------------------------------------------------------------------"""
+    from tsdat.io import FileHandler
+    from tsdat.utils import DSUtil
+    from pipelines.utils.instrumentation import instrument, stage
+    from pipelines.utils.qc import QualityEngine
+
+    with instrument('halo_pipeline', trace_memory=True) as instrumentation:
+        with stage('read'):
+            raw_dataset = FileHandler.read(filename, dtypes=pipeline.get_raw_dtypes())
+            raw_mapping = {DSUtil.get_raw_filename(raw_dataset, filename, pipeline.config): raw_dataset}
+        with stage('standardize'):
+            raw_mapping = pipeline.hook_customize_raw_datasets(raw_mapping)
+            dataset = pipeline.standardize_dataset(raw_mapping)
+        with stage('customize'):
+            dataset = pipeline.hook_customize_dataset(dataset, raw_mapping)
+        with stage('qc'):
+            dataset = QualityEngine(pipeline.config).run(dataset, None)
+        with stage('write'):
+            dataset = pipeline.hook_finalize_dataset(dataset)
+            output_file = os.path.join(output_dir, DSUtil.get_dataset_filename(dataset, file_extension='.nc'))
+            FileHandler.write(dataset, output_file, config=pipeline.config)
+        with stage('plots'):
+            pipeline.hook_generate_and_persist_plots(dataset)
+
+    return instrumentation.get_record()
+
+
+def summarize(records: List[Dict]) -> Dict[str, Dict[str, float]]:
+    # The fastest time and the largest memory of each stage over the repeats
+    summary = {}
+    for record in records:
+        for stage in record['Stages']:
+            stage_summary = summary.setdefault(stage['Stage'], {'Wall_Seconds': float('inf'), 'Traced_Peak_MB': 0})
+            stage_summary['Wall_Seconds'] = min(stage_summary['Wall_Seconds'], stage['Wall_Seconds'])
+            stage_summary['Traced_Peak_MB'] = max(stage_summary['Traced_Peak_MB'], stage.get('Traced_Peak_MB', 0))
+    return summary
+
+
+def get_commit() -> Dict:
+    # The commit the benchmark ran on, and whether the tree had changes
+    def git(*args):
+        return subprocess.run(['git', *args], cwd=project_dir, capture_output=True, text=True).stdout.strip()
+
+    return {'Commit': git('rev-parse', '--short', 'HEAD') or None,
+            'Subject': git('log', '-1', '--format=%s') or None,
+            'Dirty': bool(git('status', '--porcelain', '--untracked-files=no'))}
+
+
+def load_history(filename: str) -> List[Dict]:
+    if not os.path.isfile(filename):
+        return []
+    with open(filename) as f:
+        return json.load(f)
+
+
+def save_history(filename: str, history: List[Dict]):
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+    with open(filename, 'w') as f:
+        json.dump(history, f, indent=2)
+
+
+def find_baseline(history: List[Dict], entry: Dict) -> Optional[Dict]:
+    # The last run of the same file size and pipeline config
+    for previous in reversed(history):
+        if all(previous.get(key) == entry[key] for key in ['Rays', 'Gates', 'Pipeline_Config']):
+            return previous
+    return None
+
+
+def find_regressions(baseline: Dict, entry: Dict, tolerance: float) -> List[str]:
+    """-------------------------------------------------------------------
+    Compare the stages of a run with those of a baseline run.
+
+    Args:
+        baseline (Dict):    The history entry to compare with.
+        entry (Dict):       The history entry of the run.
+        tolerance (float):  The fraction by which a stage may be slower or
+                            use more memory than in the baseline, ignoring
+                            changes smaller than MIN_CHANGES.
+
+    Returns:
+        List[str]: A description of each stage that got slower or used
+        more memory by more than the tolerance.
+    -------------------------------------------------------------------"""
+    regressions = []
+    for name, stage in entry['Stages'].items():
+        previous = baseline['Stages'].get(name)
+        if previous is None:
+            continue
+        for key, unit in [('Wall_Seconds', 's'), ('Traced_Peak_MB', 'MB')]:
+            change = stage[key] - previous[key]
+            if previous[key] and change > previous[key] * tolerance and change > MIN_CHANGES[key]:
+                regressions.append(f"{name}: {previous[key]} {unit} -> {stage[key]} {unit} "
+                                   f"({stage[key] / previous[key] - 1:+.0%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rays', type=int, default=4500, help='The number of rays, about an hour of data.')
+    parser.add_argument('--gates', type=int, default=720, help='The number of range gates.')
+    parser.add_argument('--seed', type=int, default=0, help='The random seed of the synthetic data.')
+    parser.add_argument('--repeat', type=int, default=3, help='The number of times to run the stages.')
+    parser.add_argument('--history', default=DEFAULT_HISTORY, help='The JSON history of the results.')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='The fraction a stage may be slower or bigger than the last run before it is reported.')
+    parser.add_argument('--check', action='store_true', help='Exit with an error if there are regressions.')
+    parser.add_argument('--pipeline-config', help='The pipeline config file. Defaults to the nwtc config.',
+                        default=os.path.join(pipelines_dir, 'awa_halo_ingest', 'config', 'pipeline_config_nwtc.yml'))
+    parser.add_argument('--storage-config', default=os.path.join(pipelines_dir, 'config/storage_config.yml'),
+                        help='The storage config file.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Plots are saved to a throwaway local store
+        os.environ['STORAGE_CLASSNAME'] = 'tsdat.io.FilesystemStorage'
+        os.environ['RETAIN_INPUT_FILES'] = 'True'
+        os.environ['ROOT_DIR'] = os.path.join(tmp_dir, 'storage')
+
+        from pipelines.awa_halo_ingest.pipeline import Pipeline
+        pipeline = Pipeline(args.pipeline_config, args.storage_config)
+
+        filename = os.path.join(tmp_dir, 'synthetic.nwtc.hpl')
+        write_hpl(filename, args.rays, args.gates, seed=args.seed)
+        records = [run_stages(pipeline, filename, tmp_dir) for _ in range(args.repeat)]
+
+    entry = {
+        'Date': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        **get_commit(),
+        'Python': platform.python_version(),
+        'Machine': platform.machine(),
+        'Rays': args.rays,
+        'Gates': args.gates,
+        'Seed': args.seed,
+        'Pipeline_Config': os.path.relpath(os.path.abspath(args.pipeline_config), project_dir),
+        'Repeat': args.repeat,
+        'Stages': summarize(records),
+    }
+
+    history = load_history(args.history)
+    baseline = find_baseline(history, entry)
+    history.append(entry)
+    save_history(args.history, history)
+
+    print(f"{args.rays} rays x {args.gates} range gates, fastest of {args.repeat}")
+    for name, stage in entry['Stages'].items():
+        change = ''
+        if baseline and name in baseline['Stages'] and baseline['Stages'][name]['Wall_Seconds']:
+            change = f" {stage['Wall_Seconds'] / baseline['Stages'][name]['Wall_Seconds'] - 1:+7.1%}"
+        print(f"{name:12} {stage['Wall_Seconds']:8.3f} s {stage['Traced_Peak_MB']:8.1f} MB peak{change}")
+
+    regressions = find_regressions(baseline, entry, args.tolerance) if baseline else []
+    if baseline:
+        print(f"compared with {baseline['Commit']} ({baseline['Date']})")
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if regressions and args.check:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
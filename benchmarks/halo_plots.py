@@ -0,0 +1,74 @@
+"""-------------------------------------------------------------------
+Benchmarks rendering the Halo lidar plots from a synthetic day of rays,
+with contourf and pcolormesh at full resolution and downsampled to the
+resolution of the plots, one plot after the other and in parallel worker
+processes.
+
+Usage:
+    python benchmarks/halo_plots.py [--rays 8640] [--gates 200]
+-------------------------------------------------------------------"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+project_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, os.path.join(project_dir, 'lambda_function'))
+
+from pipelines.awa_halo_ingest.pipeline import PLOTS, Pipeline, render_plot
+from pipelines.utils.downsample import downsample
+from pipelines.utils.parallel import iterate_in_processes
+
+
+def make_dataset(num_rays: int, num_gates: int) -> xr.Dataset:
+    rng = np.random.default_rng(0)
+    time = pd.date_range('2021-05-10', '2021-05-11', periods=num_rays).values
+    distance = (np.arange(num_gates) + 0.5) * 30.0
+    profile = np.sin(np.linspace(0, 6, num_rays))[:, np.newaxis] * np.cos(distance / 2000)[np.newaxis, :]
+    return xr.Dataset(
+        {
+            'doppler': (('time', 'distance'), (4 * profile + rng.normal(0, 0.5, profile.shape)).astype(np.float32)),
+            'SNR': (('time', 'distance'), (-20 * distance / distance[-1] + rng.normal(0, 1, profile.shape))
+                    .astype(np.float32)),
+        },
+        coords={'time': time, 'distance': distance},
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rays', type=int, default=8640, help='The number of rays.')
+    parser.add_argument('--gates', type=int, default=200, help='The number of range gates.')
+    args = parser.parse_args()
+
+    data = make_dataset(args.rays, args.gates)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        start = time.perf_counter()
+        downsampled = downsample(data, Pipeline.plot_sizes)
+        print(f'downsampled {args.rays} x {args.gates} to {downsampled.sizes["time"]} x '
+              f'{downsampled.sizes["distance"]} in {time.perf_counter() - start:.3f} s')
+
+        for method, label, plot_data in [('contourf', 'contourf', data), ('pcolormesh', 'pcolormesh', data),
+                                         ('pcolormesh', 'downsampled', downsampled)]:
+            plots = [(os.path.join(tmp_dir, f'{label}.{name}.png'), title, variable, units, kwargs, method, plot_data)
+                     for name, title, variable, units, kwargs in PLOTS]
+
+            start = time.perf_counter()
+            for plot in plots:
+                render_plot(plot)
+            serial = time.perf_counter() - start
+
+            start = time.perf_counter()
+            list(iterate_in_processes(render_plot, plots))
+            parallel = time.perf_counter() - start
+
+            print(f'{label:12} {len(plots)} plots: {serial:6.2f} s serial, {parallel:6.2f} s parallel')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""-------------------------------------------------------------------
+Benchmarks the quality management of the Halo lidar pipeline with tsdat's
+QualityManagement and with pipelines.utils.qc.QualityEngine, on the sample
+file or on copies of it repeated along time, and checks that both give
+the same dataset.  Reports the time and the peak Python memory traced
+during QC.
+
+Usage:
+    python benchmarks/halo_qc.py [--repeat 1] [--pipeline-config path]
+        [--storage-config path]
+-------------------------------------------------------------------"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import xarray as xr
+
+project_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+lambda_dir = os.path.join(project_dir, 'lambda_function')
+pipelines_dir = os.path.join(lambda_dir, 'pipelines')
+sys.path.insert(0, lambda_dir)
+
+SAMPLE_FILE = os.path.join(project_dir, 'data', 'awa_halo_ingest', 'test.nwtc.hpl')
+
+
+def read_dataset(pipeline, filename: str) -> xr.Dataset:
+    # The dataset as it is just before QC in IngestPipeline.run
+    raw_mapping = pipeline.read_and_persist_raw_files([filename])
+    raw_mapping = pipeline.hook_customize_raw_datasets(raw_mapping)
+    dataset = pipeline.standardize_dataset(raw_mapping)
+    return pipeline.hook_customize_dataset(dataset, raw_mapping)
+
+
+def repeat_dataset(dataset: xr.Dataset, repeat: int) -> xr.Dataset:
+    # Copies of the dataset one after the other in time
+    step = dataset.time.values[-1] - dataset.time.values[0] + np.timedelta64(1, 's')
+    return xr.concat([dataset.assign_coords(time=dataset.time.values + i * step) for i in range(repeat)], 'time')
+
+
+def time_qc(run, dataset: xr.Dataset):
+    dataset = dataset.copy(deep=True)
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = run(dataset)
+    seconds = time.perf_counter() - start
+    peak_mb = tracemalloc.get_traced_memory()[1] / 2 ** 20
+    tracemalloc.stop()
+    return result, seconds, peak_mb
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=1, help='The number of copies of the sample file.')
+    parser.add_argument('--pipeline-config', help='The pipeline config file. Defaults to the nwtc config.',
+                        default=os.path.join(pipelines_dir, 'awa_halo_ingest', 'config', 'pipeline_config_nwtc.yml'))
+    parser.add_argument('--storage-config', default=os.path.join(pipelines_dir, 'config/storage_config.yml'),
+                        help='The storage config file.')
+    args = parser.parse_args()
+
+    os.environ.setdefault('STORAGE_CLASSNAME', 'tsdat.io.FilesystemStorage')
+    os.environ.setdefault('RETAIN_INPUT_FILES', 'True')
+    os.environ.setdefault('ROOT_DIR', tempfile.mkdtemp())
+
+    from tsdat import Config
+    from tsdat.qc import QualityManagement
+    from pipelines.awa_halo_ingest.pipeline import Pipeline
+    from pipelines.utils.qc import QualityEngine
+
+    pipeline = Pipeline(args.pipeline_config, args.storage_config)
+    dataset = repeat_dataset(read_dataset(pipeline, SAMPLE_FILE), args.repeat)
+
+    # tsdat changes the config's variable lists, so each gets its own copy
+    config = Config.load([args.pipeline_config])
+    expected, tsdat_seconds, tsdat_mb = time_qc(lambda ds: QualityManagement.run(ds, config, None), dataset)
+    engine = QualityEngine(Config.load([args.pipeline_config]))
+    result, engine_seconds, engine_mb = time_qc(lambda ds: engine.run(ds, None), dataset)
+
+    print(f"{dataset.sizes['time']} rays x {dataset.sizes['distance']} range gates")
+    print(f"tsdat QualityManagement: {tsdat_seconds:8.3f} s {tsdat_mb:8.1f} MB peak")
+    print(f"QualityEngine:           {engine_seconds:8.3f} s {engine_mb:8.1f} MB peak")
+    print(f"identical results: {result.identical(expected)}")
+
+
+if __name__ == '__main__':
+    main()
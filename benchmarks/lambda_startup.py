@@ -0,0 +1,64 @@
+"""-------------------------------------------------------------------
+Benchmarks importing the Lambda function's handler module, which runs on
+every cold start before any event is handled, in fresh interpreters.
+Exits with an error if the fastest import takes longer than the budget,
+or if it imports any of the modules that should only be imported when a
+pipeline runs.
+
+Usage:
+    python benchmarks/lambda_startup.py [--repeat 5] [--budget 0.5]
+-------------------------------------------------------------------"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+project_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+lambda_dir = os.path.join(project_dir, 'lambda_function')
+
+# Modules that take seconds to import and are only needed to run pipelines
+DEFERRED_MODULES = ['tsdat', 'xarray', 'matplotlib', 'cmocean', 'act']
+
+IMPORT_SCRIPT = f"""
+import json, sys, time
+start = time.perf_counter()
+import lambda_function
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds, 'imported': [m for m in {DEFERRED_MODULES!r} if m in sys.modules]}}))
+"""
+
+
+def time_import() -> dict:
+    """-------------------------------------------------------------------
+    Import lambda_function in a fresh interpreter.
+
+    Returns:
+        dict:   The import time in seconds and the deferred modules that
+                were imported.
+    -------------------------------------------------------------------"""
+    output = subprocess.run([sys.executable, '-c', IMPORT_SCRIPT], cwd=lambda_dir, check=True,
+                            stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5, help='The number of imports to time.')
+    parser.add_argument('--budget', type=float, default=0.5, help='The most seconds the import may take.')
+    args = parser.parse_args()
+
+    results = [time_import() for _ in range(args.repeat)]
+    seconds = sorted(result['seconds'] for result in results)
+    imported = sorted({module for result in results for module in result['imported']})
+
+    print(f"import lambda_function: {seconds[0] * 1000:8.1f} ms fastest, "
+          f"{seconds[len(seconds) // 2] * 1000:8.1f} ms median, budget {args.budget * 1000:.0f} ms")
+    if imported:
+        print(f"deferred modules imported: {', '.join(imported)}")
+    if seconds[0] > args.budget or imported:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""-------------------------------------------------------------------
+Benchmarks netCDF encoding profiles on a synthetic Halo lidar output
+dataset.  For each profile reports the time to write the file, the file
+size, and the time to read the doppler values of a ten minute window
+below 5 km, which is what the plots and most analyses read.
+
+Usage:
+    python benchmarks/netcdf_encoding.py [--rays 3600] [--repeat 3]
+-------------------------------------------------------------------"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import yaml
+
+project_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+lambda_dir = os.path.join(project_dir, 'lambda_function')
+sys.path.insert(0, lambda_dir)
+
+from tsdat.io.filehandlers import NetCdfHandler
+from pipelines.utils.netcdf import apply_encoding_profile
+
+config_file = os.path.join(lambda_dir, 'pipelines/awa_halo_ingest/config/pipeline_config_nwtc.yml')
+
+
+def get_profiles():
+    with open(config_file, 'r') as f:
+        config = yaml.safe_load(f)
+
+    return {
+        'default': {},
+        'zlib': {'zlib': True, 'complevel': 4},
+        'zlib+shuffle+chunks': {
+            'chunks': {'time': 1024, 'distance': 240}, 'zlib': True, 'complevel': 4, 'shuffle': True,
+        },
+        'nwtc config': config['pipeline']['encoding'],
+        'nwtc config+pack': {
+            **config['pipeline']['encoding'],
+            'pack': {
+                'doppler': {'dtype': 'int16', 'scale_factor': 0.002},
+                'intensity': {'dtype': 'int32', 'scale_factor': 0.000001},
+            },
+        },
+    }
+
+
+def create_dataset(num_rays: int, num_gates: int = 720) -> xr.Dataset:
+    """Creates a dataset shaped and quantized like a Halo pipeline output."""
+    rng = np.random.default_rng(0)
+    time = pd.date_range('2021-05-10', periods=num_rays, freq='1s').values
+    distance = np.arange(num_gates) * 18.0
+
+    # Doppler is reported in steps of 0.0764 m/s with four decimals, and
+    # intensity (SNR + 1) with six decimals
+    profile = 5 * np.sin(distance / 3000)
+    doppler = np.round(np.round((profile + rng.normal(0, 1, (num_rays, num_gates))) / 0.0764) * 0.0764, 4)
+    intensity = np.round(1 + np.exp(-distance / 2000) * rng.uniform(0.5, 1.5, (num_rays, num_gates)), 6)
+    qc = (rng.random((num_rays, num_gates)) < 0.1).astype(np.int32)
+
+    dataset = xr.Dataset(
+        {
+            'doppler': (('time', 'distance'), doppler.astype(np.float32), {'_FillValue': -9999.0}),
+            'intensity': (('time', 'distance'), intensity.astype(np.float32), {'_FillValue': -9999.0}),
+            'SNR': (('time', 'distance'), (10 * np.log10(intensity - 1)).astype(np.float32)),
+            'qc_doppler': (('time', 'distance'), qc),
+            'azimuth': ('time', np.full(num_rays, 90.01, dtype=np.float32)),
+        },
+        coords={'time': time, 'distance': distance},
+    )
+    dataset['time'].attrs['units'] = 'seconds since 1970-01-01T00:00:00'
+    return dataset
+
+
+def read_window(filename: str):
+    with xr.open_dataset(filename) as ds:
+        start = ds['time'].values[0]
+        window = ds['doppler'].sel(time=slice(start, start + np.timedelta64(10, 'm')), distance=slice(0, 5000))
+        window.load()
+
+
+def best_time(func, repeat: int) -> float:
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rays', type=int, default=3600, help='The number of rays in the dataset.')
+    parser.add_argument('--repeat', type=int, default=3, help='The number of times to repeat each measurement.')
+    args = parser.parse_args()
+
+    dataset = create_dataset(args.rays)
+    handler = NetCdfHandler()
+
+    print(f"{'profile':<22}{'write (s)':>12}{'size (MB)':>12}{'read (s)':>12}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, profile in get_profiles().items():
+            filename = os.path.join(tmp_dir, f"{name.replace(' ', '_')}.nc")
+            encoded = apply_encoding_profile(dataset.copy(deep=True), profile)
+
+            write_time = best_time(lambda: handler.write(encoded.copy(), filename), args.repeat)
+            size = os.path.getsize(filename) / 2 ** 20
+            read_time = best_time(lambda: read_window(filename), args.repeat)
+            print(f"{name:<22}{write_time:>12.3f}{size:>12.2f}{read_time:>12.4f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""-------------------------------------------------------------------
+Benchmarks getting a pipeline in runner.run_pipeline on a cold start,
+when the pipeline is built from its config files, and on a warm start,
+when it is reused from the process's pipeline cache.  The first cold
+start also includes importing the pipeline module.
+
+Usage:
+    python benchmarks/pipeline_startup.py [--pipeline awa_halo_ingest]
+        [--location nwtc] [--storage-config path] [--repeat 10]
+-------------------------------------------------------------------"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+project_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+lambda_dir = os.path.join(project_dir, 'lambda_function')
+pipelines_dir = os.path.join(lambda_dir, 'pipelines')
+sys.path.insert(0, lambda_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pipeline', default='awa_halo_ingest', help='The pipeline folder.')
+    parser.add_argument('--location', default='nwtc', help='The location of the pipeline config file.')
+    parser.add_argument('--storage-config', default=os.path.join(pipelines_dir, 'config/storage_config.yml'),
+                        help='The storage config file.')
+    parser.add_argument('--repeat', type=int, default=10, help='The number of cold and warm starts to time.')
+    args = parser.parse_args()
+
+    # Write to a throwaway local store unless the storage is configured
+    os.environ.setdefault('STORAGE_CLASSNAME', 'tsdat.io.FilesystemStorage')
+    os.environ.setdefault('RETAIN_INPUT_FILES', 'True')
+    os.environ.setdefault('ROOT_DIR', tempfile.mkdtemp())
+
+    from pipelines.runner import get_pipeline, pipeline_cache
+    pipeline_config = os.path.join(pipelines_dir, args.pipeline, 'config', f'pipeline_config_{args.location}.yml')
+
+    def time_get_pipeline():
+        start = time.perf_counter()
+        get_pipeline(args.pipeline, args.location, pipeline_config, args.storage_config)
+        return time.perf_counter() - start
+
+    first = time_get_pipeline()
+    cold, warm = [], []
+    for i in range(args.repeat):
+        pipeline_cache.clear()
+        cold.append(time_get_pipeline())
+        warm.append(time_get_pipeline())
+
+    print(f"first start (imports + configs): {first * 1000:10.2f} ms")
+    print(f"cold start (configs):            {min(cold) * 1000:10.2f} ms")
+    print(f"warm start (cached):             {min(warm) * 1000:10.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""-------------------------------------------------------------------
+Writes synthetic Halo Photonics .hpl files with the same header and
+line layout as the lidar's Stare files, at any number of rays and range
+gates, for benchmarks and tests.  The values are deterministic for a
+given seed: a smooth wind profile with noise, intensities that fall off
+with distance to below 1 (where the SNR is undefined) and backscatter
+that follows the intensity.
+
+Usage:
+    python benchmarks/synthetic_hpl.py output.nwtc.hpl [--rays 4500]
+        [--gates 720] [--seed 0]
+-------------------------------------------------------------------"""
+import argparse
+
+import numpy as np
+import pandas as pd
+
+# The seconds between rays of the Stare files
+RAY_SECONDS = 0.79
+
+HEADER = (
+    'Filename:\tStare_199_{start:%Y%m%d_%H}.hpl\r\n'
+    'System ID:\t199\r\n'
+    'Number of gates:\t{num_gates}\r\n'
+    'Range gate length (m):\t{gate_length}\r\n'
+    'Gate length (pts):\t12\r\n'
+    'Pulses/ray:\t5000\r\n'
+    'No. of rays in file:\t{num_rays}\r\n'
+    'Scan type:\tStare - overlapping\r\n'
+    'Focus range:\t65535\r\n'
+    'Start time:\t{start:%Y%m%d %H:%M:%S}.{centiseconds:02d}\r\n'
+    'Resolution (m/s):\t0.0764\r\n'
+    'Altitude of measurement (center of gate) = (range gate + 0.5) * Gate length\r\n'
+    'Data line 1: Decimal time (hours)  Azimuth (degrees)  Elevation (degrees) Pitch (degrees) Roll (degrees)\r\n'
+    'f9.6,1x,f6.2,1x,f6.2\r\n'
+    'Data line 2: Range Gate  Doppler (m/s)  Intensity (SNR + 1)  Beta (m-1 sr-1)\r\n'
+    'i3,1x,f6.4,1x,f8.6,1x,e12.6 - repeat for no. gates\r\n'
+    '****\r\n'
+)
+RAY_FORMAT = '%.8f %6.2f %6.2f %.2f %.2f\r\n'
+GATE_FORMAT = '%3d %.4f %.6f %13.6E \r\n'
+
+
+def make_rays(num_rays: int, num_gates: int, gate_length: float = 18.0, seed: int = 0):
+    """-------------------------------------------------------------------
+    Make the values of synthetic rays.
+
+    Args:
+        num_rays (int):                 The number of rays.
+        num_gates (int):                The number of range gates per ray.
+        gate_length (float, optional):  The range gate length in meters.
+                                        Defaults to 18.
+        seed (int, optional):           The random seed. Defaults to 0.
+
+    Returns:
+        Tuple[np.ndarray, ...]: The seconds of each ray since the start
+        time, the azimuth, elevation, pitch and roll of each ray with shape
+        (ray, 4), and the doppler, intensity and beta of each gate, each
+        with shape (ray, gate).
+    -------------------------------------------------------------------"""
+    rng = np.random.default_rng(seed)
+    seconds = np.arange(num_rays) * RAY_SECONDS + rng.uniform(0, 0.01, num_rays)
+
+    angles = np.column_stack([
+        90.01 + rng.normal(0, 0.01, num_rays),
+        90 + rng.normal(0, 0.02, num_rays),
+        0.16 + rng.normal(0, 0.05, num_rays),
+        -0.3 + rng.normal(0, 0.05, num_rays),
+    ])
+
+    distance = (np.arange(num_gates) + 0.5) * gate_length
+    wind = np.sin(seconds / 600)[:, np.newaxis] * np.log1p(distance / 100)[np.newaxis, :]
+    doppler = 0.0764 * np.round((wind + rng.normal(0, 0.3, wind.shape)) / 0.0764)
+
+    signal = 0.03 * np.exp(-distance / 1500)[np.newaxis, :]
+    intensity = 1 + signal * (1 + 0.1 * np.cos(seconds / 300))[:, np.newaxis] + rng.normal(0, 0.002, wind.shape)
+    beta = (intensity - 1) * 5e-5 * rng.uniform(0.5, 1.5, wind.shape)
+    return seconds, angles, doppler, intensity, beta
+
+
+def write_hpl(filename: str, num_rays: int, num_gates: int, start_time: str = '2021-05-10 00:01:25.78',
+              gate_length: float = 18.0, seed: int = 0):
+    """-------------------------------------------------------------------
+    Write a synthetic .hpl file.  Decimal times wrap at midnight like the
+    lidar's, so a start time late in the day gives a file that crosses
+    into the next day.
+
+    Args:
+        filename (str):                 The path of the file to write.
+        num_rays (int):                 The number of rays.
+        num_gates (int):                The number of range gates per ray.
+        start_time (str, optional):     The start time in the header.
+                                        Defaults to 2021-05-10 00:01:25.78.
+        gate_length (float, optional):  The range gate length in meters.
+                                        Defaults to 18.
+        seed (int, optional):           The random seed. Defaults to 0.
+    -------------------------------------------------------------------"""
+    start = pd.Timestamp(start_time)
+    seconds, angles, doppler, intensity, beta = make_rays(num_rays, num_gates, gate_length, seed)
+    start_hours = (start - start.normalize()) / pd.Timedelta(hours=1)
+    hours = (start_hours + seconds / 3600) % 24
+
+    gates = np.arange(num_gates)
+    ray_gates_format = GATE_FORMAT * num_gates
+
+    # The file ends without a line break, like the lidar's
+    with open(filename, 'w', newline='') as f:
+        f.write(HEADER.format(start=start, centiseconds=start.microsecond // 10000, num_gates=num_gates,
+                              gate_length=gate_length, num_rays=num_rays))
+        for ray in range(num_rays):
+            text = RAY_FORMAT % (hours[ray], *angles[ray])
+            values = np.column_stack([gates, doppler[ray], intensity[ray], beta[ray]])
+            # Fortran exponents have no leading zero, e.g. 1.266357E-6
+            text += (ray_gates_format % tuple(values.ravel())).replace('E-0', 'E-').replace('E+0', 'E+')
+            f.write(text if ray < num_rays - 1 else text.rstrip())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('filename', help='The path of the .hpl file to write.')
+    parser.add_argument('--rays', type=int, default=4500, help='The number of rays.')
+    parser.add_argument('--gates', type=int, default=720, help='The number of range gates.')
+    parser.add_argument('--seed', type=int, default=0, help='The random seed.')
+    args = parser.parse_args()
+
+    write_hpl(args.filename, args.rays, args.gates, seed=args.seed)
+
+
+if __name__ == '__main__':
+    main()
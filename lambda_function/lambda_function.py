@@ -1,17 +1,23 @@
 import json
 import os
-from pipelines.runner import run_pipeline
+from pipelines.runner import get_query_file, is_routed, run_pipelines
 from typing import Dict
 from urllib.parse import unquote_plus
 
-from tsdat.io import S3Path
 from pipelines.utils.log_helper import logger, log_exception
 
 
 def get_s3_path(record: Dict):
+    # tsdat takes seconds to import, so it is only imported once a record
+    # is for a file that a pipeline will process
+    from tsdat.io import S3Path
+
     bucket_name = record['s3']['bucket']['name']
     bucket_path = unquote_plus(record['s3']['object']['key'])
     s3_path = S3Path(bucket_name, bucket_path)
+
+    # Identifies the object's content in the processed-file ledger
+    s3_path.etag = record['s3']['object'].get('eTag')
     return s3_path
 
 
@@ -42,8 +48,9 @@ def set_env_vars():
     retain_input_files = os.environ.get('RETAIN_INPUT_FILES', 'False')
     os.environ['RETAIN_INPUT_FILES'] = retain_input_files
 
-    # Storage
-    storage_classname = os.environ.get('STORAGE_CLASSNAME', 'tsdat.io.AwsStorage')
+    # Storage.  AsyncAwsStorage uploads outputs while the pipeline keeps
+    # working and can prefetch inputs.
+    storage_classname = os.environ.get('STORAGE_CLASSNAME', 'pipelines.utils.aws_storage.AsyncAwsStorage')
     os.environ['STORAGE_CLASSNAME'] = storage_classname
 
 
@@ -82,13 +89,23 @@ def lambda_handler(event, context):
         for record in sns['Records']:
             logger.debug(record)
 
+            # Skip files that no pipeline is registered for without
+            # importing the pipelines
+            record = json.loads(record)
+            query_file = get_query_file(unquote_plus(record['s3']['object']['key']))
+            if not is_routed(query_file):
+                logger.info(f'Skipping file: {query_file} since no pipeline is registered for it.')
+                continue
+
             # Get the AWS path to the raw file from the lambda event
-            s3_path = get_s3_path(json.loads(record))
+            s3_path = get_s3_path(record)
             input_files.append(s3_path)
 
         deployment_mode = 'aws_dev'
 
-        run_pipeline(input_files=input_files)
+        # Records may be for different pipelines and locations, so each
+        # group of files is run by its own pipeline
+        run_pipelines(input_files=input_files)
 
     except Exception as e:
         # This is only to catch for exceptions that happen outside the pipeline
@@ -2,8 +2,394 @@ import xarray as xr
 import pandas as pd
 from tsdat.io import AbstractFileHandler
 from tsdat import Config
+import io
+import mmap
 import numpy as np
+import os
+import warnings
+import zipfile
+from contextlib import contextmanager
+from itertools import islice
+from typing import Dict, Iterator, Optional, TextIO, Tuple
 
+from pipelines.utils.compression import is_compressed, open_member
+
+
+# The .hpl header is 11 "key: value" metadata lines followed by 6 lines
+# describing the layout of the data block.
+HEADER_METADATA_LINES = 11
+HEADER_LABEL_LINES = 6
+HEADER_LINES = HEADER_METADATA_LINES + HEADER_LABEL_LINES
+
+# Each ray is one line of ray values (decimal time, azimuth, elevation,
+# pitch, roll) followed by one line per range gate (range gate, doppler,
+# intensity, beta).
+RAY_FIELDS = 5
+GATE_FIELDS = 4
+
+# Names of the raw variables parsed from each ray and gate line.  These are
+# the keys of the dtypes mapping accepted by the reader.
+RAY_VARIABLES = ['Decimal time (hours)', 'Azimuth (degrees)', 'Elevation (degrees)', 'Pitch (degrees)', 'Roll (degrees)']
+GATE_VARIABLES = ['Doppler', 'Intensity', 'Beta']
+
+# Number of rays parsed at a time.  This bounds the amount of raw text held
+# in memory while reading, independent of the length of the file.
+RAYS_PER_CHUNK = 500
+
+# Number of bytes scanned at a time when indexing a memory-mapped file
+INDEX_SCAN_BYTES = 64 * 1024 * 1024
+
+# The name of the .hpl file in a gzip, zip or tar file
+HPL_MEMBER_PATTERN = r'.*\.hpl'
+
+
+def parse_rays(data: str, num_gates: int) -> Tuple[np.ndarray, np.ndarray]:
+    """-------------------------------------------------------------------
+    Parse the data block of a .hpl file in a single pass.
+
+    The data block is tokenized in bulk by numpy and reshaped into rays,
+    rather than splitting and converting each line in python.  Values are
+    parsed with the same correctly-rounded conversion as float(), so the
+    results are bit-identical to a line-by-line reader.  A partially
+    written ray at the end of the block is dropped.  numpy stops at the
+    first value it can't parse, so the values are checked against the
+    number of complete rays in the block, like float() would raise.  Gate
+    values are placed by the range gate in their first column, so gates
+    written out of order are put back in order.
+
+    Args:
+        data (str):         The text following the .hpl header.
+        num_gates (int):    The number of range gates per ray.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The ray values with shape
+        (ray, RAY_FIELDS) and the gate values with shape
+        (ray, gate, GATE_FIELDS).
+
+    Raises:
+        ValueError: If a complete ray has a value that can't be parsed, or
+        its range gates aren't each of 0 to num_gates - 1 once.
+    -------------------------------------------------------------------"""
+    with warnings.catch_warnings():
+        # numpy warns that it stopped early, which is checked below
+        warnings.simplefilter('ignore', DeprecationWarning)
+        values = np.fromstring(data, dtype=np.float64, sep=' ')
+
+    ray_size = RAY_FIELDS + GATE_FIELDS * num_gates
+    num_rays = values.size // ray_size
+    complete_rays = data.count(b'\n' if isinstance(data, bytes) else '\n') // (num_gates + 1)
+    if num_rays < complete_rays:
+        raise ValueError(f'Could not parse ray {num_rays} of the data block: only {values.size} of the '
+                         f'{complete_rays * ray_size} values of its complete rays are numbers')
+    values = values[:num_rays * ray_size].reshape(num_rays, ray_size)
+
+    rays = values[:, :RAY_FIELDS]
+    gates = values[:, RAY_FIELDS:].reshape(num_rays, num_gates, GATE_FIELDS)
+
+    expected = np.arange(num_gates)
+    range_gates = gates[:, :, 0]
+    if not (range_gates == expected).all():
+        order = np.argsort(range_gates, axis=1, kind='stable')
+        gates = np.take_along_axis(gates, order[:, :, np.newaxis], axis=1)
+        bad_rays = np.flatnonzero((gates[:, :, 0] != expected).any(axis=1))
+        if bad_rays.size:
+            raise ValueError(f'Ray {bad_rays[0]} of the data block does not have range gates 0 to {num_gates - 1}: '
+                             f'{range_gates[bad_rays[0]].tolist()}')
+    return rays, gates
+
+
+def decimal_hours_to_datetime64(hours: np.ndarray, start_time: np.datetime64) -> np.ndarray:
+    """-------------------------------------------------------------------
+    Convert the decimal time of each ray to np.datetime64 in one vectorized
+    operation.
+
+    Decimal time counts hours since midnight UTC of the start date and
+    wraps back to 0 at midnight, so a day is added for every backwards
+    jump of more than 12 hours, including one between the header start
+    time and the first ray.
+
+    Args:
+        hours (np.ndarray):         The decimal time of each ray.
+        start_time (np.datetime64): The start time from the .hpl header.
+
+    Returns:
+        np.ndarray: The datetime64[us] timestamp of each ray.
+    -------------------------------------------------------------------"""
+    midnight = start_time.astype('datetime64[D]')
+    start_hours = (start_time - midnight) / np.timedelta64(1, 'h')
+
+    days = np.cumsum(np.diff(hours, prepend=start_hours) < -12)
+    microseconds = (3600 * 1e6 * hours).astype(np.int64)
+
+    return midnight + days.astype('timedelta64[D]') + microseconds.astype('timedelta64[us]')
+
+
+class RayBuffer:
+    """-------------------------------------------------------------------
+    Growable storage for parsed rays.  The ray values and the doppler,
+    intensity and beta gate values are each kept in their own contiguous
+    array so they can be handed to xarray without another copy.  Buffers
+    grow geometrically when a chunk does not fit and are trimmed to the
+    exact number of rays once reading is done.
+
+    Gate values are stored in the data type given for them in dtypes as
+    each chunk is copied in, so a full-size float64 copy is never made
+    when a smaller type is requested.  Ray values are always kept as
+    float64 since the decimal time needs the precision to compute
+    timestamps.
+
+    Args:
+        num_gates (int):    The number of range gates per ray.
+        capacity (int):     The initial number of rays to allocate.
+        dtypes (Dict[str, np.dtype], optional): Data types keyed by raw
+                                                variable name. Defaults to
+                                                float64.
+    -------------------------------------------------------------------"""
+
+    def __init__(self, num_gates: int, capacity: int, dtypes: Dict[str, np.dtype] = None):
+        dtypes = dtypes or {}
+        self.size = 0
+        self.rays = np.empty((capacity, RAY_FIELDS))
+        self.doppler = np.empty((capacity, num_gates), dtype=dtypes.get('Doppler', np.float64))
+        self.intensity = np.empty((capacity, num_gates), dtype=dtypes.get('Intensity', np.float64))
+        self.beta = np.empty((capacity, num_gates), dtype=dtypes.get('Beta', np.float64))
+
+    @property
+    def capacity(self) -> int:
+        return len(self.rays)
+
+    def append(self, rays: np.ndarray, gates: np.ndarray):
+        start, end = self.size, self.size + len(rays)
+        if end > self.capacity:
+            self._resize(max(end, int(self.capacity * 1.5)))
+
+        self.rays[start:end] = rays
+        self.doppler[start:end] = gates[:, :, 1]
+        self.intensity[start:end] = gates[:, :, 2]
+        self.beta[start:end] = gates[:, :, 3]
+        self.size = end
+
+    def trim(self):
+        if self.size != self.capacity:
+            self._resize(self.size)
+
+    def _resize(self, capacity: int):
+        # New arrays are allocated rather than resizing in place, so views
+        # of the old arrays handed out before the resize stay valid.
+        for name in ['rays', 'doppler', 'intensity', 'beta']:
+            array = getattr(self, name)
+            resized = np.empty((capacity,) + array.shape[1:], dtype=array.dtype)
+            rows = min(self.size, capacity)
+            resized[:rows] = array[:rows]
+            setattr(self, name, resized)
+
+
+@contextmanager
+def open_hpl(filename: str) -> Iterator[Tuple[TextIO, Optional[int]]]:
+    """-------------------------------------------------------------------
+    Open a .hpl file as text.  The .hpl file in a gzip, zip or tar file
+    (e.g. a .hpl.gz file) is decompressed as it is read, without writing
+    it out to disk.
+
+    Args:
+        filename (str): The path to the file.
+
+    Yields:
+        Tuple[TextIO, Optional[int]]: The text of the .hpl file, and the
+        size of the decompressed file in bytes if it is compressed (an
+        estimate for large gzip files), or None if it isn't.
+    -------------------------------------------------------------------"""
+    if not is_compressed(filename):
+        with open(filename, 'r') as f:
+            yield f, None
+        return
+
+    with open_member(filename, HPL_MEMBER_PATTERN) as member:
+        yield io.TextIOWrapper(member.fileobj), member.size
+
+
+def read_header(f: TextIO) -> Dict[str, str]:
+    """-------------------------------------------------------------------
+    Read the header of an open .hpl file, leaving the file positioned at
+    the start of the data block.
+
+    Args:
+        f (TextIO): The .hpl file, positioned at the start of the file.
+
+    Returns:
+        Dict[str, str]: The header metadata keyed by name.
+    -------------------------------------------------------------------"""
+    lines = []
+    for line_num in range(HEADER_METADATA_LINES):
+        lines.append(f.readline())
+
+    # read metadata into strings.  Only split on the first colon since
+    # values like the start time contain colons too.
+    metadata = {}
+    for line in lines:
+        key, value = line.split(':', 1)
+        metadata[key] = value.strip()
+
+    # Read some of the label lines
+    for line_num in range(HEADER_LABEL_LINES):
+        f.readline()
+
+    return metadata
+
+
+def get_start_time(metadata: Dict[str, str]) -> np.datetime64:
+    """Returns the header 'Start time' as a np.datetime64."""
+    start_time = pd.to_datetime(metadata['Start time'], format='%Y%m%d %H:%M:%S.%f')
+    return np.datetime64(start_time, 'us')
+
+
+def iter_ray_chunks(f: TextIO, num_gates: int, rays_per_chunk: int = RAYS_PER_CHUNK) -> Iterator[Tuple[int, np.ndarray, np.ndarray]]:
+    """-------------------------------------------------------------------
+    Parse the data block of an open .hpl file a chunk of rays at a time.
+
+    Args:
+        f (TextIO):             The .hpl file, positioned after the header.
+        num_gates (int):        The number of range gates per ray.
+        rays_per_chunk (int):   The number of rays to parse at a time.
+
+    Yields:
+        Tuple[int, np.ndarray, np.ndarray]: The length of the chunk's text
+        and its ray and gate values as returned by parse_rays.
+    -------------------------------------------------------------------"""
+    lines_per_chunk = rays_per_chunk * (num_gates + 1)
+    while True:
+        chunk = ''.join(islice(f, lines_per_chunk))
+        rays, gates = parse_rays(chunk, num_gates)
+        if not len(rays):
+            return
+        yield len(chunk), rays, gates
+
+
+def read_rays(f: TextIO, num_gates: int, rays_per_chunk: int = RAYS_PER_CHUNK, dtypes: Dict[str, np.dtype] = None,
+              size: int = None) -> RayBuffer:
+    """-------------------------------------------------------------------
+    Read the data block of an open .hpl file a chunk of rays at a time.
+
+    The .hpl header's ray count is not reliable, so the buffers are sized
+    from the bytes left in the file and the size of the first chunk, then
+    grown or trimmed as needed.  Peak memory is the size of the data plus
+    a single chunk of text.  Streams that aren't files, e.g. decompressed
+    files, must be given their size.
+
+    Args:
+        f (TextIO):             The .hpl file, positioned after the header.
+        num_gates (int):        The number of range gates per ray.
+        rays_per_chunk (int):   The number of rays to parse at a time.
+        dtypes (Dict[str, np.dtype], optional): Data types keyed by raw
+                                                variable name.
+        size (int, optional):   The size of the stream in bytes, or an
+                                estimate of it. Defaults to the size of the
+                                file.
+
+    Returns:
+        RayBuffer: The parsed rays, trimmed to size.
+    -------------------------------------------------------------------"""
+    remaining_bytes = size if size is not None else os.fstat(f.fileno()).st_size - f.tell()
+
+    buffer = None
+    for chunk_bytes, rays, gates in iter_ray_chunks(f, num_gates, rays_per_chunk):
+        if buffer is None:
+            bytes_per_ray = chunk_bytes / len(rays)
+            buffer = RayBuffer(num_gates, int(np.ceil(remaining_bytes / bytes_per_ray)), dtypes)
+        buffer.append(rays, gates)
+
+    if buffer is None:
+        buffer = RayBuffer(num_gates, 0, dtypes)
+    buffer.trim()
+    return buffer
+
+
+def get_index_filename(filename: str) -> str:
+    """Returns the path of the sidecar ray index for the given .hpl file."""
+    return f'{filename}.idx.npz'
+
+
+def build_ray_index(filename: str, num_gates: int) -> Tuple[np.ndarray, np.ndarray]:
+    """-------------------------------------------------------------------
+    Scan a memory-mapped .hpl file for the start of every ray.
+
+    Newlines are located with numpy a block of bytes at a time, so only
+    the ray header lines are ever touched from python.
+
+    Args:
+        filename (str):     The path to the .hpl file.
+        num_gates (int):    The number of range gates per ray.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The byte offset of each complete
+        ray followed by the offset just past the last one, and the decimal
+        time of each complete ray.
+    -------------------------------------------------------------------"""
+    lines_per_ray = num_gates + 1
+
+    # A ray starts after the newline ending the header and then after
+    # every lines_per_ray newlines
+    def is_ray_start(newline_numbers):
+        after_header = newline_numbers - (HEADER_LINES - 1)
+        return (after_header >= 0) & (after_header % lines_per_ray == 0)
+
+    with open(filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        size = len(mm)
+        offsets = []
+        num_newlines = 0
+        for start in range(0, size, INDEX_SCAN_BYTES):
+            block = np.frombuffer(mm, dtype=np.uint8, count=min(INDEX_SCAN_BYTES, size - start), offset=start)
+            newlines = np.flatnonzero(block == ord('\n'))
+            del block
+
+            newline_numbers = num_newlines + np.arange(len(newlines))
+            offsets.append(newlines[is_ray_start(newline_numbers)] + start + 1)
+            num_newlines += len(newlines)
+
+        # The last line may not end with a newline
+        if size and mm[size - 1] != ord('\n') and is_ray_start(np.array([num_newlines]))[0]:
+            offsets.append(np.array([size]))
+
+        offsets = np.concatenate(offsets) if offsets else np.zeros(0, dtype=np.int64)
+        offsets = offsets.astype(np.int64)
+        hours = np.array([float(mm[offset:offset + 32].split(None, 1)[0]) for offset in offsets[:-1]])
+
+    return offsets, hours
+
+
+def load_ray_index(filename: str, num_gates: int) -> Tuple[np.ndarray, np.ndarray]:
+    """-------------------------------------------------------------------
+    Load the ray index of a .hpl file from its sidecar file, building and
+    saving it first if there is no sidecar or the .hpl file's size or
+    modification time has changed since it was built.  Failing to save
+    the sidecar (e.g., in a read-only directory) is not an error.
+
+    Args:
+        filename (str):     The path to the .hpl file.
+        num_gates (int):    The number of range gates per ray.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The ray offsets and decimal times as
+        returned by build_ray_index.
+    -------------------------------------------------------------------"""
+    stat = os.stat(filename)
+    index_filename = get_index_filename(filename)
+
+    try:
+        with np.load(index_filename) as index:
+            if index['size'] == stat.st_size and index['mtime_ns'] == stat.st_mtime_ns:
+                return index['offsets'], index['hours']
+    except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+        pass
+
+    offsets, hours = build_ray_index(filename, num_gates)
+    try:
+        with open(index_filename, 'wb') as f:
+            np.savez(f, size=stat.st_size, mtime_ns=stat.st_mtime_ns, offsets=offsets, hours=hours)
+    except OSError:
+        pass
+
+    return offsets, hours
 
 
 class HplHandler(AbstractFileHandler):
@@ -13,6 +399,10 @@ class HplHandler(AbstractFileHandler):
     See https://tsdat.readthedocs.io/ for more file handler examples.
     -------------------------------------------------------------------"""
 
+    # Gzip, zip and tar files of .hpl files are read as streams, so the
+    # pipeline passes them in whole instead of extracting them
+    reads_archives = True
+
     def write(self, ds: xr.Dataset, filename: str, config: Config, **kwargs):
         """-------------------------------------------------------------------
         Classes derived from the FileHandler class can implement this method
@@ -27,115 +417,178 @@ class HplHandler(AbstractFileHandler):
         -------------------------------------------------------------------"""
         raise NotImplementedError("Error: this file format should not be used to write to.")
 
-    def read(self, filename: str, **kwargs) -> xr.Dataset:
+    def read(self, filename: str, time_range: Optional[Tuple] = None, gate_range: Optional[Tuple[int, int]] = None,
+             dtypes: Dict[str, np.dtype] = None, **kwargs) -> xr.Dataset:
         """-------------------------------------------------------------------
         Classes derived from the FileHandler class can implement this method.
         to read a custom file format into a xr.Dataset object.
 
+        If a time or gate range is given, only those rays and gates are read
+        using the file's ray index (see read_window).  Compressed files
+        (e.g. .hpl.gz) are decompressed as they are parsed.
+
         Args:
             filename (str): The path to the file to read in.
+            time_range (Tuple, optional):   Start (inclusive) and end
+                                            (exclusive) times of the rays
+                                            to read. Defaults to None.
+            gate_range (Tuple[int, int], optional): Start (inclusive) and
+                                                    end (exclusive) range
+                                                    gates to read. Defaults
+                                                    to None.
+            dtypes (Dict[str, np.dtype], optional): Data types to parse the
+                                                    variables to, keyed by
+                                                    raw variable name.
+                                                    Defaults to float64.
 
         Returns:
             xr.Dataset: An xr.Dataset object
         -------------------------------------------------------------------"""
+        if time_range is not None or gate_range is not None:
+            return self.read_window(filename, time_range, gate_range, dtypes)
+
+        with open_hpl(filename) as (f, size):
+            metadata = read_header(f)
+            buffer = read_rays(f, int(metadata['Number of gates']), dtypes=dtypes, size=size)
+
+        return self._create_dataset(buffer, metadata, get_start_time(metadata), dtypes=dtypes)
+
+    def read_window(self, filename: str, time_range: Optional[Tuple] = None, gate_range: Optional[Tuple[int, int]] = None,
+                    dtypes: Dict[str, np.dtype] = None) -> xr.Dataset:
+        """-------------------------------------------------------------------
+        Read a time window and/or range of gates from a .hpl file.
+
+        The file is memory-mapped and only the bytes of the selected rays
+        are parsed.  Ray offsets come from a sidecar index that is built on
+        the first read and reused until the file changes.  Compressed files
+        can't be indexed, so they are read whole and then selected from.
+
+        Args:
+            filename (str): The path to the file to read in.
+            time_range (Tuple, optional):   Start (inclusive) and end
+                                            (exclusive) times of the rays
+                                            to read. Defaults to all rays.
+            gate_range (Tuple[int, int], optional): Start (inclusive) and
+                                                    end (exclusive) range
+                                                    gates to read. Defaults
+                                                    to all gates.
+            dtypes (Dict[str, np.dtype], optional): Data types keyed by raw
+                                                    variable name.
 
+        Returns:
+            xr.Dataset: The selected rays and gates.
+        -------------------------------------------------------------------"""
+        if is_compressed(filename):
+            return self._select_window(self.read(filename, dtypes=dtypes), time_range, gate_range)
 
-        # open file
         with open(filename, 'r') as f:
-            lines = []
-            for line_num in range(11):
-                lines.append(f.readline())
-                
-            # read metadata into strings
-            metadata = {}
-            for line in lines:
-                metaline = line.split(':')
-                if 'Start time' in metaline:
-                    metadata['Start time'] = metaline[1:]
-                else:
-                    metadata[metaline[0]] = metaline[1]
-                
-            # convert some metadata
+            metadata = read_header(f)
+        num_gates = int(metadata['Number of gates'])
+        start_time = get_start_time(metadata)
+
+        offsets, hours = load_ray_index(filename, num_gates)
+        timestamps = decimal_hours_to_datetime64(hours, start_time)
+
+        first, last = 0, len(hours)
+        if time_range is not None:
+            window_start, window_end = (np.datetime64(t, 'us') for t in time_range)
+            selected = np.flatnonzero((timestamps >= window_start) & (timestamps < window_end))
+            first, last = (selected[0], selected[-1] + 1) if len(selected) else (0, 0)
+
+        gates = slice(*gate_range) if gate_range is not None else slice(None)
+        range_gates = np.arange(num_gates)[gates]
+
+        with open(filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            data = mm[offsets[first]:offsets[last]] if last > first else b''
+
+        rays, gate_values = parse_rays(data, num_gates)
+        buffer = RayBuffer(len(range_gates), len(rays), dtypes)
+        buffer.append(rays, gate_values[:, gates])
+
+        # Anchor midnight rollover on the ray before the window
+        anchor = timestamps[first - 1] if first > 0 else start_time
+        return self._create_dataset(buffer, metadata, anchor, range_gates, dtypes)
+
+    def read_blocks(self, filename: str, rays_per_block: int = RAYS_PER_CHUNK, dtypes: Dict[str, np.dtype] = None,
+                    **kwargs) -> Iterator[xr.Dataset]:
+        """-------------------------------------------------------------------
+        Read a .hpl file as a sequence of datasets holding at most
+        rays_per_block rays each, so the whole file never has to be in
+        memory at once.  Concatenating the blocks along time gives the same
+        dataset as the read method.
+
+        Args:
+            filename (str):         The path to the file to read in.
+            rays_per_block (int):   The maximum number of rays per block.
+            dtypes (Dict[str, np.dtype], optional): Data types keyed by raw
+                                                    variable name.
+
+        Yields:
+            xr.Dataset: One dataset per block of rays.
+        -------------------------------------------------------------------"""
+        with open_hpl(filename) as (f, size):
+            metadata = read_header(f)
             num_gates = int(metadata['Number of gates'])
-            
-            # Read some of the label lines
-            for line_num in range(6):
-                f.readline()
-                
-            
-            max_len = 10000
-            # initialize arrays
-            time            = np.full(max_len, fill_value=np.nan)
-            azimuth         = np.full(max_len, fill_value=np.nan)
-            elevation       = np.full(max_len, fill_value=np.nan)
-            pitch           = np.full(max_len, fill_value=np.nan)
-            roll            = np.full(max_len, fill_value=np.nan)
-            doppler         = np.full((max_len,num_gates), fill_value=np.nan)
-            intensity       = np.full((max_len,num_gates), fill_value=np.nan)
-            beta            = np.full((max_len,num_gates), fill_value=np.nan)
-                        
-            index = 0
-            
-            while True:
-                a = f.readline().split()
-                if not len(a): # is empty
-                    break
-
-                data_point = {}
-                time[index]         = float(a[0])
-                azimuth[index]      = float(a[1])
-                elevation[index]    = float(a[2])
-                pitch[index]        = float(a[3])
-                roll[index]         = float(a[4])
-
-                for i in range(num_gates):
-                    b = f.readline().split()
-                    range_gate                  = int(b[0])
-                    doppler[index,range_gate]   = float(b[1])
-                    intensity[index,range_gate] = float(b[2])
-                    beta[index,range_gate]      = float(b[3])
-                    
-                # increment index
-                index += 1
-
-                # # print status
-                # if True and index % 100 == 0:
-                #     print(time[index-1])
-                    
-
-        # Trim data where first time index is nan
-        last_ind = np.where(np.isnan(time))[0][0]
-
-        # convert date to np.datetime64
-        start_time_string = '{}-{}-{}T{}:{}:{}'.format(
-            metadata['Start time'][0][1:5],     # year
-            metadata['Start time'][0][5:7],     # month
-            metadata['Start time'][0][7:9],     # day
-            '00',           # hour
-            '00',           # minute
-            '00.00'         # second
-        )
-        start_time  = np.datetime64(start_time_string)      
-        dtimes      = time[:last_ind]
-        tt          = []
-        for i, t in enumerate(dtimes):
-            tt.append(start_time + np.timedelta64(int(3600 * 1e6 *t),'us'))
+
+            # Anchor each block on the end of the previous one so midnight
+            # rollover is still detected across block boundaries
+            start_time = get_start_time(metadata)
+            for chunk_bytes, rays, gates in iter_ray_chunks(f, num_gates, rays_per_block):
+                buffer = RayBuffer(num_gates, len(rays), dtypes)
+                buffer.append(rays, gates)
+
+                dataset = self._create_dataset(buffer, metadata, start_time, dtypes=dtypes)
+                start_time = dataset['Timestamp'].data[-1]
+                yield dataset
+
+    @staticmethod
+    def _select_window(dataset: xr.Dataset, time_range: Optional[Tuple] = None,
+                       gate_range: Optional[Tuple[int, int]] = None) -> xr.Dataset:
+        # The same rays and gates as read_window selects from the file
+        if time_range is not None:
+            window_start, window_end = (np.datetime64(t, 'us') for t in time_range)
+            timestamps = dataset['Timestamp'].values
+            selected = np.flatnonzero((timestamps >= window_start) & (timestamps < window_end))
+            dataset = dataset.isel(time=slice(selected[0], selected[-1] + 1) if len(selected) else slice(0, 0))
+        if gate_range is not None:
+            dataset = dataset.isel(range_gate=slice(*gate_range))
+        return dataset
+
+    @staticmethod
+    def _create_dataset(buffer: RayBuffer, metadata: Dict[str, str], start_time: np.datetime64, range_gates: np.ndarray = None,
+                        dtypes: Dict[str, np.dtype] = None) -> xr.Dataset:
+        if range_gates is None:
+            range_gates = np.arange(int(metadata['Number of gates']))
+
+        dtypes = dtypes or {}
+        time, azimuth, elevation, pitch, roll = np.ascontiguousarray(buffer.rays.T)
+        doppler     = buffer.doppler
+        intensity   = buffer.intensity
+        beta        = buffer.beta
+
+        # convert decimal hours to np.datetime64
+        timestamps  = decimal_hours_to_datetime64(time, start_time)
+
+        time, azimuth, elevation, pitch, roll = [
+            values.astype(dtypes.get(name, np.float64), copy=False)
+            for name, values in zip(RAY_VARIABLES, [time, azimuth, elevation, pitch, roll])
+        ]
 
         dataset = xr.Dataset(
             {
-                'Decimal time (hours)' :   (("time"), time[:last_ind]),
-                'Timestamp' :              (("time"), np.array(tt)),
-                'Azimuth (degrees)' :      (("time"), azimuth[:last_ind]),
-                'Elevation (degrees)' :    (("time"), elevation[:last_ind]),
-                'Pitch (degrees)' :        (("time"), pitch[:last_ind]),
-                'Roll (degrees)' :         (("time"), roll[:last_ind]),
-                'Doppler' :                (("time","range_gate"), doppler[:last_ind,:]),
-                'Intensity' :              (("time","range_gate"), intensity[:last_ind,:]),
-                'Beta' :                   (("time","range_gate"), beta[:last_ind,:]),
+                'Decimal time (hours)' :   (("time"), time),
+                'Timestamp' :              (("time"), timestamps),
+                'Azimuth (degrees)' :      (("time"), azimuth),
+                'Elevation (degrees)' :    (("time"), elevation),
+                'Pitch (degrees)' :        (("time"), pitch),
+                'Roll (degrees)' :         (("time"), roll),
+                'Doppler' :                (("time","range_gate"), doppler),
+                'Intensity' :              (("time","range_gate"), intensity),
+                'Beta' :                   (("time","range_gate"), beta),
             },
             coords = {
-                "time": np.array(tt),
-                "range_gate": np.arange(num_gates)
+                "time": timestamps,
+                "range_gate": range_gates
             },
             attrs = {
                 "Range gate length (m)": float(metadata['Range gate length (m)'])
@@ -1,27 +1,436 @@
+import multiprocessing as mp
 import os
-from typing import Dict
+import warnings
+from contextlib import ExitStack
+from itertools import chain
+from typing import Dict, Iterator, List, Union
 
-import cmocean
-import matplotlib as mpl
-import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 import xarray as xr
-from tsdat.pipeline import IngestPipeline
+from tsdat.io import DatastreamStorage, FileHandler
 from tsdat.utils import DSUtil
+from tsdat.utils.converters import DefaultConverter
+
+from pipelines.utils.downsample import downsample, get_pixel_sizes
+from pipelines.utils.instrumentation import stage
+from pipelines.utils.netcdf import NetCdfAppender, apply_encoding_profile
+from pipelines.utils.parallel import get_max_workers, iterate_in_processes, map_in_processes
+from pipelines.utils.pipeline import A2ePipeline
+from pipelines.utils.qc import QualityEngine
+from pipelines.utils.zarr_handler import ZarrAppender, is_zarr_store, open_zarr
 
 example_dir = os.path.abspath(os.path.dirname(__file__))
 style_file = os.path.join(example_dir, "styling.mplstyle")
-plt.style.use(style_file)
+
+# The plotting modules, imported by import_plotting() when the first plot
+# is made rather than on every cold start
+cmocean = mpl = plt = None
+
+
+# The plots made by Pipeline.hook_generate_and_persist_plots: the name of
+# the plot, its title, the variable plotted against distance and time, the
+# colorbar label and the plot's keyword arguments
+PLOTS = [
+    ("wind_speed_v_dist_time", "Wind Speed", "doppler", r"Wind Speed (ms$^{-1}$)", dict(vmin=-5, vmax=5)),
+    ("SNR_v_dist_time", "Signal to Noise Ratio", "SNR", "SNR (dB)", dict()),
+]
+
+# The size in inches and resolution of the plots
+FIGSIZE = (14, 8)
+DPI = 100
+
+# The data plotted by render_plot, set by the pipeline before the plot
+# workers are forked so they don't need a copy of it sent to them
+shared_plot_data = None
 
 
-class Pipeline(IngestPipeline):
+def import_plotting():
+    """-------------------------------------------------------------------
+    Imports matplotlib and cmocean the first time it is called, selects the
+    non-interactive Agg backend and applies the plot style.  Runs that
+    only ingest data or skip their files don't pay for these imports.
+    -------------------------------------------------------------------"""
+    global cmocean, mpl, plt
+    if plt is not None:
+        return
+
+    import matplotlib
+    matplotlib.use("Agg")
+    import cmocean as cmocean_module
+    import matplotlib.dates
+    import matplotlib.pyplot as pyplot
+    pyplot.style.use(style_file)
+    cmocean, mpl, plt = cmocean_module, matplotlib, pyplot
+
+
+def format_time_xticks(ax, start=4, stop=21, step=4, date_format="%H-%M"):
+    ax.xaxis.set_major_locator(mpl.dates.HourLocator(byhour=range(start, stop, step)))
+    ax.xaxis.set_major_formatter(mpl.dates.DateFormatter(date_format))
+    plt.setp(ax.xaxis.get_majorticklabels(), rotation=0, ha='center')
+
+
+def add_colorbar(ax, plot, label):
+    cb = plt.colorbar(plot, ax=ax, pad=0.01)
+    cb.ax.set_ylabel(label, fontsize=12)
+    cb.outline.set_linewidth(1)
+    cb.ax.tick_params(size=0)
+    cb.ax.minorticks_off()
+    return cb
+
+
+def get_cell_edges(centers: np.ndarray) -> np.ndarray:
+    # The edges halfway between the centers of the cells of a plot
+    centers = np.asarray(centers, dtype=np.float64)
+    if len(centers) < 2:
+        return np.concatenate([centers - 0.5, centers + 0.5])
+    midpoints = (centers[1:] + centers[:-1]) / 2
+    return np.concatenate([[2 * centers[0] - midpoints[0]], midpoints, [2 * centers[-1] - midpoints[-1]]])
+
+
+def render_plot(plot) -> str:
+    """-------------------------------------------------------------------
+    Renders one of the PLOTS to a png file.  Defined at module level so it
+    can be run in a worker process.
+
+    Args:
+    ---
+        plot (Tuple):   The path of the png file, the title, the variable,
+                        the colorbar label, the plot's keyword arguments,
+                        'pcolormesh' or 'contourf', and optionally the data
+                        to plot if it isn't shared_plot_data.
+
+    Returns:
+    ---
+        str: The path of the png file.
+    -------------------------------------------------------------------"""
+    tmp_path, title, variable, label, kwargs, method, *data = plot
+    data = data[0] if data else shared_plot_data
+    import_plotting()
+
+    fig, axs = plt.subplots(nrows=1, figsize=FIGSIZE, constrained_layout=True)
+    fig.suptitle(title)
+
+    if method == "contourf":
+        plot = data[variable].plot.contourf(ax=axs, x="time", levels=30, cmap=cmocean.cm.deep_r,
+                                            add_colorbar=False, **kwargs)
+    else:
+        # pcolorfast draws the cells as one image instead of a polygon per
+        # cell, which is much faster for the regular grid of rays and gates
+        time = mpl.dates.date2num(data["time"].values)
+        plot = axs.pcolorfast(get_cell_edges(time), get_cell_edges(data["distance"].values),
+                              data[variable].values.T, cmap=cmocean.cm.deep_r, **kwargs)
+        axs.xaxis_date()
+    add_colorbar(axs, plot, label)
+
+    format_time_xticks(axs)
+    axs.set_xlabel("Time (UTC)")
+    axs.set_ylabel("Height (m)")
+
+    fig.savefig(tmp_path, dpi=DPI)
+    plt.close(fig)
+    return tmp_path
+
+
+def read_raw_file(handler_path_and_dtypes):
+    """Reads a raw file with its FileHandler.  Defined at module level so it
+    can be run in a worker process."""
+    handler, path, dtypes = handler_path_and_dtypes
+    return handler.read(path, dtypes=dtypes)
+
+
+class Pipeline(A2ePipeline):
     """Example tsdat ingest pipeline used to process lidar instrument data from
     a Halo Photonics Lidar as part of the AWAKEN project. 
 
     See https://tsdat.readthedocs.io/ for more on configuring tsdat pipelines.
     """
 
+    # Plots are time across and distance up, so they can't show more rays
+    # or range gates than they are pixels wide or tall
+    plot_sizes = dict(zip(["time", "distance"], get_pixel_sizes(FIGSIZE, DPI)))
+    # The plots only draw these variables at ranges below 5 km
+    plot_variables = [variable for _, _, variable, _, _ in PLOTS]
+    plot_ranges = {"distance": (None, 5000)}
+
+    # The Halo quality managers only use tsdat's checkers and handlers and
+    # the vectorized ones in pipelines.awa_halo_ingest.qc
+    use_quality_engine = True
+
+    def run(self, filepath: Union[str, List[str]]) -> None:
+        """-------------------------------------------------------------------
+        Runs the pipeline on the provided file(s).
+
+        If `rays_per_block` is set in the pipeline section of the config
+        file, the .hpl inputs are streamed through the pipeline in blocks of
+        that many rays.  Each block is standardized, customized and QC'd on
+        its own and then appended to the output file, so peak memory is
+        bounded by the block size rather than the file size.  Otherwise the
+        whole input is processed at once by the standard IngestPipeline.
+        Either way, if the config file has an `aggregation` section the
+        statistics over each interval of time (e.g. 10 minute means) are
+        saved as an additional datastream (see A2ePipeline.create_aggregator),
+        and if `daily_rollup` is set the output is added to the daily zarr
+        store of each day it covers (see A2ePipeline.create_rollup).
+
+        Args:
+        ---
+            filepath (Union[str, List[str]]): The path or list of paths to
+                                              the file(s) to run the pipeline
+                                              on.
+        -------------------------------------------------------------------"""
+        rays_per_block = self.config.pipeline_definition.dictionary.get('rays_per_block')
+        if not rays_per_block:
+            return super().run(filepath)
+
+        with self.extract_files(filepath) as file_paths:
+            datasets = self.stream_datasets(file_paths, int(rays_per_block))
+
+            # The outputs are named after the first block, which starts at
+            # the same time as the full dataset would
+            dataset = next(datasets)
+            with ExitStack() as stack:
+                appenders = {}
+                for file_extension in DatastreamStorage.output_file_extensions.values():
+                    filename = DSUtil.get_dataset_filename(dataset, file_extension=file_extension)
+                    tmp_path = stack.enter_context(self.storage.tmp.get_temp_filepath(filename))
+                    appenders[tmp_path] = self.create_appender(tmp_path)
+
+                # The aggregated output is computed a block at a time too,
+                # before writing the block moves its time units to encoding
+                aggregator = self.create_aggregator()
+                for dataset in chain([dataset], datasets):
+                    if aggregator is not None:
+                        with stage("aggregate"):
+                            aggregator.add(dataset)
+                    with stage("append"):
+                        for appender in appenders.values():
+                            appender.append(dataset)
+
+                with stage("save"):
+                    for tmp_path, appender in appenders.items():
+                        appender.close()
+                        self.storage.save(tmp_path)
+                if aggregator is not None:
+                    with stage("store_aggregate"):
+                        self.store_aggregate(aggregator)
+
+                # Roll up and plot from the default output type, like
+                # IngestPipeline
+                tmp_path = next(iter(appenders))
+                with (open_zarr(tmp_path) if is_zarr_store(tmp_path) else xr.open_dataset(tmp_path)) as dataset:
+                    rollup = self.create_rollup()
+                    if rollup is not None:
+                        with stage("rollup"):
+                            rollup.update(dataset)
+                    with stage("plots"):
+                        self.hook_generate_and_persist_plots(dataset)
+
+    def create_appender(self, filename: str) -> Union[NetCdfAppender, ZarrAppender]:
+        """-------------------------------------------------------------------
+        Create the appender that writes streamed blocks to an output file.
+
+        Args:
+        ---
+            filename (str): The path of the output file.
+
+        Returns:
+        ---
+            Union[NetCdfAppender, ZarrAppender]: The appender.
+        -------------------------------------------------------------------"""
+        if is_zarr_store(filename):
+            return ZarrAppender(filename, self.config)
+        if filename.endswith(".nc"):
+            return NetCdfAppender(filename, self.config)
+        raise ValueError(f"Cannot stream blocks to output file: {filename}")
+
+    def stream_datasets(self, file_paths: List[str], rays_per_block: int) -> Iterator[xr.Dataset]:
+        """-------------------------------------------------------------------
+        Reads each raw file a block of rays at a time and runs every block
+        through the same standardization, customization, QC and finalize
+        steps as IngestPipeline.run.  Raw files are persisted as they are
+        read, and each file is prefetched while the one before it is
+        processed.  The last ray of each block is passed to QC as the
+        previous dataset for the next one so checks that look at the
+        previous value see the same record as they would for the whole
+        file.
+
+        Args:
+        ---
+            file_paths (List[str]): The raw files to read, in time order.
+            rays_per_block (int):   The maximum number of rays per block.
+
+        Yields:
+        ---
+            xr.Dataset: The processed dataset for each block.
+        -------------------------------------------------------------------"""
+        quality_engine = QualityEngine(self.config)
+        previous_dataset = None
+        for i, file_path in enumerate(file_paths):
+            # Download the next file while this one is processed
+            self.prefetch(file_paths[i + 1:i + 2])
+            with stage("fetch"):
+                disposable_file = self.storage.tmp.fetch(file_path)
+            with disposable_file as tmp_path:
+                handler = FileHandler._get_handler(tmp_path)
+                raw_filename = None
+                blocks = handler.read_blocks(tmp_path, rays_per_block, dtypes=self.get_raw_dtypes())
+
+                while True:
+                    with stage("read"):
+                        raw_dataset = next(blocks, None)
+                    if raw_dataset is None:
+                        break
+
+                    if raw_filename is None:
+                        raw_filename = DSUtil.get_raw_filename(raw_dataset, tmp_path, self.config)
+                        with stage("persist"):
+                            self.storage.save(tmp_path, raw_filename)
+
+                    with stage("customize_raw"):
+                        raw_mapping = self.hook_customize_raw_datasets({raw_filename: raw_dataset})
+                    with stage("standardize"):
+                        dataset = self.standardize_dataset(raw_mapping)
+                    with stage("customize"):
+                        dataset = self.hook_customize_dataset(dataset, raw_mapping)
+
+                    with stage("qc"):
+                        if previous_dataset is None:
+                            previous_dataset = self.get_previous_dataset(dataset)
+
+                        # Keep the last ray as it was before QC replaced
+                        # failed values, which is what the checks see within
+                        # a block
+                        last_ray = dataset.isel(time=[-1])
+                        dataset = quality_engine.run(dataset, previous_dataset)
+
+                    # The output file grows along time, so chunks along time
+                    # are not limited by the length of the first block
+                    dataset.encoding["unlimited_dims"] = {"time"}
+                    with stage("finalize"):
+                        dataset = self.hook_finalize_dataset(dataset)
+
+                    previous_dataset = last_ray
+                    yield dataset
+
+    def prefetch(self, file_paths: List[str]):
+        """-------------------------------------------------------------------
+        Start downloading raw files that will be fetched later, if the
+        storage supports it (see pipelines.utils.aws_storage).
+
+        Args:
+        ---
+            file_paths (List[str]): The raw files.
+        -------------------------------------------------------------------"""
+        prefetch = getattr(self.storage, "prefetch", None)
+        if prefetch is not None:
+            prefetch(file_paths)
+
+    def get_raw_dtypes(self) -> Dict[str, np.dtype]:
+        """-------------------------------------------------------------------
+        Returns the data types the .hpl reader parses the raw variables to,
+        keyed by raw variable name.  If `raw_dtype` is set in the pipeline
+        section of the config file (e.g. `raw_dtype: float32`), variables
+        with a floating point `type` are parsed straight to it, so they
+        never exist as a full-size float64 array.  Otherwise they are
+        parsed to float64 at full precision.
+
+        Returns:
+        ---
+            Dict[str, np.dtype]: The data types keyed by raw variable name.
+        -------------------------------------------------------------------"""
+        raw_dtype = self.config.pipeline_definition.dictionary.get("raw_dtype")
+        if not raw_dtype:
+            return {}
+
+        dtypes = {}
+        for variable in self.config.dataset_definition.vars.values():
+            # Variables with a custom converter get the full parsed precision
+            if variable.has_input() and type(variable.input.converter) is DefaultConverter \
+                    and np.issubdtype(variable.get_data_type(), np.floating):
+                dtypes[variable.get_input_name()] = np.dtype(raw_dtype)
+        return dtypes
+
+    def read_and_persist_raw_files(self, file_paths: List[str]) -> Dict[str, xr.Dataset]:
+        """-------------------------------------------------------------------
+        Same as IngestPipeline.read_and_persist_raw_files, except that raw
+        variables are parsed to their configured data types and, when
+        several files are co-processed, files are downloaded at the same
+        time and parsed in parallel worker processes.  Each parsed dataset
+        is pickled back from its worker, which briefly takes twice its
+        memory, so a single file, or any number of files with one worker,
+        is parsed in this process instead.
+
+        Args:
+        ---
+            file_paths (List[str]): The paths to the raw files.
+
+        Returns:
+        ---
+            Dict[str, xr.Dataset]: The raw datasets keyed by their
+                                   standardized raw file names.
+        -------------------------------------------------------------------"""
+        if isinstance(file_paths, str):
+            file_paths = [file_paths]
+
+        raw_dataset_mapping = {}
+        with ExitStack() as stack:
+            with stage("fetch"):
+                self.prefetch(file_paths)
+                tmp_paths = [stack.enter_context(self.storage.tmp.fetch(file_path)) for file_path in file_paths]
+            handlers = [FileHandler._get_handler(tmp_path) for tmp_path in tmp_paths]
+
+            # Don't use files that no FileHandler is registered for
+            dtypes = self.get_raw_dtypes()
+            readable = []
+            for handler, tmp_path in zip(handlers, tmp_paths):
+                if handler:
+                    readable.append((handler, tmp_path, dtypes))
+                else:
+                    warnings.warn(f"Couldn't use extracted raw file: {tmp_path}")
+
+            with stage("parse"):
+                if len(readable) > 1 and get_max_workers() > 1:
+                    datasets = map_in_processes(read_raw_file, readable)
+                else:
+                    datasets = [read_raw_file(item) for item in readable]
+
+            with stage("persist"):
+                for (handler, tmp_path, dtypes), dataset in zip(readable, datasets):
+                    new_filename = DSUtil.get_raw_filename(dataset, tmp_path, self.config)
+                    raw_dataset_mapping[new_filename] = dataset
+                    self.storage.save(tmp_path, new_filename)
+
+        return raw_dataset_mapping
+
+    def reduce_raw_datasets(self, raw_mapping: Dict[str, xr.Dataset], definition) -> List[xr.Dataset]:
+        """-------------------------------------------------------------------
+        Reduces each raw dataset as in IngestPipeline, then concatenates
+        the hourly .hpl datasets along time with a single xr.concat so the
+        co-processed files do not have to be merged one at a time.  All of
+        the files must come from the same range gate configuration.
+
+        Args:
+        ---
+            raw_mapping (Dict[str, xr.Dataset]):    The raw dataset mapping.
+            definition (DatasetDefinition):         The dataset definition.
+
+        Returns:
+        ---
+            List[xr.Dataset]: The reduced datasets.
+        -------------------------------------------------------------------"""
+        reduced_datasets = super().reduce_raw_datasets(raw_mapping, definition)
+        if len(reduced_datasets) < 2:
+            return reduced_datasets
+
+        gate_configs = {(ds.dims["range_gate"], ds.attrs["Range gate length (m)"]) for ds in reduced_datasets}
+        if len(gate_configs) > 1:
+            raise ValueError(f"Cannot co-process .hpl files with different range gates: {gate_configs}")
+
+        reduced_datasets.sort(key=lambda ds: ds["time"].data[0])
+        dataset = xr.concat(reduced_datasets, dim="time", data_vars="minimal", coords="minimal", compat="override")
+        return [dataset]
+
     def hook_customize_dataset(self, dataset: xr.Dataset, raw_mapping: Dict[str, xr.Dataset]) -> xr.Dataset:
         """-------------------------------------------------------------------
         Hook to allow for user customizations to the standardized dataset such
@@ -39,7 +448,8 @@ class Pipeline(IngestPipeline):
             xr.Dataset: The customized dataset.
         -------------------------------------------------------------------"""
         
-        # Compress row of variables in input into variables dimensioned by time and height
+        # Compress row of variables in input into variables dimensioned by time and height.
+        # Co-processed .hpl files have already been concatenated into one dataset.
         for raw_filename, raw_dataset in raw_mapping.items():
             # convert range gate to distance and change coords
             if ".hpl" in raw_filename:
@@ -48,6 +458,31 @@ class Pipeline(IngestPipeline):
 
                 dataset["SNR"] = 10 * np.log10(dataset.intensity - 1)
 
+                # QC replaces failed values with the _FillValue, and without
+                # one the replacement would upcast SNR to float64
+                dataset["SNR"].attrs["_FillValue"] = np.nan
+                break
+
+        return dataset
+
+    def hook_finalize_dataset(self, dataset: xr.Dataset) -> xr.Dataset:
+        """-------------------------------------------------------------------
+        Hook to apply any final customizations to the dataset before it is
+        saved.  Sets the netCDF chunking, compression and packing of the
+        output variables from the `encoding` profile in the pipeline section
+        of the config file, if there is one.
+
+        Args:
+        ---
+            dataset (xr.Dataset): The dataset to finalize.
+
+        Returns:
+        ---
+            xr.Dataset: The finalized dataset to save.
+        -------------------------------------------------------------------"""
+        profile = self.config.pipeline_definition.dictionary.get("encoding")
+        if profile:
+            dataset = apply_encoding_profile(dataset, profile)
         return dataset
 
     def hook_generate_and_persist_plots(self, dataset: xr.Dataset) -> None:
@@ -56,111 +491,52 @@ class Pipeline(IngestPipeline):
         processing and QC have been applied and just before the dataset is
         saved to disk.
 
-        To save on filesystem space (which is limited when running on the
-        cloud via a lambda function), this method should only
-        write one plot to local storage at a time. An example of how this
-        could be done is below:
-
-        ```
-        filename = DSUtil.get_plot_filename(dataset, "sea_level", "png")
-        with self.storage._tmp.get_temp_filepath(filename) as tmp_path:
-            fig, ax = plt.subplots(figsize=(10,5))
-            ax.plot(dataset["time"].data, dataset["sea_level"].data)
-            fig.save(tmp_path)
-            storage.save(tmp_path)
-
-        filename = DSUtil.get_plot_filename(dataset, "qc_sea_level", "png")
-        with self.storage._tmp.get_temp_filepath(filename) as tmp_path:
-            fig, ax = plt.subplots(figsize=(10,5))
-            DSUtil.plot_qc(dataset, "sea_level", tmp_path)
-            storage.save(tmp_path)
-        ```
+        Plots the wind speed and SNR against distance and time.  The ranges
+        below 5 km are selected once and the plots are rendered in parallel
+        worker processes, and each plot is saved to storage as soon as it
+        is rendered, so only the finished plots are in local storage at
+        once.  The data is first reduced to the resolution of the plots by
+        averaging neighbouring rays and range gates, so the time to render
+        the plots doesn't grow with the number of rays.  Each point is
+        drawn as a pcolormesh rasterized into a single image.  Set
+        `plot_method: contourf` in the pipeline section of the config file
+        to draw filled contour plots instead, which are much slower to
+        render.
 
         Args:
         ---
             dataset (xr.Dataset):   The xarray dataset with customizations and
                                     QC applied.
         -------------------------------------------------------------------"""
-
-        def format_time_xticks(ax, start=4, stop=21, step=4, date_format="%H-%M"):
-            ax.xaxis.set_major_locator(mpl.dates.HourLocator(byhour=range(start, stop, step)))
-            ax.xaxis.set_major_formatter(mpl.dates.DateFormatter(date_format))
-            plt.setp(ax.xaxis.get_majorticklabels(), rotation=0, ha='center')
-
-        def add_colorbar(ax, plot, label):
-            cb = plt.colorbar(plot, ax=ax, pad=0.01)
-            cb.ax.set_ylabel(label, fontsize=12)
-            cb.outline.set_linewidth(1)
-            cb.ax.tick_params(size=0)
-            cb.ax.minorticks_off()
-            return cb
-
-        ds = dataset
-        date = pd.to_datetime(ds.time.data[0]).strftime('%d-%b-%Y')
-
-        # Colormaps to use
-        wind_cmap = cmocean.cm.deep_r
-        avail_cmap = cmocean.cm.amp_r
-
-        filename = DSUtil.get_plot_filename(dataset, "wind_speed_v_dist_time", "png")
-        with self.storage._tmp.get_temp_filepath(filename) as tmp_path:
-
-            # Calculations for contour plots
-            levels = 30
-
-            # Create figure and axes objects
-            fig, axs = plt.subplots(nrows=1, figsize=(14, 8), constrained_layout=True)
-            fig.suptitle(f"Wind Speed at {ds.attrs['location_meaning']} on {date}")
-
-            # Make top subplot -- contours and quiver plots for wind speed and direction
-            los_wind_speed = ds.doppler.where(ds.distance < 5000,drop=True)
-            csf = los_wind_speed.plot.contourf(ax=axs, x="time", levels=levels, cmap=wind_cmap, add_colorbar=False, vmin=-5, vmax=5)
-            add_colorbar(axs, csf, r"Wind Speed (ms$^{-1}$)")
-
-            # # Make bottom subplot -- heatmap for data availability
-            # da = ds.data_availability.plot(ax=axs[1], x="time", cmap=avail_cmap, add_colorbar=False, vmin=0, vmax=100)
-            # add_colorbar(axs[1], da, "Availability (%)")
-
-            # Set the labels and ticks
-            # for i in range(1):
-            format_time_xticks(axs)
-            axs.set_xlabel("Time (UTC)")
-            axs.set_ylabel("Height (m)")
-
-            # Save the figure
-            fig.savefig(tmp_path, dpi=100)
-            self.storage.save(tmp_path)
-            plt.close()
-
-        filename = DSUtil.get_plot_filename(dataset, "SNR_v_dist_time", "png")
-        with self.storage._tmp.get_temp_filepath(filename) as tmp_path:
-
-            # Calculations for contour plots
-            levels = 30
-
-            # Create figure and axes objects
-            fig, axs = plt.subplots(nrows=1, figsize=(14, 8), constrained_layout=True)
-            fig.suptitle(f"Signal to Noise Ratio at {ds.attrs['location_meaning']} on {date}")
-
-            # Make top subplot -- contours and quiver plots for wind speed and direction
-            SNR_v_dist = ds.SNR.where(ds.distance < 5000,drop=True)
-            csf = SNR_v_dist.plot.contourf(ax=axs, x="time", levels=levels, cmap=wind_cmap, add_colorbar=False)
-            add_colorbar(axs, csf, "SNR (dB)")
-
-            # # Make bottom subplot -- heatmap for data availability
-            # da = ds.data_availability.plot(ax=axs[1], x="time", cmap=avail_cmap, add_colorbar=False, vmin=0, vmax=100)
-            # add_colorbar(axs[1], da, "Availability (%)")
-
-            # Set the labels and ticks
-            # for i in range(1):
-            format_time_xticks(axs)
-            axs.set_xlabel("Time (UTC)")
-            axs.set_ylabel("Height (m)")
-
-            # Save the figure
-            fig.savefig(tmp_path, dpi=100)
-            self.storage.save(tmp_path)
-            plt.close()
-
-
-        return
+        global shared_plot_data
+
+        method = self.config.pipeline_definition.dictionary.get("plot_method", "pcolormesh")
+        date = pd.to_datetime(dataset.time.data[0]).strftime('%d-%b-%Y')
+        location = dataset.attrs['location_meaning']
+
+        # Select the near ranges once for all of the plots, reading only the
+        # chunks that are plotted when the dataset is lazily loaded, and
+        # reduce them to the resolution of the plots.  Both do nothing if
+        # run_plots already has.
+        data = downsample(self.select_plot_data(dataset), self.plot_sizes).load()
+
+        with ExitStack() as stack:
+            plots = []
+            for plot_name, title, variable, label, kwargs in PLOTS:
+                filename = DSUtil.get_plot_filename(dataset, plot_name, "png")
+                tmp_path = stack.enter_context(self.storage.tmp.get_temp_filepath(filename))
+                plots.append((tmp_path, f"{title} at {location} on {date}", variable, label, kwargs, method))
+
+            # Forked workers share the selected data and the plotting modules
+            # with this process, so the data is only sent to workers that are
+            # not forked
+            import_plotting()
+            shared_plot_data = data
+            if mp.get_start_method() != "fork":
+                plots = [plot + (data,) for plot in plots]
+
+            try:
+                for _, tmp_path in iterate_in_processes(render_plot, plots):
+                    self.storage.save(tmp_path)
+            finally:
+                shared_plot_data = None
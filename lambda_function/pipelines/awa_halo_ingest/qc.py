@@ -1,16 +1,27 @@
 from typing import Optional
 
 import numpy as np
-from tsdat.qc import QualityChecker, QualityHandler
 
+from pipelines.utils.log_helper import logger
+from pipelines.utils.qc import VectorizedChecker, VectorizedHandler
 
-class DummyQCTest(QualityChecker):
+
+class CheckLowSNR(VectorizedChecker):
     """-------------------------------------------------------------------
-    Class containing placeholder code to perform a single QC test on a
-    Dataset variable.
+    Checks for values measured when the lidar's signal to noise ratio was
+    too low for them to be reliable, e.g. doppler wind speeds from beyond
+    the range of the lidar.  Reads the SNR variable, so the QC engine runs
+    it in the order of the config file.
+
+    Parameters specified in the pipeline config file:
+
+        parameters:
+          snr_variable: SNR   # The SNR variable in dB. Defaults to SNR.
+          min_snr: -20        # The lowest reliable SNR. Defaults to -20.
 
     See https://tsdat.readthedocs.io/ for more QC examples.
     -------------------------------------------------------------------"""
+    local = False
 
     def run(self, variable_name: str) -> Optional[np.ndarray]:
         """-------------------------------------------------------------------
@@ -28,39 +39,46 @@ class DummyQCTest(QualityChecker):
             results of the test.  True means the test failed.  False means
             it succeeded.
 
-            Note that we are using an np.ndarray instead of an xr.DataArray
-            because the DataArray contains coordinate indexes which can
-            sometimes get out of sync when performing np arithmectic vector
-            operations.  So it's easier to just use numpy arrays.
-
-            If the test was skipped for some reason (i.e., it was not
-            relevant given the current attributes defined for this dataset),
-            then the run method should return None.
+            The test is skipped if the dataset has no SNR variable with the
+            dimensions of the variable, in which case None is returned.
         -------------------------------------------------------------------"""
-
-        # Just return an array of all False of same shape as the variable
-        results_array = np.full_like(self.ds[variable_name].data, False, dtype=bool)
-
+        snr_variable = self.params.get("snr_variable", "SNR")
+        min_snr = self.params.get("min_snr", -20)
+        if snr_variable not in self.ds or self.ds[snr_variable].dims != self.ds[variable_name].dims:
+            return None
+
+        # SNR is NaN where the intensity is too low for a ratio, so values
+        # fail unless SNR is at least min_snr
+        results_array = np.greater_equal(self.ds[snr_variable].values, min_snr)
+        np.logical_not(results_array, out=results_array)
         return results_array
 
 
-class DummyErrorHandler(QualityHandler):
+class LogFailedValues(VectorizedHandler):
     """-------------------------------------------------------------------
-    Class containing placeholder code for a custom error handler.
+    Logs how many values of a variable failed a quality check, so a rise
+    in failures shows up in the logs of the pipeline runs.
+
+    Parameters specified in the pipeline config file:
+
+        parameters:
+          min_percent: 0  # Only log if more than this percentage of the
+                          # values failed. Defaults to 0.
 
     See https://tsdat.readthedocs.io/ for more QC examples.
     -------------------------------------------------------------------"""
 
     def run(self, variable_name: str, results_array: np.ndarray):
         """-------------------------------------------------------------------
-        Perform a follow-on action if a qc test fails.  This can be used to
-        correct data if needed (such as replacing a bad value with missing value,
-        emailing a contact persion, adding additional metadata, or raising an
-        exception if the failure constitutes a critical error).
+        Log the number of values of the variable that failed the check.
 
         Args:
-            variable_name (str): Name of the variable that failed
+            variable_name (str): Name of the variable that was checked
             results_array (np.ndarray)  : An array of True/False values for
             each data value of the variable.  True means the test failed.
         -------------------------------------------------------------------"""
-        print(f"QC test failed for variable {variable_name}")
+        failed = np.count_nonzero(results_array)
+        percent = 100 * failed / max(results_array.size, 1)
+        if failed and percent > self.params.get("min_percent", 0):
+            logger.warning(f"QC test {self.quality_manager.name} failed for {failed} of {results_array.size} "
+                           f"values ({percent:.1f}%) of variable {variable_name}")
@@ -0,0 +1,291 @@
+"""-------------------------------------------------------------------
+Backfill: run the pipelines over a directory tree or a manifest of raw
+files on the local filesystem, e.g. to reprocess months of data after a
+config change.
+
+Files are matched to pipelines and locations with the same patterns as
+run_pipeline, and each file is run as its own pipeline invocation, as it
+would be when it arrived in S3.  Files are processed across all cores
+with a process pool.  Every finished file is appended to a checkpoint
+file, so an interrupted backfill can be rerun with the same arguments
+and will skip the files that already succeeded.  Files whose names match
+more than one route or location are logged, recorded in the checkpoint
+file and the summary as skipped, and not run.  A throughput summary is
+printed and written as JSON at the end.
+
+Usage:
+    python -m pipelines.backfill /data/raw --root-dir /data/storage
+    python -m pipelines.backfill --manifest files.txt --root-dir /data/storage
+
+Run from the lambda_function folder.  Outputs are written with
+tsdat.io.FilesystemStorage under --root-dir, and input files are never
+removed.
+-------------------------------------------------------------------"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import as_completed
+from typing import Dict, Iterable, List, Tuple
+
+from pipelines.runner import clear_pipeline_cache, router, run_pipeline
+from pipelines.utils.log_helper import logger
+from pipelines.utils.parallel import create_process_pool, get_max_workers
+from pipelines.utils.router import AmbiguousRouteError
+
+# Suffixes of sidecar files written next to raw files, e.g. the .hpl ray
+# index, which must not be run as raw files themselves
+SIDECAR_SUFFIXES = ['.idx.npz']
+
+
+def is_backfill_candidate(filename: str) -> bool:
+    name = os.path.basename(filename)
+    return not name.startswith('.') and not any(name.endswith(suffix) for suffix in SIDECAR_SUFFIXES)
+
+
+def walk_files(root: str) -> Iterable[str]:
+    """-------------------------------------------------------------------
+    Yields the files under a directory in sorted order, skipping hidden
+    files and folders and sidecar files.
+
+    Args:
+        root (str): The directory to walk.
+
+    Yields:
+        str: The path of each file.
+    -------------------------------------------------------------------"""
+    for dir_path, dir_names, file_names in os.walk(root):
+        dir_names[:] = sorted(name for name in dir_names if not name.startswith('.'))
+        for file_name in sorted(file_names):
+            if is_backfill_candidate(file_name):
+                yield os.path.join(dir_path, file_name)
+
+
+def read_manifest(manifest: str) -> List[str]:
+    """-------------------------------------------------------------------
+    Reads a manifest with one file path per line.  Relative paths are
+    relative to the manifest, and blank lines and lines starting with #
+    are ignored.
+
+    Args:
+        manifest (str): The path to the manifest.
+
+    Returns:
+        List[str]: The file paths.
+    -------------------------------------------------------------------"""
+    manifest_dir = os.path.dirname(os.path.abspath(manifest))
+    with open(manifest, 'r') as f:
+        lines = [line.strip() for line in f]
+    return [os.path.join(manifest_dir, line) for line in lines if line and not line.startswith('#')]
+
+
+def find_pipeline_files(files: Iterable[str], include_plots: bool = False) -> Tuple[List[str], List[str]]:
+    """-------------------------------------------------------------------
+    Finds the files that a pipeline is registered for.  Files with
+    ambiguous names are logged and returned separately, like
+    runner.group_input_files skips them, so one odd name doesn't stop
+    the whole backfill.
+
+    Args:
+        files (Iterable[str]):          The file paths.
+        include_plots (bool, optional): Also keep processed files to plot.
+                                        Defaults to False.
+
+    Returns:
+        Tuple[List[str], List[str]]:    The files to run and the files
+                                        skipped because their names are
+                                        ambiguous.
+    -------------------------------------------------------------------"""
+    pipeline_files, ambiguous = [], []
+    for filename in files:
+        try:
+            pipeline_dir, method_to_call, location = router.route(os.path.basename(filename))
+        except AmbiguousRouteError as e:
+            logger.error(f'Skipping file: {filename} since {e}')
+            ambiguous.append(filename)
+            continue
+
+        if pipeline_dir and location and (method_to_call == 'run' or include_plots):
+            pipeline_files.append(filename)
+    return pipeline_files, ambiguous
+
+
+def read_checkpoint(checkpoint: str) -> Dict[str, Dict]:
+    """-------------------------------------------------------------------
+    Reads the result of each file recorded in a checkpoint file.  Later
+    records for a file replace earlier ones.
+
+    Args:
+        checkpoint (str):   The path to the checkpoint file.
+
+    Returns:
+        Dict[str, Dict]: The latest record of each file keyed by path.
+    -------------------------------------------------------------------"""
+    records = {}
+    if os.path.isfile(checkpoint):
+        with open(checkpoint, 'r') as f:
+            for line in f:
+                # The last line is incomplete if the backfill was killed
+                # while writing it
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                records[record['file']] = record
+    return records
+
+
+def backfill_file(filename: str, storage_config: str = None) -> Dict:
+    """-------------------------------------------------------------------
+    Runs the pipeline on one file.  Defined at module level so it can be
+    run in a worker process.
+
+    Args:
+        filename (str):                 The file to run.
+        storage_config (str, optional): The storage config file. Defaults
+                                        to run_pipeline's default.
+
+    Returns:
+        Dict: The checkpoint record of the file.
+    -------------------------------------------------------------------"""
+    start = time.perf_counter()
+    try:
+        succeeded = run_pipeline([filename], storage_config)
+        status = 'success' if succeeded else 'failed'
+    except Exception:
+        logger.exception(f'Failed to run pipeline on {filename}')
+        status = 'failed'
+
+    return {
+        'file': filename,
+        'status': status,
+        'bytes': os.path.getsize(filename),
+        'seconds': round(time.perf_counter() - start, 3),
+    }
+
+
+def backfill(files: List[str], checkpoint: str, storage_config: str = None, max_workers: int = None,
+             skipped: List[str] = None) -> Dict:
+    """-------------------------------------------------------------------
+    Runs the pipelines on the files that have not already succeeded
+    according to the checkpoint file, appending the result of each file to
+    the checkpoint file as it finishes.
+
+    Args:
+        files (List[str]):              The files to run.
+        checkpoint (str):               The path to the checkpoint file.
+        storage_config (str, optional): The storage config file. Defaults
+                                        to run_pipeline's default.
+        max_workers (int, optional):    The maximum number of worker
+                                        processes. Defaults to
+                                        get_max_workers().
+        skipped (List[str], optional):  Files that were not run because
+                                        their names are ambiguous, which
+                                        are recorded as skipped. Defaults
+                                        to None.
+
+    Returns:
+        Dict: The throughput summary.
+    -------------------------------------------------------------------"""
+    done = {filename for filename, record in read_checkpoint(checkpoint).items() if record['status'] == 'success'}
+    pending = [filename for filename in files if filename not in done]
+    max_workers = min(max_workers or get_max_workers(), max(len(pending), 1))
+    logger.info(f'Backfilling {len(pending)} files with {max_workers} workers, '
+                f'{len(files) - len(pending)} already done.')
+
+    records = []
+    start = time.perf_counter()
+    with open(checkpoint, 'a') as f:
+
+        def record_result(record: Dict):
+            records.append(record)
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+
+        for filename in skipped or []:
+            f.write(json.dumps({'file': filename, 'status': 'skipped', 'reason': 'ambiguous route'}) + '\n')
+        f.flush()
+
+        executor = create_process_pool(max_workers, clear_pipeline_cache) if max_workers > 1 else None
+        if executor is None:
+            for filename in pending:
+                record_result(backfill_file(filename, storage_config))
+        else:
+            with executor:
+                futures = [executor.submit(backfill_file, filename, storage_config) for filename in pending]
+                for future in as_completed(futures):
+                    record_result(future.result())
+
+    elapsed = time.perf_counter() - start
+    num_bytes = sum(record['bytes'] for record in records)
+    failures = sorted(record['file'] for record in records if record['status'] == 'failed')
+    return {
+        'files': len(records),
+        'succeeded': len(records) - len(failures),
+        'failed': len(failures),
+        'already_done': len(files) - len(pending),
+        'seconds': round(elapsed, 3),
+        'files_per_second': round(len(records) / elapsed, 3) if elapsed else None,
+        'mb_per_second': round(num_bytes / 2 ** 20 / elapsed, 3) if elapsed else None,
+        'workers': max_workers,
+        'failures': failures,
+        'skipped': sorted(skipped or []),
+    }
+
+
+def main(args: List[str] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', nargs='?', help='The directory of raw files to backfill.')
+    parser.add_argument('--manifest', help='A file listing the raw files to backfill, one per line.')
+    parser.add_argument('--root-dir', default=os.environ.get('ROOT_DIR', 'storage'),
+                        help='The root folder of the output storage.')
+    parser.add_argument('--storage-config', help='The storage config file. Defaults to the pipelines\' config.')
+    parser.add_argument('--workers', type=int, help='The number of worker processes. Defaults to the CPU count.')
+    parser.add_argument('--checkpoint', help='The checkpoint file. Defaults to backfill_checkpoint.jsonl in '
+                                             'the root folder.')
+    parser.add_argument('--summary', help='Where to write the JSON summary. Defaults to backfill_summary.json in '
+                                          'the root folder.')
+    parser.add_argument('--include-plots', action='store_true',
+                        help='Also re-run the plots of processed files found in the tree.')
+    parser.add_argument('--log-level', default='WARNING', help='The logging level of the pipelines.')
+    args = parser.parse_args(args)
+
+    if bool(args.path) == bool(args.manifest):
+        parser.error('Provide either a directory or --manifest.')
+
+    logger.setLevel(args.log_level.upper())
+    if not logger.handlers:
+        logger.addHandler(logging.StreamHandler(sys.stderr))
+
+    # Store outputs on the local filesystem and always keep the inputs
+    root_dir = os.path.abspath(args.root_dir)
+    os.makedirs(root_dir, exist_ok=True)
+    os.environ['STORAGE_CLASSNAME'] = 'tsdat.io.FilesystemStorage'
+    os.environ['RETAIN_INPUT_FILES'] = 'True'
+    os.environ['ROOT_DIR'] = root_dir
+
+    files = read_manifest(args.manifest) if args.manifest else walk_files(args.path)
+    files, skipped = find_pipeline_files((os.path.abspath(filename) for filename in files), args.include_plots)
+
+    checkpoint = args.checkpoint or os.path.join(root_dir, 'backfill_checkpoint.jsonl')
+    summary = backfill(files, checkpoint, args.storage_config, args.workers, skipped)
+
+    summary_file = args.summary or os.path.join(root_dir, 'backfill_summary.json')
+    with open(summary_file, 'w') as f:
+        json.dump(summary, f, indent=2)
+
+    print(f"{summary['files']} files in {summary['seconds']} s ({summary['files_per_second']} files/s, "
+          f"{summary['mb_per_second']} MB/s), {summary['failed']} failed, {summary['already_done']} already done, "
+          f"{len(summary['skipped'])} skipped")
+    for filename in summary['failures']:
+        print(f'FAILED {filename}')
+    for filename in summary['skipped']:
+        print(f'SKIPPED {filename}')
+
+    return 1 if summary['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
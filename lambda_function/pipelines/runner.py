@@ -1,39 +1,77 @@
 
+from __future__ import annotations
+
+import functools
 import importlib
 import traceback
 
 import json
 import os
 import re
+import shutil
 import sys
+import time
+from collections import OrderedDict
+from pipelines.utils.instrumentation import Instrumentation, instrument, stage
+from pipelines.utils.ledger import get_ledger, get_ledger_key
 from pipelines.utils.log_helper import logger
-from typing import List, Union
+from pipelines.utils.parallel import get_max_workers, map_in_processes
+from pipelines.utils.router import AmbiguousRouteError, FileRouter, Route
+from pipelines.utils.s3 import is_s3_path
+from pipelines.utils.transfers import transfers
+from typing import TYPE_CHECKING, Any, Dict, List, Tuple, Union
 
-from tsdat.io import S3Path
+# tsdat takes seconds to import, so it is imported when a pipeline is
+# first built rather than on every cold start
+if TYPE_CHECKING:
+    from tsdat.io import S3Path
 
-pipeline_map = {
-    'a2e_tracker_ingest': re.compile('tracker\\..*\\.tar\\.gz'),
-    'a2e_waves_ingest': re.compile('.*waves\\.csv'),
-    'a2e_imu_ingest':   re.compile('.*\\.imu\\.bin'),
-    'a2e_lidar_ingest': re.compile('.*\\.sta\\.7z'),
-    'a2e_buoy_ingest': re.compile('buoy\\..*\\.(?:csv|zip|tar|tar\\.gz)'),
-    'awa_halo_ingest': re.compile('.*\\.hpl'),
-}
+# Routes from file names to pipelines.  Patterns must match the whole file
+# name.  When more than one route matches, the highest priority wins, and a
+# tie is an error.  Raw files have priority over processed files to plot,
+# and buoy waves files (e.g. buoy.z05.00.20201201.000000.waves.csv) also
+# match the buoy pattern, so they are given a higher priority.
+routes = [
+    # Raw files to ingest
+    Route('a2e_tracker_ingest', 'run', r'tracker\..*\.tar\.gz', priority=1),
+    Route('a2e_waves_ingest',   'run', r'.*waves\.csv', priority=2),
+    Route('a2e_imu_ingest',     'run', r'.*\.imu\.bin', priority=1),
+    Route('a2e_lidar_ingest',   'run', r'.*\.sta\.7z', priority=1),
+    Route('a2e_buoy_ingest',    'run', r'buoy\..*\.(?:csv|zip|tar|tar\.gz)', priority=1),
+    Route('awa_halo_ingest',    'run', r'.*\.hpl', priority=1),
+    Route('awa_halo_ingest',    'run', r'.*\.hpl\.(?:gz|zip|tar|tar\.gz|tgz|tar\.bz2|tar\.xz)', priority=1),
 
-plotting_map = {
-    'a2e_buoy_ingest':  re.compile(r'buoy\.z\d{2}\.a0\.\d{8}\.\d{6}\.10m\.a2e\.nc'),
-    'a2e_waves_ingest': re.compile(r'buoy\.z\d{2}\.a0\.\d{8}\.\d{6}\.waves\.a2e\.nc'),
-    'a2e_imu_ingest':   re.compile(r'buoy\.z\d{2}\.a0\.\d{8}\.\d{6}\.imu\.a2e\.nc'),
-    'a2e_lidar_ingest': re.compile(r'lidar\.z\d{2}\.a0\.\d{8}\.\d{6}\.sta\.a2e\.nc'),
-    'awa_halo_ingest': re.compile(r'NWTC\.test_01-lidar-10min\.a1\.\d{8}\.\d{6}\.nc'),
-}
+    # Processed files to plot
+    Route('a2e_buoy_ingest',  'run_plots', r'buoy\.z\d{2}\.a0\.\d{8}\.\d{6}\.10m\.a2e\.nc'),
+    Route('a2e_waves_ingest', 'run_plots', r'buoy\.z\d{2}\.a0\.\d{8}\.\d{6}\.waves\.a2e\.nc'),
+    Route('a2e_imu_ingest',   'run_plots', r'buoy\.z\d{2}\.a0\.\d{8}\.\d{6}\.imu\.a2e\.nc'),
+    Route('a2e_lidar_ingest', 'run_plots', r'lidar\.z\d{2}\.a0\.\d{8}\.\d{6}\.sta\.a2e\.nc'),
+    Route('awa_halo_ingest',  'run_plots', r'NWTC\.test_01-lidar-10min\.a1\.\d{8}\.\d{6}\.(?:nc|zarr\.zip)'),
+]
 
 location_map = {
-    'humboldt': re.compile('.*z05.*'),
-    'morro'   : re.compile('.*z06.*'),
-    'nwtc'    : re.compile('.*nwtc.*')
+    'humboldt': r'.*z05.*',
+    'morro'   : r'.*z06.*',
+    'nwtc'    : r'.*nwtc.*',
 }
 
+router = FileRouter(routes, location_map)
+
+# Files routed to the same pipeline and location are only co-processed if
+# they also have the same co-processing key: the part of the file name
+# before its date and the date, e.g. ('Stare_142_', '20210510') for
+# Stare_142_20210510_00.hpl.  A batch with files from several days or
+# datastreams then gives one output for each.  Names without a date all
+# have the same key.
+coprocess_pattern = re.compile(r'(.*?)(?<!\d)(\d{8})(?!\d)')
+
+# Environment variables that are substituted into the storage config file
+storage_env_vars = ['STORAGE_CLASSNAME', 'RETAIN_INPUT_FILES', 'ROOT_DIR', 'STORAGE_BUCKET']
+
+# Pipelines built by earlier calls in this process, e.g. earlier invocations
+# of a warm Lambda container, keyed by get_pipeline_key()
+pipeline_cache = {}
+
 
 def instantiate_pipeline(pipeline_dir, pipeline_config, storage_config):
     # Dynamically instantiate the pipeline class from the designated folder
@@ -44,7 +82,76 @@ def instantiate_pipeline(pipeline_dir, pipeline_config, storage_config):
     return instance
 
 
-def get_log_message(pipeline_state, pipeline_name, location, input_files, exception=False):
+def get_pipeline_key(pipeline_dir, location, pipeline_config, storage_config):
+    # A pipeline is rebuilt when either config file or the environment
+    # variables used in the storage config change
+    return (
+        pipeline_dir,
+        location,
+        os.stat(pipeline_config).st_mtime_ns,
+        os.stat(storage_config).st_mtime_ns,
+        tuple(os.environ.get(name) for name in storage_env_vars),
+    )
+
+
+def get_pipeline(pipeline_dir, location, pipeline_config, storage_config):
+    """-------------------------------------------------------------------
+    Get the pipeline for a pipeline folder and location, reusing the one
+    built by an earlier call in this process if its config files and
+    storage environment variables have not changed since.  Reused
+    pipelines skip importing the pipeline module, parsing the config files
+    and registering the file handlers.
+
+    Args:
+        pipeline_dir (str):     The name of the pipeline folder.
+        location (str):         The location.
+        pipeline_config (str):  The path to the pipeline config file.
+        storage_config (str):   The path to the storage config file.
+
+    Returns:
+        Pipeline: The pipeline.
+    -------------------------------------------------------------------"""
+    start = time.perf_counter()
+    key = get_pipeline_key(pipeline_dir, location, pipeline_config, storage_config)
+    pipeline = pipeline_cache.get(key)
+
+    if pipeline is None:
+        # Drop pipelines built from older config files or environments
+        for stale_key in [stale_key for stale_key in pipeline_cache if stale_key[:2] == key[:2]]:
+            del pipeline_cache[stale_key]
+
+        pipeline = instantiate_pipeline(pipeline_dir, pipeline_config, storage_config)
+        pipeline_cache[key] = pipeline
+        logger.info(f'Cold start: built {pipeline_dir} pipeline for {location} in {time.perf_counter() - start:.3f} s')
+
+    else:
+        logger.info(f'Warm start: reused {pipeline_dir} pipeline for {location} in {time.perf_counter() - start:.3f} s')
+
+    return pipeline
+
+
+def reset_pipeline(pipeline):
+    """-------------------------------------------------------------------
+    Reset the per-run state of a pipeline so it can be reused for the next
+    run.  Waits for any uploads a failed run left running, and removes any
+    temporary files the run left in the storage's local temp folder, which
+    would otherwise pile up in a warm Lambda container's limited /tmp
+    space.
+
+    Args:
+        pipeline (Pipeline):    The pipeline to reset.
+    -------------------------------------------------------------------"""
+    try:
+        transfers.wait()
+    except Exception as e:
+        logger.warning(f'Failed to upload a file of a failed run: {e}')
+
+    temp_folder = pipeline.storage.tmp.local_temp_folder
+    shutil.rmtree(temp_folder, ignore_errors=True)
+    os.makedirs(temp_folder, exist_ok=True)
+
+
+def get_log_message(pipeline_state, pipeline_name, location, input_files, exception=False, metrics=None):
 
     log_msg = {
         "Pipeline_Name": pipeline_name,
@@ -53,6 +160,9 @@ def get_log_message(pipeline_state, pipeline_name, location, input_files, except
         "Input_Files": input_files
     }
 
+    if metrics is not None:
+        log_msg["Metrics"] = metrics
+
     if exception:
         exception_type, exception_value, exception_traceback = sys.exc_info()
         traceback_string = traceback.format_exception(exception_type, exception_value, exception_traceback)
@@ -64,7 +174,195 @@ def get_log_message(pipeline_state, pipeline_name, location, input_files, except
 
 
 
-def run_pipeline(input_files: Union[List[S3Path], List[str]] = []):
+def log_metrics(instrumentation: Instrumentation, succeeded: bool, pipeline_name, location, input_files):
+    """-------------------------------------------------------------------
+    Log the wall time, CPU time and memory of each stage of a pipeline run
+    as one JSON message.  If the TRACE_DIR environment variable is set,
+    the stages are also written there as a Chrome trace file.
+
+    Args:
+        instrumentation (Instrumentation):  The instrumentation of the run.
+        succeeded (bool):                   Whether the run succeeded.
+        pipeline_name (str):                The pipeline folder.
+        location (str):                     The location.
+        input_files (List[Union[S3Path, str]]): The input files of the run.
+    -------------------------------------------------------------------"""
+    metrics = instrumentation.get_record()
+    metrics['Succeeded'] = succeeded
+    logger.info(get_log_message('Metrics', pipeline_name, location, input_files, metrics=metrics))
+
+    trace_dir = os.environ.get('TRACE_DIR')
+    if trace_dir:
+        os.makedirs(trace_dir, exist_ok=True)
+        trace_file = os.path.join(trace_dir, f'{pipeline_name}.{location}.{time.time_ns()}.{os.getpid()}.trace.json')
+        instrumentation.write_chrome_trace(trace_file)
+
+
+def get_query_file(file_path: Union[S3Path, str]) -> str:
+    # We must use the python equivalent toString() method since the
+    # input file could be provided as an S3Path object or a string file path
+    return os.path.basename(file_path.__str__())
+
+
+def get_route(query_file: str) -> Tuple[str, str, str]:
+    """-------------------------------------------------------------------
+    Look up the pipeline, the pipeline method to call and the location
+    for a file name.
+
+    Args:
+        query_file (str):   The name of the file.
+
+    Returns:
+        Tuple[str, str, str]:   The pipeline folder, 'run' or 'run_plots',
+                                and the location.  The pipeline or the
+                                location is None if no pattern matches.
+
+    Raises:
+        AmbiguousRouteError:    If the routes or locations are ambiguous
+                                for the file name.
+    -------------------------------------------------------------------"""
+    return router.route(query_file)
+
+
+def is_routed(query_file: str) -> bool:
+    """-------------------------------------------------------------------
+    Check if a file name may be routed to a pipeline, so files that no
+    pipeline is registered for can be skipped before tsdat is imported.
+    Ambiguous names count as routed, so they are logged as errors when the
+    files are grouped.
+
+    Args:
+        query_file (str):   The name of the file.
+
+    Returns:
+        bool: False if no pipeline or location matches the file name.
+    -------------------------------------------------------------------"""
+    try:
+        pipeline_dir, _, location = get_route(query_file)
+    except AmbiguousRouteError:
+        return True
+    return pipeline_dir is not None and location is not None
+
+
+def get_coprocess_key(query_file: str) -> Tuple[str, ...]:
+    """-------------------------------------------------------------------
+    Get the key that files routed to the same pipeline and location must
+    share to be co-processed (see coprocess_pattern).
+
+    Args:
+        query_file (str):   The name of the file.
+
+    Returns:
+        Tuple[str, ...]:    The part of the name before its date and the
+                            date, or () if the name has no date.
+    -------------------------------------------------------------------"""
+    match = coprocess_pattern.search(query_file)
+    return match.groups() if match else ()
+
+
+def group_input_files(input_files: List[Union[S3Path, str]]) -> Dict[Tuple[str, str, str, Tuple[str, ...]],
+                                                                     List[Union[S3Path, str]]]:
+    """-------------------------------------------------------------------
+    Group files by the pipeline, pipeline method and location they are
+    routed to and by their co-processing key.  The files in each group are
+    co-processed in one pipeline invocation.  Files that no pipeline is
+    registered for are logged and left out.
+
+    Args:
+        input_files (List[Union[S3Path, str]]): The files to group.
+
+    Returns:
+        Dict[Tuple[str, str, str, Tuple[str, ...]], List[Union[S3Path, str]]]:
+            The files keyed by (pipeline folder, method, location,
+            co-processing key), in the order each group was first seen.
+    -------------------------------------------------------------------"""
+    groups = OrderedDict()
+    for input_file in input_files:
+        query_file = get_query_file(input_file)
+        try:
+            pipeline_dir, method_to_call, location = get_route(query_file)
+        except AmbiguousRouteError as e:
+            logger.error(f'Skipping file: {input_file} since {e}')
+            continue
+
+        if location is None or pipeline_dir is None:
+            logger.info(f'Skipping file: {input_file} since no pipeline is registered for file named: "{query_file}".')
+        else:
+            key = (pipeline_dir, method_to_call, location, get_coprocess_key(query_file))
+            groups.setdefault(key, []).append(input_file)
+
+    return groups
+
+
+def pack_input_file(input_file: Union[S3Path, str]) -> Union[Tuple, str]:
+    # S3Path can't be pickled, so it is sent to worker processes as a tuple
+    if is_s3_path(input_file):
+        return (input_file.bucket_name, input_file.bucket_path, input_file.region_name,
+                getattr(input_file, 'etag', None))
+    return input_file
+
+
+def unpack_input_file(input_file: Union[Tuple, str]) -> Union[S3Path, str]:
+    if isinstance(input_file, tuple):
+        from tsdat.io import S3Path
+        s3_path = S3Path(*input_file[:3])
+        if input_file[3] is not None:
+            s3_path.etag = input_file[3]
+        return s3_path
+    return input_file
+
+
+def run_group(input_files: List[Union[Tuple, str]], storage_config: str = None) -> bool:
+    """Runs one group of packed input files.  Defined at module level so it
+    can be run in a worker process."""
+    return run_pipeline([unpack_input_file(input_file) for input_file in input_files], storage_config)
+
+
+def clear_pipeline_cache():
+    # Worker processes must not share the temp folders of pipelines built
+    # in the parent process
+    pipeline_cache.clear()
+
+
+def run_pipelines(input_files: Union[List[S3Path], List[str]] = [], max_workers: int = None,
+                  storage_config: str = None):
+    """-------------------------------------------------------------------
+    Run the appropriate pipeline on each group of files routed to the same
+    pipeline, pipeline method and location with the same co-processing
+    key (see group_input_files).  Groups run concurrently in worker
+    processes, at most max_workers at a time.  Each group is logged and
+    succeeds or fails on its own.  With a single group or worker, the
+    groups run one after the other in this process so they can reuse
+    cached pipelines, and the inputs of each group are prefetched while
+    the group before it runs.
+
+    Args:
+        input_files (Union[List[S3Path], List[str]]):
+            The files to run the pipelines against.
+        max_workers (int, optional):
+            The maximum number of groups to run at once.  Defaults to the
+            number of CPUs.
+        storage_config (str, optional):
+            The storage config file.  Defaults to config/storage_config.yml.
+    -------------------------------------------------------------------"""
+    groups = list(group_input_files(input_files).values())
+    logger.info(f'Dispatching {len(input_files)} files in {len(groups)} pipeline groups.')
+
+    if min(max_workers or get_max_workers(), len(groups)) <= 1:
+        try:
+            for group, next_group in zip(groups, groups[1:] + [None]):
+                run_pipeline(group, storage_config, next_group)
+        finally:
+            transfers.discard_prefetched()
+        return
+
+    packed_groups = [[pack_input_file(input_file) for input_file in group] for group in groups]
+    run = functools.partial(run_group, storage_config=storage_config)
+    map_in_processes(run, packed_groups, max_workers=max_workers, initializer=clear_pipeline_cache)
+
+
+def run_pipeline(input_files: Union[List[S3Path], List[str]] = [], storage_config: str = None,
+                 next_input_files: Union[List[S3Path], List[str]] = None) -> bool:
     """-------------------------------------------------------------------
     Run the appropriate pipeline on the provided files.  This method
     determines the appropriate pipeline to call based upon the file name.
@@ -81,6 +379,21 @@ def run_pipeline(input_files: Union[List[S3Path], List[str]] = []):
             it is assumed that they must be co-processed in the same
             pipeline invocation.
 
+        storage_config (str, optional):
+
+            The storage config file.  Defaults to config/storage_config.yml.
+
+        next_input_files (Union[List[S3Path], List[str]], optional):
+
+            The files of the next run, which are prefetched during this one
+            if the pipeline's storage supports it (see
+            pipelines.utils.aws_storage.AsyncAwsStorage).
+
+    Returns:
+
+        bool:   True if the pipeline succeeded, False if it failed, or
+                None if no pipeline is registered for the files.
+
     -------------------------------------------------------------------"""
 
     # If no files are provided, just return out
@@ -91,39 +404,20 @@ def run_pipeline(input_files: Union[List[S3Path], List[str]] = []):
     # they will all use the same pipeline.  So use the filename of
     # the first file to pick the correct pipeline and location to
     # use.
-    # We must use the python equivalent toString() method since the
-    # input file could be provided as an S3Path object or a string file path
-    file_path = input_files[0].__str__()
-    query_file = os.path.basename(file_path)
+    query_file = get_query_file(input_files[0])
 
     logger.debug(f"Dynamically determining pipeline to use from input file: {query_file}")
 
     # Get the storage config file
     pipelines_dir = os.path.dirname(os.path.realpath(__file__))
-    storage_config = os.path.join(pipelines_dir, 'config/storage_config.yml')
-
-    # Look up the correct location for the given data file
-    location = None
-    for location_key, file_pattern in location_map.items():
-        if file_pattern.match(query_file):
-            location = location_key
-            break
-
-    # Look up the correct pipeline for the given file
-    method_to_call = 'run'
-    pipeline_dir = None
-    for pipeline_key, file_pattern in pipeline_map.items():
-        if file_pattern.match(query_file):
-            pipeline_dir = pipeline_key
-            break
-    
-    # Look up the correct pipeline for plotting the given file (if applicable)
-    if pipeline_dir is None:
-        for pipeline_key, file_pattern in plotting_map.items():
-            if file_pattern.match(query_file):
-                pipeline_dir = pipeline_key
-                method_to_call = 'run_plots'
-                break
+    if storage_config is None:
+        storage_config = os.path.join(pipelines_dir, 'config/storage_config.yml')
+
+    try:
+        pipeline_dir, method_to_call, location = get_route(query_file)
+    except AmbiguousRouteError as e:
+        logger.error(f'Skipping files: {input_files} since {e}')
+        return False
 
     # If no pipeline is registered for this file, then skip it
     if location is None or pipeline_dir is None:
@@ -132,14 +426,56 @@ def run_pipeline(input_files: Union[List[S3Path], List[str]] = []):
     else:
         # Look up the correct pipeline config file and instantiate pipeline
         pipeline_config = os.path.join(pipelines_dir, pipeline_dir, 'config', f'pipeline_config_{location}.yml')
-        pipeline = instantiate_pipeline(pipeline_dir, pipeline_config, storage_config)
+        if not os.path.exists(pipeline_config):
+            logger.error(f'Skipping files: {input_files} since there is no pipeline config file: {pipeline_config}')
+            return False
+
+        # Skip files that were already processed with the same configuration,
+        # e.g. duplicate S3 and SNS deliveries, before any input is fetched
+        ledger = get_ledger()
+        if ledger is not None:
+            ledger_key = get_ledger_key(input_files, f'{pipeline_dir}.{method_to_call}', [pipeline_config, storage_config],
+                                        [os.environ.get(name) for name in storage_env_vars])
+            if ledger.contains(ledger_key):
+                logger.info(get_log_message('Duplicate', pipeline_dir, location, input_files))
+                return True
+
+        succeeded = False
+        pipeline = None
+        trace_memory = os.environ.get('TRACE_MEMORY', 'False').lower() == 'true'
+        with instrument(f'{pipeline_dir}.{method_to_call}', trace_memory) as instrumentation:
+            try:
+                # A pipeline that can't be built, e.g. from an invalid config
+                # file, fails this run only
+                with stage('get_pipeline'):
+                    pipeline = get_pipeline(pipeline_dir, location, pipeline_config, storage_config)
+
+                prefetch = getattr(pipeline.storage, 'prefetch', None)
+                if next_input_files and prefetch is not None:
+                    prefetch(next_input_files)
+
+                # Run Pipeline or plots
+                logger.info(get_log_message('Start', pipeline_dir, location, input_files))
+                method = getattr(pipeline, method_to_call)
+                with stage(method_to_call):
+                    method(input_files)
+
+                # Some storages upload saved files in the background, and the
+                # run has only succeeded once they are all stored
+                with stage('wait_for_uploads'):
+                    transfers.wait()
+                logger.info(get_log_message('Success', pipeline_dir, location, input_files))
+                succeeded = True
+
+            except Exception as e:
+                logger.error(get_log_message('Error', pipeline_dir, location, input_files, exception=True))
+
+            finally:
+                if pipeline is not None:
+                    reset_pipeline(pipeline)
 
-        try:                        
-            # Run Pipeline or plots
-            logger.info(get_log_message('Start', pipeline_dir, location, input_files))
-            method = getattr(pipeline, method_to_call)         
-            method(input_files)
-            logger.info(get_log_message('Success', pipeline_dir, location, input_files))
+        log_metrics(instrumentation, succeeded, pipeline_dir, location, input_files)
 
-        except Exception as e:
-            logger.error(get_log_message('Error', pipeline_dir, location, input_files, exception=True))
+        if succeeded and ledger is not None:
+            ledger.record(ledger_key, f'{pipeline_dir}.{method_to_call}', [str(input_file) for input_file in input_files])
+        return succeeded
@@ -0,0 +1,210 @@
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+def get_bins(times: np.ndarray, interval: np.timedelta64) -> np.ndarray:
+    # The start of the interval each time falls in, counted from 1970
+    step = interval.astype('timedelta64[ns]').astype(np.int64)
+    return times.astype('datetime64[ns]').astype(np.int64) // step * step
+
+
+def get_fill_value(array: xr.DataArray) -> Optional[float]:
+    # The value that marks missing data, e.g. values that failed QC, before
+    # packing replaces it with NaN
+    fill_value = array.attrs.get('_FillValue', array.encoding.get('_FillValue'))
+    if fill_value is None or np.isnan(fill_value):
+        return None
+    return fill_value
+
+
+def reduce_bins(values: np.ndarray, starts: np.ndarray,
+                fill_value: float = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """-------------------------------------------------------------------
+    Compute the number of valid values, their mean and their sum of squared
+    deviations from the mean (M2) over each run of rows of an array,
+    ignoring NaN, infinite and fill values.  Each statistic is a single
+    np.add.reduceat over the whole array rather than a loop over the bins.
+
+    Args:
+        values (np.ndarray):    The values, with time along the first axis.
+        starts (np.ndarray):    The index of the first row of each bin.
+        fill_value (float, optional):   A value that marks missing data.
+                                        Defaults to None.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: The count, mean and M2
+        of each bin, in float64.  The mean and M2 are 0 where the count is.
+    -------------------------------------------------------------------"""
+    valid = np.isfinite(values)
+    if fill_value is not None:
+        valid &= values != fill_value
+    values = np.where(valid, values, 0)
+    count = np.add.reduceat(valid, starts, axis=0, dtype=np.int64)
+    sums = np.add.reduceat(values, starts, axis=0, dtype=np.float64)
+    mean = np.divide(sums, count, out=np.zeros_like(sums), where=count > 0)
+
+    # Deviations from the mean of each bin, for an accurate M2
+    lengths = np.diff(np.append(starts, len(values)))
+    deviations = values - np.repeat(mean, lengths, axis=0)
+    deviations *= valid
+    m2 = np.add.reduceat(np.square(deviations, out=deviations), starts, axis=0)
+    return count, mean, m2
+
+
+def combine_bins(bins: np.ndarray, count: np.ndarray, mean: np.ndarray,
+                 m2: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """-------------------------------------------------------------------
+    Combine the statistics of the same bin computed from different blocks
+    of data, using the pairwise update of Chan et al., so a bin split
+    between two blocks gets the same statistics as if it had been
+    reduced at once.
+
+    Args:
+        bins (np.ndarray):  The bin of each row of statistics.
+        count (np.ndarray): The count of each row.
+        mean (np.ndarray):  The mean of each row.
+        m2 (np.ndarray):    The M2 of each row.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]: The sorted
+        unique bins and their count, mean and M2.
+    -------------------------------------------------------------------"""
+    order = np.argsort(bins, kind='stable')
+    bins, count, mean, m2 = bins[order], count[order], mean[order], m2[order]
+    starts = np.flatnonzero(np.diff(bins, prepend=bins[0] - 1))
+    lengths = np.diff(np.append(starts, len(bins)))
+
+    total = np.add.reduceat(count, starts, axis=0)
+    sums = np.add.reduceat(count * mean, starts, axis=0)
+    total_mean = np.divide(sums, total, out=np.zeros_like(sums), where=total > 0)
+    spread = count * (mean - np.repeat(total_mean, lengths, axis=0)) ** 2
+    total_m2 = np.add.reduceat(m2 + spread, starts, axis=0)
+    return bins[starts], total, total_mean, total_m2
+
+
+class TimeAggregator:
+    """-------------------------------------------------------------------
+    Computes the mean, standard deviation and number of valid values of
+    variables over fixed intervals of time, e.g. 10 minute averages of a
+    lidar's full rate data.  Intervals start at multiples of the interval
+    since 1970, i.e. since midnight for intervals that divide a day.
+    Missing values (NaN or the variable's _FillValue, e.g. values that
+    failed QC) and infinite values (e.g. the SNR of a zero signal) are left
+    out.  The standard deviation is the population standard deviation, as
+    in xarray's std().
+
+    Datasets are added a block at a time, in any order, so a file streamed
+    through the pipeline is aggregated without holding all of it in memory.
+    Only the statistics of each interval are kept between blocks.
+
+    A filtered variable holds only the values of a variable where another
+    variable is at least a minimum, e.g. the Doppler velocities with a high
+    enough signal to noise ratio.  Its statistics are computed the same way.
+
+    Args:
+        interval (str):         The length of the intervals, e.g. '10min'.
+        variables (List[str]):  The variables to aggregate.  They may have
+                                other dimensions after time.
+        filtered (Dict[str, Dict], optional):   The filtered variables to
+                                aggregate, keyed by name.  Each has the
+                                `variable` to filter, the variable to filter
+                                it `where` and the `min` value of that
+                                variable.  Defaults to None.
+    -------------------------------------------------------------------"""
+
+    def __init__(self, interval: str, variables: List[str], filtered: Dict[str, Dict] = None):
+        self.interval = interval
+        self.step = pd.to_timedelta(interval).to_timedelta64()
+        self.variables = list(variables)
+        self.filtered = filtered or {}
+        self.blocks = []
+        self.template = None
+        self.attrs = {}
+        self.time_attrs = {}
+
+    @classmethod
+    def from_config(cls, definition: Dict) -> 'TimeAggregator':
+        # Create an aggregator from the aggregation section of a pipeline
+        # config file
+        return cls(definition['interval'], definition.get('variables', []), definition.get('filtered'))
+
+    def get_values(self, dataset: xr.Dataset) -> Dict[str, Tuple[xr.DataArray, Optional[float]]]:
+        # The variables and filtered variables to aggregate, with time first,
+        # and their fill values
+        values = {name: (dataset[name], get_fill_value(dataset[name])) for name in self.variables}
+        for name, definition in self.filtered.items():
+            variable, where = dataset[definition['variable']], dataset[definition['where']]
+            values[name] = (variable.where(where >= definition['min']), get_fill_value(variable))
+        return {name: (array.transpose('time', ...), fill_value) for name, (array, fill_value) in values.items()}
+
+    def add(self, dataset: xr.Dataset):
+        """-------------------------------------------------------------------
+        Add the statistics of a block of data.
+
+        Args:
+            dataset (xr.Dataset):   The block, with a time dimension.
+        -------------------------------------------------------------------"""
+        if not dataset.sizes.get('time'):
+            return
+
+        bins = get_bins(dataset['time'].values, self.step)
+        order = None
+        if np.any(bins[1:] < bins[:-1]):
+            order = np.argsort(bins, kind='stable')
+            bins = bins[order]
+        starts = np.flatnonzero(np.diff(bins, prepend=bins[0] - 1))
+
+        values = self.get_values(dataset)
+        stats = {}
+        for name, (array, fill_value) in values.items():
+            data = array.values if order is None else array.values[order]
+            stats[name] = reduce_bins(data, starts, fill_value)
+        self.blocks.append((bins[starts], stats))
+
+        if self.template is None:
+            self.template = {name: array.isel(time=0, drop=True) for name, (array, _) in values.items()}
+            self.attrs = dict(dataset.attrs)
+            self.time_attrs = dict(dataset['time'].attrs)
+
+    def result(self) -> xr.Dataset:
+        """-------------------------------------------------------------------
+        Get the statistics of each interval from the blocks added so far.
+        Each variable has a _mean and _std in the type of the variable (or
+        float32 for integer variables) and a _count of the valid values in
+        the interval.  Time is the start of each interval.
+
+        Returns:
+            xr.Dataset: The statistics, or None if no data was added.
+        -------------------------------------------------------------------"""
+        if self.template is None:
+            return None
+
+        bins = np.concatenate([block_bins for block_bins, _ in self.blocks])
+        data_vars = {}
+        for name, template in self.template.items():
+            stats = [np.concatenate([block[name][i] for _, block in self.blocks]) for i in range(3)]
+            _, count, mean, m2 = combine_bins(bins, *stats)
+
+            dtype = template.dtype if np.issubdtype(template.dtype, np.floating) else np.float32
+            variance = np.divide(m2, count, out=np.full_like(m2, np.nan), where=count > 0)
+            mean = np.where(count > 0, mean, np.nan).astype(dtype)
+            std = np.sqrt(variance).astype(dtype)
+
+            dims = ('time',) + template.dims
+            long_name = template.attrs.get('long_name', name)
+            units = {key: template.attrs['units'] for key in ['units'] if key in template.attrs}
+            data_vars[f'{name}_mean'] = (dims, mean, {
+                'long_name': f'{long_name} {self.interval} mean', **units, 'cell_methods': 'time: mean'})
+            data_vars[f'{name}_std'] = (dims, std, {
+                'long_name': f'{long_name} {self.interval} standard deviation', **units,
+                'cell_methods': 'time: standard_deviation'})
+            data_vars[f'{name}_count'] = (dims, count.astype(np.int32), {
+                'long_name': f'Number of valid {long_name} values in {self.interval}', 'units': '1'})
+
+        coords = {name: coord for template in self.template.values() for name, coord in template.coords.items()}
+        time = np.unique(bins).astype('datetime64[ns]')
+        time_attrs = {**self.time_attrs, 'long_name': f'Start of {self.interval} interval (UTC)'}
+        return xr.Dataset(data_vars, coords={'time': ('time', time, time_attrs), **coords},
+                          attrs={**self.attrs, 'averaging_interval': self.interval})
@@ -0,0 +1,81 @@
+import os
+from typing import List, Union
+
+from tsdat.io import AwsStorage, S3Path
+from tsdat.io.aws_storage import AwsTemporaryStorage
+from tsdat.io.storage import DisposableLocalTempFile
+
+from pipelines.utils.s3 import is_s3_path
+from pipelines.utils.transfers import get_transfer_config, transfers
+
+
+class AsyncAwsTemporaryStorage(AwsTemporaryStorage):
+    """-------------------------------------------------------------------
+    AwsTemporaryStorage that uploads in the background and fetches from
+    pending uploads and prefetched downloads where it can.  See
+    pipelines.utils.transfers.TransferExecutor.
+    -------------------------------------------------------------------"""
+
+    def fetch(self, file_path: S3Path, local_dir=None, disposable=True) -> Union[DisposableLocalTempFile, str]:
+        if not local_dir:
+            local_dir = self.create_temp_dir()
+
+        fetched_file = os.path.join(local_dir, os.path.basename(file_path.bucket_path))
+        if not transfers.take(file_path.bucket_name, file_path.bucket_path, fetched_file):
+            s3_client = self.datastream_storage.s3_client
+            s3_client.download_file(file_path.bucket_name, file_path.bucket_path, fetched_file,
+                                    Config=get_transfer_config())
+
+        if disposable:
+            return DisposableLocalTempFile(fetched_file)
+
+        return fetched_file
+
+    def upload(self, local_path: str, s3_path: S3Path):
+        transfers.upload(self.datastream_storage.s3_client, local_path, s3_path.bucket_name, s3_path.bucket_path)
+
+    def delete(self, filepath: S3Path) -> None:
+        # Input files are deleted as soon as the pipeline is done with them
+        # (see DisposableStorageTempFileList), before its uploads have
+        # finished.  Wait for the uploads first, so if one fails the error
+        # is raised and the input is kept to be processed again.
+        transfers.wait()
+        super().delete(filepath)
+
+
+class AsyncAwsStorage(AwsStorage):
+    """-------------------------------------------------------------------
+    AwsStorage that overlaps S3 transfers with the pipeline's work.  Saved
+    files (the raw inputs, outputs and plots) are uploaded in background
+    threads, in parts if they are large, and reopening a saved output uses
+    the local file rather than downloading it again.  Inputs can be
+    prefetched while the pipeline works on earlier ones.
+
+    pipelines.runner waits for the uploads before a run counts as a
+    success, and input files are only deleted once the uploads before
+    them have succeeded.  When the storage is used on its own, call wait()
+    before relying on the saved files being in S3.
+
+    Args:
+        parameters (dict, optional):    The same parameters as AwsStorage.
+    -------------------------------------------------------------------"""
+
+    def __init__(self, parameters={}):
+        super().__init__(parameters=parameters)
+        self._tmp = AsyncAwsTemporaryStorage(self)
+
+    def prefetch(self, file_paths: List[Union[S3Path, str]]):
+        """-------------------------------------------------------------------
+        Start downloading input files that will be fetched later.  Files
+        that aren't in S3 are left alone.
+
+        Args:
+            file_paths (List[Union[S3Path, str]]):  The files to download.
+        -------------------------------------------------------------------"""
+        for file_path in file_paths:
+            if is_s3_path(file_path):
+                transfers.prefetch(self.s3_client, file_path.bucket_name, file_path.bucket_path)
+
+    def wait(self):
+        # Wait for the uploads of this process to finish
+        transfers.wait()
@@ -0,0 +1,128 @@
+import gzip
+import io
+import os
+import re
+import struct
+import tarfile
+import zipfile
+from contextlib import contextmanager
+from typing import BinaryIO, Iterator, NamedTuple, Optional
+
+# Archives are recognized by name, like tsdat's AwsTemporaryStorage, so
+# files aren't opened to find out what they are
+TAR_EXTENSIONS = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')
+ZIP_EXTENSIONS = ('.zip',)
+GZIP_EXTENSIONS = ('.gz',)
+
+
+class Member(NamedTuple):
+    # A decompressed file in a compressed file or archive
+    name: str
+    size: Optional[int]
+    fileobj: BinaryIO
+
+
+class ForwardStream(io.RawIOBase):
+    # A file in a tar file read in stream mode, which can't report whether
+    # it is seekable, as a stream that is only read forwards
+    def __init__(self, fileobj: BinaryIO):
+        self.fileobj = fileobj
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        data = self.fileobj.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def is_tar(filename: str) -> bool:
+    return filename.lower().endswith(TAR_EXTENSIONS)
+
+
+def is_zip(filename: str) -> bool:
+    return filename.lower().endswith(ZIP_EXTENSIONS)
+
+
+def is_gzip(filename: str) -> bool:
+    return filename.lower().endswith(GZIP_EXTENSIONS) and not is_tar(filename)
+
+
+def is_compressed(filename: str) -> bool:
+    return is_tar(filename) or is_zip(filename) or is_gzip(filename)
+
+
+def get_gzip_size(filename: str) -> int:
+    # The size of the decompressed data modulo 2**32, from the end of the
+    # last gzip member.  Only an estimate for files of several members or
+    # of 4 GiB or more.
+    with open(filename, 'rb') as f:
+        f.seek(-4, os.SEEK_END)
+        return struct.unpack('<I', f.read(4))[0]
+
+
+def iter_members(filename: str) -> Iterator[Member]:
+    """-------------------------------------------------------------------
+    Iterate over the files in a gzip, zip or tar file as decompressed
+    streams, without extracting them.  Each stream is decompressed as it
+    is read, and is only valid until the next member.  Tar files are read
+    in a single forward pass.  Files that aren't compressed are a single
+    member.
+
+    Args:
+        filename (str): The path to the file.
+
+    Yields:
+        Member: The name, decompressed size (None if unknown) and binary
+        stream of each file.
+    -------------------------------------------------------------------"""
+    if is_tar(filename):
+        with tarfile.open(filename, 'r|*') as tar:
+            for info in tar:
+                if info.isfile():
+                    yield Member(info.name, info.size, io.BufferedReader(ForwardStream(tar.extractfile(info))))
+
+    elif is_zip(filename):
+        with zipfile.ZipFile(filename) as zip_file:
+            for info in zip_file.infolist():
+                if not info.is_dir():
+                    with zip_file.open(info) as f:
+                        yield Member(info.filename, info.file_size, f)
+
+    elif is_gzip(filename):
+        with gzip.open(filename, 'rb') as f:
+            yield Member(os.path.basename(filename)[:-3], get_gzip_size(filename), f)
+
+    else:
+        with open(filename, 'rb') as f:
+            yield Member(os.path.basename(filename), os.fstat(f.fileno()).st_size, f)
+
+
+@contextmanager
+def open_member(filename: str, pattern: str = None) -> Iterator[Member]:
+    """-------------------------------------------------------------------
+    Open the first file in a gzip, zip or tar file whose name matches a
+    pattern as a decompressed stream.  See iter_members.
+
+    Args:
+        filename (str):             The path to the file.
+        pattern (str, optional):    A regex the whole name of the member
+                                    must match, e.g. r'.*\\.hpl'.  Defaults
+                                    to the first member.
+
+    Yields:
+        Member: The member.
+
+    Raises:
+        FileNotFoundError: If no member matches.
+    -------------------------------------------------------------------"""
+    members = iter_members(filename)
+    try:
+        for member in members:
+            if pattern is None or re.fullmatch(pattern, os.path.basename(member.name)):
+                yield member
+                return
+        raise FileNotFoundError(f'No file matching {pattern} in {filename}')
+    finally:
+        members.close()
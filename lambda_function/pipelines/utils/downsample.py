@@ -0,0 +1,138 @@
+import math
+import warnings
+from typing import Dict, Tuple
+
+import numpy as np
+import xarray as xr
+
+
+def get_pixel_sizes(figsize: Tuple[float, float], dpi: float) -> Tuple[int, int]:
+    """-------------------------------------------------------------------
+    Get the size in pixels of a figure, the most points a plot in it can
+    show along each axis.
+
+    Args:
+        figsize (Tuple[float, float]):  The width and height in inches.
+        dpi (float):                    The dots per inch it is saved with.
+
+    Returns:
+        Tuple[int, int]: The width and height in pixels.
+    -------------------------------------------------------------------"""
+    return int(figsize[0] * dpi), int(figsize[1] * dpi)
+
+
+def get_factors(dataset: xr.Dataset, sizes: Dict[str, int]) -> Dict[str, int]:
+    # The number of points combined into one along each dimension
+    return {dim: math.ceil(dataset.sizes[dim] / size) for dim, size in sizes.items()
+            if dim in dataset.sizes and dataset.sizes[dim] > size}
+
+
+def aggregate(values: np.ndarray, factors: Tuple[int, ...], how: str = 'mean') -> np.ndarray:
+    """-------------------------------------------------------------------
+    Combine each block of factors[i] points along each axis of an array
+    into one point, ignoring NaN and NaT values.  The last block along an
+    axis is shorter if the axis length isn't a multiple of its factor.
+
+    Floating point values are combined with their mean or max, datetimes
+    with their mean, and integer and boolean values (e.g. QC flags) always
+    with their max.
+
+    Args:
+        values (np.ndarray):        The values.
+        factors (Tuple[int, ...]):  The block length along each axis.
+        how (str, optional):        'mean' or 'max'. Defaults to 'mean'.
+
+    Returns:
+        np.ndarray: The combined values.
+    -------------------------------------------------------------------"""
+    if np.issubdtype(values.dtype, np.datetime64):
+        nat = np.isnat(values)
+        numbers = np.where(nat, np.nan, values.astype(np.int64).astype(np.float64))
+        means = aggregate(numbers, factors, 'mean')
+        result = np.nan_to_num(means).astype(np.int64).astype(values.dtype)
+        result[np.isnan(means)] = np.datetime64('NaT')
+        return result
+
+    floating = np.issubdtype(values.dtype, np.floating)
+    if floating:
+        fill = np.nan
+    elif values.dtype == bool:
+        fill = False
+    else:
+        fill = np.iinfo(values.dtype).min
+
+    # Pad each axis to a multiple of its factor, then split it into blocks
+    padding = [(0, -length % factor) for length, factor in zip(values.shape, factors)]
+    if any(after for _, after in padding):
+        values = np.pad(values, padding, constant_values=fill)
+    blocks = values.reshape([size for length, factor in zip(values.shape, factors)
+                             for size in (length // factor, factor)])
+    block_axes = tuple(range(1, blocks.ndim, 2))
+
+    if not floating:
+        return blocks.max(axis=block_axes)
+
+    # All-NaN blocks are expected where there is no data
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        reduce = np.nanmax if how == 'max' else np.nanmean
+        return reduce(blocks, axis=block_axes).astype(values.dtype)
+
+
+def downsample(dataset: xr.Dataset, sizes: Dict[str, int], how: str = 'mean',
+               rows_per_block: int = 256) -> xr.Dataset:
+    """-------------------------------------------------------------------
+    Reduce a dataset to at most sizes[dim] points along each dimension,
+    e.g. the pixels of the plot it is drawn in, so plots take the same time
+    to render however long the file is.  Consecutive points are combined
+    with a NaN-aware aggregate (see aggregate), which looks the same as the
+    full resolution data at the plot's resolution.  Coordinates are
+    combined with their mean, and variables along the dimensions that
+    aren't numbers or datetimes are dropped.
+
+    The dataset is read and reduced in blocks along the first dimension in
+    sizes, so only rows_per_block output rows of a lazily loaded dataset
+    (e.g. a zarr store) are in memory at once.  The dataset is returned as
+    is if it is already small enough.
+
+    Args:
+        dataset (xr.Dataset):   The dataset.
+        sizes (Dict[str, int]): The maximum number of points along each
+                                dimension.
+        how (str, optional):    'mean' or 'max', how floating point
+                                variables are combined. Defaults to 'mean'.
+        rows_per_block (int, optional): The number of output rows computed
+                                        at once. Defaults to 256.
+
+    Returns:
+        xr.Dataset: The downsampled dataset.
+    -------------------------------------------------------------------"""
+    factors = get_factors(dataset, sizes)
+    if not factors:
+        return dataset
+
+    dims = [dim for dim in sizes if dim in factors]
+    block_dim = dims[0]
+    step = factors[block_dim] * rows_per_block
+    blocks = []
+    for start in range(0, dataset.sizes[block_dim], step):
+        block = dataset.isel({block_dim: slice(start, start + step)})
+        blocks.append(downsample_block(block, factors, how))
+
+    return xr.concat(blocks, dim=block_dim, data_vars='minimal', coords='minimal', compat='override')
+
+
+def downsample_block(dataset: xr.Dataset, factors: Dict[str, int], how: str) -> xr.Dataset:
+    # Downsample the variables and coordinates along the dimensions, and
+    # keep the others as they are
+    variables = {}
+    for name, variable in dataset.variables.items():
+        if not set(variable.dims) & set(factors):
+            variables[name] = variable
+        elif variable.dtype.kind in 'fiubM':
+            values = aggregate(variable.values, tuple(factors.get(dim, 1) for dim in variable.dims),
+                               'mean' if name in dataset.coords else how)
+            variables[name] = xr.Variable(variable.dims, values, variable.attrs)
+
+    coords = [name for name in dataset.coords if name in variables]
+    return xr.Dataset(variables, attrs=dataset.attrs).set_coords(coords)
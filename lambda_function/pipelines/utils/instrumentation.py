@@ -0,0 +1,314 @@
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+
+# How often the resident memory is sampled while a run is instrumented
+RSS_SAMPLE_SECONDS = 0.01
+
+
+def get_max_rss_mb() -> float:
+    # The peak resident memory of this process since it started, including
+    # earlier invocations of a warm Lambda container.  ru_maxrss is in
+    # kilobytes on Linux and bytes on macOS.
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 2 ** 20 if sys.platform == 'darwin' else max_rss / 2 ** 10
+
+
+def get_rss_mb() -> Optional[float]:
+    # The current resident memory of this process, or None where
+    # /proc/self/statm doesn't exist (e.g. macOS)
+    try:
+        with open('/proc/self/statm', 'rb') as f:
+            resident_pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return resident_pages * resource.getpagesize() / 2 ** 20
+
+
+class RssSampler:
+    """-------------------------------------------------------------------
+    Samples the resident memory of this process in a background thread and
+    keeps the highest sample since it was last reset, like tracemalloc's
+    peak.  Stages reset it when they start and end, so each stage gets the
+    high-water mark of the memory in use while it ran rather than the peak
+    of the process so far.
+
+    Args:
+        interval (float, optional): Seconds between samples. Defaults to
+                                    RSS_SAMPLE_SECONDS.
+    -------------------------------------------------------------------"""
+    def __init__(self, interval: float = RSS_SAMPLE_SECONDS):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.peak_mb = get_rss_mb()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample_until_stopped, daemon=True)
+        self.thread.start()
+
+    def sample_until_stopped(self):
+        while not self.stopped.wait(self.interval):
+            rss_mb = get_rss_mb()
+            with self.lock:
+                self.peak_mb = max(self.peak_mb, rss_mb)
+
+    def reset_peak(self) -> float:
+        # Returns the peak since the last reset, including the memory now
+        rss_mb = get_rss_mb()
+        with self.lock:
+            peak_mb = max(self.peak_mb, rss_mb)
+            self.peak_mb = rss_mb
+        return peak_mb
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+def get_cpu_seconds() -> float:
+    # CPU time of this process and of the worker processes it has reaped,
+    # e.g. the workers of a process pool that has shut down
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+
+class Stage:
+    """-------------------------------------------------------------------
+    The measurements of one timed stage of a pipeline run.
+
+    Args:
+        name (str):     The name of the stage.
+        path (str):     The names of the enclosing stages and this stage,
+                        joined with '/'.
+        depth (int):    The number of enclosing stages.
+    -------------------------------------------------------------------"""
+    def __init__(self, name: str, path: str, depth: int):
+        self.name = name
+        self.path = path
+        self.depth = depth
+        self.start = time.perf_counter()
+        self.start_cpu = get_cpu_seconds()
+        self.wall_seconds = None
+        self.cpu_seconds = None
+        self.peak_rss_mb = None
+        self.traced_peak_mb = None
+
+    def finish(self):
+        self.wall_seconds = time.perf_counter() - self.start
+        self.cpu_seconds = get_cpu_seconds() - self.start_cpu
+
+
+class Instrumentation:
+    """-------------------------------------------------------------------
+    Records the wall time, CPU time and memory of the stages of a pipeline
+    run.  Stages are timed with the stage() context manager and can be
+    nested.  Use the module level instrument() and stage() functions so
+    pipelines don't need a reference to the instrumentation of the run.
+
+    Memory is measured as the highest resident memory sampled while each
+    stage ran (see RssSampler), where /proc/self/statm is available.  The
+    peak resident memory of the whole process, which in a warm Lambda
+    container includes earlier invocations, is only reported for the run.
+    If trace_memory is set, the peak Python allocations during each stage
+    are measured with tracemalloc as well (Python 3.9 or later), which is
+    more precise but slows the run down.
+
+    Args:
+        name (str):                     The name of the run.
+        trace_memory (bool, optional):  Whether to trace allocations.
+                                        Defaults to False.
+    -------------------------------------------------------------------"""
+    def __init__(self, name: str, trace_memory: bool = False):
+        self.name = name
+        self.trace_memory = trace_memory and hasattr(tracemalloc, 'reset_peak')
+        self.stages: List[Stage] = []
+        self.open_stages: List[Stage] = []
+        self.start = time.perf_counter()
+        self.start_cpu = get_cpu_seconds()
+        self.wall_seconds = None
+        self.cpu_seconds = None
+        self.rss_sampler = RssSampler() if get_rss_mb() is not None else None
+        self.peak_rss_mb = None
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[Stage]:
+        """-------------------------------------------------------------------
+        Time a stage of the run.
+
+        Args:
+            name (str): The name of the stage.
+
+        Yields:
+            Stage: The measurements, which are set when the stage ends.
+        -------------------------------------------------------------------"""
+        parent = self.open_stages[-1] if self.open_stages else None
+        self.update_peaks(parent)
+
+        path = f'{parent.path}/{name}' if parent else name
+        stage = Stage(name, path, len(self.open_stages))
+        self.stages.append(stage)
+        self.open_stages.append(stage)
+        try:
+            yield stage
+        finally:
+            stage.finish()
+            self.update_peaks(stage)
+            if parent is not None:
+                for name in ['peak_rss_mb', 'traced_peak_mb']:
+                    if getattr(stage, name) is not None:
+                        setattr(parent, name, max(getattr(parent, name) or 0, getattr(stage, name)))
+            self.open_stages.pop()
+
+    def update_peaks(self, stage: Stage):
+        # The sampler and tracemalloc each keep one peak, which is reset
+        # whenever a stage starts or ends, so the peak of each stage is the
+        # largest of the peaks between those events.  The peaks between
+        # the events of stages count towards the whole run.
+        if self.rss_sampler is not None:
+            peak_mb = self.rss_sampler.reset_peak()
+            self.peak_rss_mb = max(self.peak_rss_mb or 0, peak_mb)
+            if stage is not None:
+                stage.peak_rss_mb = max(stage.peak_rss_mb or 0, peak_mb)
+        if self.trace_memory:
+            if stage is not None:
+                peak_mb = tracemalloc.get_traced_memory()[1] / 2 ** 20
+                stage.traced_peak_mb = max(stage.traced_peak_mb or 0, peak_mb)
+            tracemalloc.reset_peak()
+
+    def finish(self):
+        self.wall_seconds = time.perf_counter() - self.start
+        self.cpu_seconds = get_cpu_seconds() - self.start_cpu
+        if self.rss_sampler is not None:
+            self.update_peaks(None)
+            self.rss_sampler.stop()
+
+    def get_record(self) -> Dict:
+        """-------------------------------------------------------------------
+        Summarize the run, with the stages that ran more than once (e.g. for
+        each block of a streamed file) combined under their path.
+
+        Returns:
+            Dict: The total wall and CPU seconds and peak memory of the run
+            and of each stage, in the order the stages first started.
+            Peak_Rss_MB is the highest resident memory sampled during the
+            run or stage.  Process_Max_Rss_MB is the peak resident memory
+            of the process since it started.
+        -------------------------------------------------------------------"""
+        stages = {}
+        for stage in self.stages:
+            if stage.wall_seconds is None:
+                continue
+            summary = stages.setdefault(stage.path, {
+                'Stage': stage.path, 'Count': 0, 'Wall_Seconds': 0, 'Cpu_Seconds': 0})
+            summary['Count'] += 1
+            summary['Wall_Seconds'] += stage.wall_seconds
+            summary['Cpu_Seconds'] += stage.cpu_seconds
+            for key, peak_mb in [('Peak_Rss_MB', stage.peak_rss_mb), ('Traced_Peak_MB', stage.traced_peak_mb)]:
+                if peak_mb is not None:
+                    summary[key] = max(summary.get(key, 0), peak_mb)
+
+        for summary in stages.values():
+            for key, value in summary.items():
+                if isinstance(value, float):
+                    summary[key] = round(value, 1 if key.endswith('_MB') else 4)
+
+        return {
+            'Wall_Seconds': round(self.wall_seconds, 4) if self.wall_seconds is not None else None,
+            'Cpu_Seconds': round(self.cpu_seconds, 4) if self.cpu_seconds is not None else None,
+            'Peak_Rss_MB': round(self.peak_rss_mb, 1) if self.peak_rss_mb is not None else None,
+            'Process_Max_Rss_MB': round(get_max_rss_mb(), 1),
+            'Stages': list(stages.values()),
+        }
+
+    def get_chrome_trace(self) -> Dict:
+        """-------------------------------------------------------------------
+        Export the stages as Chrome trace events, which can be opened in
+        chrome://tracing or https://ui.perfetto.dev.
+
+        Returns:
+            Dict: The trace, with a complete event per stage.
+        -------------------------------------------------------------------"""
+        events = []
+        for stage in self.stages:
+            if stage.wall_seconds is None:
+                continue
+            args = {'cpu_seconds': round(stage.cpu_seconds, 6)}
+            if stage.peak_rss_mb is not None:
+                args['peak_rss_mb'] = round(stage.peak_rss_mb, 1)
+            if stage.traced_peak_mb is not None:
+                args['traced_peak_mb'] = round(stage.traced_peak_mb, 1)
+            events.append({
+                'name': stage.name,
+                'cat': self.name,
+                'ph': 'X',
+                'ts': round((stage.start - self.start) * 1e6, 1),
+                'dur': round(stage.wall_seconds * 1e6, 1),
+                'pid': os.getpid(),
+                'tid': threading.get_ident(),
+                'args': args,
+            })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write_chrome_trace(self, filename: str):
+        with open(filename, 'w') as f:
+            json.dump(self.get_chrome_trace(), f)
+
+
+# The instrumentation of the run in progress in this process, if any
+current_instrumentation: Instrumentation = None
+
+
+@contextmanager
+def instrument(name: str, trace_memory: bool = False) -> Iterator[Instrumentation]:
+    """-------------------------------------------------------------------
+    Instrument a pipeline run.  Stages started with stage() while the run
+    is in progress are recorded.  If trace_memory is set, tracemalloc is
+    started for the run unless it is already tracing.
+
+    Args:
+        name (str):                     The name of the run.
+        trace_memory (bool, optional):  Whether to measure allocations with
+                                        tracemalloc. Defaults to False.
+
+    Yields:
+        Instrumentation: The instrumentation of the run.
+    -------------------------------------------------------------------"""
+    global current_instrumentation
+    previous = current_instrumentation
+    start_tracing = trace_memory and not tracemalloc.is_tracing()
+    if start_tracing:
+        tracemalloc.start()
+
+    current_instrumentation = Instrumentation(name, trace_memory)
+    try:
+        yield current_instrumentation
+    finally:
+        current_instrumentation.finish()
+        current_instrumentation = previous
+        if start_tracing:
+            tracemalloc.stop()
+
+
+@contextmanager
+def stage(name: str) -> Iterator[Stage]:
+    """-------------------------------------------------------------------
+    Time a stage of the pipeline run in progress.  Does nothing if the run
+    isn't instrumented.
+
+    Args:
+        name (str): The name of the stage.
+
+    Yields:
+        Stage: The measurements, or None if the run isn't instrumented.
+    -------------------------------------------------------------------"""
+    if current_instrumentation is None:
+        yield None
+    else:
+        with current_instrumentation.stage(name) as measurements:
+            yield measurements
@@ -0,0 +1,171 @@
+from __future__ import annotations
+
+import hashlib
+import importlib
+import json
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Iterator, List, Union
+
+from pipelines.utils.s3 import is_s3_path
+
+if TYPE_CHECKING:
+    from tsdat.io import S3Path
+
+
+class AbstractLedger:
+    """-------------------------------------------------------------------
+    A ledger of the pipeline runs that have succeeded, keyed by a hash of
+    their input files and configuration (see get_ledger_key).  S3 and SNS
+    deliver notifications at least once, so the same files can arrive more
+    than once, and runs already in the ledger are skipped.
+
+    Subclasses implement a backend.  A ledger shared by all of the
+    function's containers (e.g. a database table) is needed to catch every
+    duplicate delivery, while SqliteLedger only catches duplicates that
+    reach the same container or machine.
+
+    Args:
+        path (str): The location of the ledger, e.g. a file path or a
+                    table name.
+    -------------------------------------------------------------------"""
+    def __init__(self, path: str):
+        self.path = path
+
+    def contains(self, key: str) -> bool:
+        """-------------------------------------------------------------------
+        Check if a run is in the ledger.
+
+        Args:
+            key (str):  The ledger key of the run.
+
+        Returns:
+            bool: True if the run already succeeded.
+        -------------------------------------------------------------------"""
+        raise NotImplementedError
+
+    def record(self, key: str, pipeline: str, input_files: List[str]):
+        """-------------------------------------------------------------------
+        Add a successful run to the ledger.
+
+        Args:
+            key (str):                  The ledger key of the run.
+            pipeline (str):             The pipeline and method that ran.
+            input_files (List[str]):    The input files of the run.
+        -------------------------------------------------------------------"""
+        raise NotImplementedError
+
+
+class SqliteLedger(AbstractLedger):
+    """-------------------------------------------------------------------
+    A ledger stored in a local SQLite database file.  Safe to use from
+    several processes at once.
+    -------------------------------------------------------------------"""
+    def __init__(self, path: str):
+        super().__init__(path)
+        folder = os.path.dirname(os.path.abspath(path))
+        os.makedirs(folder, exist_ok=True)
+        with self.connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS runs '
+                               '(key TEXT PRIMARY KEY, pipeline TEXT, input_files TEXT, processed_at REAL)')
+
+    @contextmanager
+    def connect(self) -> Iterator[sqlite3.Connection]:
+        # Connect on each call, since connections can't be shared with
+        # worker processes.  Commits on success and always closes.
+        connection = sqlite3.connect(self.path, timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def contains(self, key: str) -> bool:
+        with self.connect() as connection:
+            return connection.execute('SELECT 1 FROM runs WHERE key = ?', (key,)).fetchone() is not None
+
+    def record(self, key: str, pipeline: str, input_files: List[str]):
+        with self.connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?)',
+                               (key, pipeline, json.dumps(input_files), time.time()))
+
+
+def get_ledger() -> AbstractLedger:
+    """-------------------------------------------------------------------
+    Get the ledger configured by the LEDGER_CLASSNAME and LEDGER_PATH
+    environment variables, e.g. pipelines.utils.ledger.SqliteLedger and
+    /tmp/ledger.sqlite.  The ledger is opt-in, so this returns None if
+    LEDGER_CLASSNAME is not set.
+
+    Returns:
+        AbstractLedger: The ledger, or None.
+    -------------------------------------------------------------------"""
+    classname = os.environ.get('LEDGER_CLASSNAME')
+    if not classname:
+        return None
+
+    module_name, class_name = classname.rsplit('.', 1)
+    class_ = getattr(importlib.import_module(module_name), class_name)
+    return class_(os.environ['LEDGER_PATH'])
+
+
+def get_file_fingerprint(input_file: Union[S3Path, str]) -> str:
+    """-------------------------------------------------------------------
+    Identify the content of an input file without reading it.  S3 objects
+    are identified by their ETag, taken from the S3 event when it is set
+    as the S3Path's etag attribute and looked up otherwise.  Local files
+    are identified by their size and modification time.
+
+    Args:
+        input_file (Union[S3Path, str]):    The input file.
+
+    Returns:
+        str: The file's path and fingerprint.
+    -------------------------------------------------------------------"""
+    if is_s3_path(input_file):
+        etag = getattr(input_file, 'etag', None)
+        if etag is None:
+            import boto3
+            s3 = boto3.client('s3', region_name=input_file.region_name)
+            etag = s3.head_object(Bucket=input_file.bucket_name, Key=input_file.bucket_path)['ETag']
+
+        # S3 events give the ETag without the quotes that the API adds
+        etag = etag.strip('"')
+        return f's3://{input_file.bucket_name}/{input_file.bucket_path}:{etag}'
+
+    stat = os.stat(input_file)
+    return f'{os.path.abspath(input_file)}:{stat.st_size}:{stat.st_mtime_ns}'
+
+
+def hash_file(filename: str) -> str:
+    with open(filename, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def get_ledger_key(input_files: List[Union[S3Path, str]], pipeline: str, config_files: List[str],
+                   environment: List[str] = None) -> str:
+    """-------------------------------------------------------------------
+    Get the ledger key of a pipeline run.  The key changes when any input
+    file changes, or when the content of a config file or the environment
+    (e.g. the output bucket) changes, so those runs are not skipped.
+
+    Args:
+        input_files (List[Union[S3Path, str]]): The input files of the run.
+        pipeline (str):                         The pipeline and method.
+        config_files (List[str]):               The config files used.
+        environment (List[str], optional):      Other values that the
+                                                outputs depend on. Defaults
+                                                to None.
+
+    Returns:
+        str: The key.
+    -------------------------------------------------------------------"""
+    key = {
+        'pipeline': pipeline,
+        'input_files': sorted(get_file_fingerprint(input_file) for input_file in input_files),
+        'config_files': [hash_file(config_file) for config_file in config_files],
+        'environment': environment or [],
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
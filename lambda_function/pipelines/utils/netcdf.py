@@ -0,0 +1,184 @@
+from typing import Dict
+
+import netCDF4
+import numpy as np
+import xarray as xr
+from tsdat import Config
+from tsdat.io import FileHandler
+
+from pipelines.utils.log_helper import logger
+
+# Encoding keys needed to convert in-memory values to the on-disk values of
+# an existing netCDF variable.
+VALUE_ENCODING_KEYS = ['units', 'calendar', 'dtype', '_FillValue', 'scale_factor', 'add_offset']
+
+# Keys of an encoding profile that are copied to the encoding of every
+# variable.
+COMPRESSION_ENCODING_KEYS = ['zlib', 'complevel', 'shuffle']
+
+
+class NetCdfAppender:
+    """-------------------------------------------------------------------
+    Writes a dataset to a netCDF file one block at a time along an
+    unlimited dimension.
+
+    The first block is written with the registered netCDF FileHandler so
+    the file gets the same attributes and encoding as a regular pipeline
+    output.  Later blocks are encoded with the encoding read back from the
+    file and written directly into the existing variables, so only one
+    block needs to be in memory at a time.
+
+    Args:
+        filename (str):             The path of the netCDF file to write.
+        config (Config, optional):  The pipeline config passed to the
+                                    FileHandler. Defaults to None.
+        dim (str, optional):        The dimension to append along. Defaults
+                                    to 'time'.
+    -------------------------------------------------------------------"""
+
+    def __init__(self, filename: str, config: Config = None, dim: str = 'time'):
+        self.filename = filename
+        self.config = config
+        self.dim = dim
+        self.encodings = None
+
+    def append(self, dataset: xr.Dataset):
+        """-------------------------------------------------------------------
+        Append a block to the file, creating the file with the first block.
+
+        Args:
+            dataset (xr.Dataset):   The block to append.  It must have the
+                                    same variables as the first block.
+        -------------------------------------------------------------------"""
+        if self.encodings is None:
+            self._create(dataset)
+            return
+
+        with netCDF4.Dataset(self.filename, 'a') as nc:
+            # Values are encoded by xarray below, so netCDF4 must not mask
+            # or scale them a second time
+            nc.set_auto_maskandscale(False)
+            start = len(nc.dimensions[self.dim])
+
+            for name, encoding in self.encodings.items():
+                variable = dataset[name].variable
+                variable = xr.Variable(variable.dims, variable.data, encoding=encoding)
+                encoded = xr.conventions.encode_cf_variable(variable, name=name)
+
+                index = tuple(
+                    slice(start, start + size) if dim == self.dim else slice(None)
+                    for dim, size in zip(encoded.dims, encoded.shape)
+                )
+                nc.variables[name][index] = encoded.values
+
+    def close(self):
+        """-------------------------------------------------------------------
+        Finish writing the file.  Blocks are written as they are appended,
+        so there is nothing left to do.
+        -------------------------------------------------------------------"""
+        pass
+
+    def _create(self, dataset: xr.Dataset):
+        dataset.encoding['unlimited_dims'] = {self.dim}
+        FileHandler.write(dataset, self.filename, self.config)
+
+        # Remember how each variable along the append dimension was encoded
+        with xr.open_dataset(self.filename) as written:
+            self.encodings = {}
+            for name, variable in written.variables.items():
+                if self.dim in variable.dims:
+                    self.encodings[name] = {
+                        key: value for key, value in variable.encoding.items() if key in VALUE_ENCODING_KEYS
+                    }
+
+
+def apply_encoding_profile(dataset: xr.Dataset, profile: Dict) -> xr.Dataset:
+    """-------------------------------------------------------------------
+    Set the netCDF encoding of each variable in the dataset from an
+    encoding profile, e.g.:
+
+        chunks:             # Chunk length of each dimension
+          time: 1024
+          distance: 720
+        zlib: true
+        complevel: 4
+        shuffle: true
+        pack:               # Variables to store as scaled integers
+          doppler:
+            dtype: int16
+            scale_factor: 0.002
+            add_offset: 0   # Optional, defaults to 0
+            _FillValue: -32768  # Optional, defaults to the dtype minimum
+
+    Chunks are clipped to the length of dimensions that are not unlimited.
+    Values of a packed variable that equal its _FillValue attribute are
+    stored as the packed _FillValue and read back as NaN.  So are values
+    outside the range of the packed type (e.g. a noisy gate past 65.5 m/s
+    for the doppler above), with a warning, so one bad value doesn't fail
+    the whole file.
+
+    Args:
+        dataset (xr.Dataset):   The dataset to encode.  It is modified in
+                                place.
+        profile (Dict):         The encoding profile.
+
+    Returns:
+        xr.Dataset: The dataset.
+    -------------------------------------------------------------------"""
+    chunks = profile.get('chunks', {})
+    unlimited_dims = dataset.encoding.get('unlimited_dims', ())
+    compression = {key: profile[key] for key in COMPRESSION_ENCODING_KEYS if key in profile}
+
+    for name, variable in dataset.variables.items():
+        if variable.ndim == 0 or variable.dtype.kind not in 'biuf':
+            continue
+
+        variable.encoding.update(compression)
+        if chunks:
+            variable.encoding['chunksizes'] = tuple(
+                chunks.get(dim, size) if dim in unlimited_dims else min(chunks.get(dim, size), size)
+                for dim, size in zip(variable.dims, variable.shape)
+            )
+
+    for name, packing in profile.get('pack', {}).items():
+        if name in dataset.variables:
+            _pack_variable(dataset, name, packing)
+
+    return dataset
+
+
+def _pack_variable(dataset: xr.Dataset, name: str, packing: Dict):
+    dtype = np.dtype(packing['dtype'])
+    scale_factor = packing['scale_factor']
+    add_offset = packing.get('add_offset', 0)
+    fill_value = packing.get('_FillValue', np.iinfo(dtype).min)
+
+    # The unpacked _FillValue is replaced by NaN, which xarray writes as
+    # the packed _FillValue
+    variable = dataset[name]
+    encoding = dict(variable.encoding)
+    unpacked_fill_value = variable.attrs.pop('_FillValue', None)
+    if unpacked_fill_value is not None:
+        variable = variable.where(variable != unpacked_fill_value)
+
+    # Values outside the range of the packed type would silently wrap, and
+    # values packed to the _FillValue would be read back as missing, so
+    # they are stored as missing
+    low, high = np.iinfo(dtype).min, np.iinfo(dtype).max
+    low, high = low + (fill_value == low), high - (fill_value == high)
+    with np.errstate(invalid='ignore'):
+        packed = np.round((variable.values - add_offset) / scale_factor)
+        out_of_range = (packed < low) | (packed > high)
+    if out_of_range.any():
+        logger.warning(f"Storing {np.count_nonzero(out_of_range)} values of {name} as missing because they are "
+                       f"outside the range of {dtype} with scale_factor {scale_factor} and add_offset {add_offset}")
+        variable = variable.where(~out_of_range)
+
+    # xarray reads packed variables back as the type of the scale and
+    # offset when it can hold them, e.g. int16 packed float32 values
+    if variable.dtype.kind == 'f':
+        scale_factor, add_offset = variable.dtype.type(scale_factor), variable.dtype.type(add_offset)
+
+    encoding.update(dtype=dtype, scale_factor=scale_factor, add_offset=add_offset, _FillValue=fill_value)
+    variable.encoding = encoding
+    dataset[name] = variable
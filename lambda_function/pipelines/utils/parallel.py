@@ -0,0 +1,192 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing.connection import wait
+from typing import Any, Callable, Iterable, Iterator, List, Tuple
+
+from pipelines.utils.log_helper import logger
+
+
+def get_max_workers() -> int:
+    """-------------------------------------------------------------------
+    Returns the number of worker processes to use.  Defaults to the number
+    of CPUs (the vCPUs allotted to the function when running in Lambda)
+    and can be overridden with the MAX_WORKERS environment variable.
+    -------------------------------------------------------------------"""
+    return int(os.environ.get('MAX_WORKERS', 0)) or os.cpu_count() or 1
+
+
+def create_process_pool(max_workers: int, initializer: Callable = None) -> ProcessPoolExecutor:
+    """-------------------------------------------------------------------
+    Create a process pool, or return None if worker processes can't be
+    used here.  AWS Lambda has no /dev/shm, so the semaphores that
+    multiprocessing pools rely on can't be created there.
+
+    Args:
+        max_workers (int):              The number of worker processes.
+        initializer (Callable, optional):   Called at the start of each
+                                            worker process. Defaults to
+                                            None.
+
+    Returns:
+        ProcessPoolExecutor: The pool, or None.
+    -------------------------------------------------------------------"""
+    try:
+        return ProcessPoolExecutor(max_workers=max_workers, initializer=initializer)
+    except (OSError, NotImplementedError) as e:
+        logger.warning(f'Process pools are not available, using worker processes with pipes: {e}')
+        return None
+
+
+def run_in_child(func: Callable, item: Any, initializer: Callable, connection):
+    try:
+        if initializer is not None:
+            initializer()
+        connection.send((True, func(item)))
+    except Exception as e:
+        connection.send((False, e))
+    finally:
+        connection.close()
+
+
+def iterate_with_pipes(func: Callable, items: List, max_workers: int,
+                       initializer: Callable = None) -> Iterator[Tuple[int, Any]]:
+    """-------------------------------------------------------------------
+    Call func on each item in its own worker process, running at most
+    max_workers at a time, and yield the index of each item and its result
+    as each call finishes.  Results are sent back through pipes, which
+    unlike the queues of a process pool don't need /dev/shm, so this works
+    in AWS Lambda.  If any call raises, the first exception is raised once
+    all of the workers have finished.
+
+    Args:
+        func (Callable):                    The function to call on each item.
+        items (List):                       The items to process.
+        max_workers (int):                  The maximum number of worker
+                                            processes.
+        initializer (Callable, optional):   Called at the start of each
+                                            worker process. Defaults to
+                                            None.
+
+    Yields:
+        Tuple[int, Any]: The index of an item and its result.
+    -------------------------------------------------------------------"""
+    errors = []
+    pending = list(enumerate(items))
+    running = {}
+
+    while pending or running:
+        while pending and len(running) < max_workers:
+            index, item = pending.pop(0)
+            receiver, sender = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(target=run_in_child, args=(func, item, initializer, sender))
+            process.start()
+            sender.close()
+            running[receiver] = (index, process)
+
+        for receiver in wait(list(running)):
+            index, process = running.pop(receiver)
+            try:
+                succeeded, result = receiver.recv()
+            except EOFError:
+                succeeded, result = False, RuntimeError(f'Worker process for item {index} exited unexpectedly')
+            receiver.close()
+            process.join()
+
+            if succeeded:
+                yield index, result
+            else:
+                errors.append(result)
+
+    if errors:
+        raise errors[0]
+
+
+def map_with_pipes(func: Callable, items: List, max_workers: int, initializer: Callable = None) -> List[Any]:
+    """-------------------------------------------------------------------
+    Same as iterate_with_pipes, but returns the results in the order of
+    the items once all of the workers have finished.
+
+    Returns:
+        List[Any]: The result for each item.
+    -------------------------------------------------------------------"""
+    results = [None] * len(items)
+    for index, result in iterate_with_pipes(func, items, max_workers, initializer):
+        results[index] = result
+    return results
+
+
+def iterate_in_processes(func: Callable, items: Iterable, max_workers: int = None,
+                         initializer: Callable = None) -> Iterator[Tuple[int, Any]]:
+    """-------------------------------------------------------------------
+    Call func on each item in worker processes and yield the index of each
+    item and its result as soon as each call finishes, so results can be
+    used while the other calls are still running.  Works like
+    map_in_processes otherwise.
+
+    Args:
+        func (Callable):            The function to call on each item.
+        items (Iterable):           The items to process.
+        max_workers (int, optional):    The maximum number of worker
+                                        processes. Defaults to
+                                        get_max_workers().
+        initializer (Callable, optional):   Called at the start of each
+                                            worker process, but not when
+                                            running serially. Defaults to
+                                            None.
+
+    Yields:
+        Tuple[int, Any]: The index of an item and its result.
+    -------------------------------------------------------------------"""
+    items = list(items)
+    max_workers = min(max_workers or get_max_workers(), len(items))
+    if max_workers <= 1:
+        for index, item in enumerate(items):
+            yield index, func(item)
+        return
+
+    executor = create_process_pool(max_workers, initializer)
+    if executor is None:
+        yield from iterate_with_pipes(func, items, max_workers, initializer)
+        return
+
+    with executor:
+        futures = {executor.submit(func, item): index for index, item in enumerate(items)}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+
+def map_in_processes(func: Callable, items: Iterable, max_workers: int = None,
+                     initializer: Callable = None) -> List[Any]:
+    """-------------------------------------------------------------------
+    Call func on each item in worker processes and return the results in
+    the order of the items.  Uses a process pool where one can be created
+    and map_with_pipes otherwise, and runs serially in this process when
+    there is only one item or one worker.  func, the items and the results
+    must be picklable.
+
+    Args:
+        func (Callable):            The function to call on each item.
+        items (Iterable):           The items to process.
+        max_workers (int, optional):    The maximum number of worker
+                                        processes. Defaults to
+                                        get_max_workers().
+        initializer (Callable, optional):   Called at the start of each
+                                            worker process, but not when
+                                            running serially. Defaults to
+                                            None.
+
+    Returns:
+        List[Any]: The result for each item.
+    -------------------------------------------------------------------"""
+    items = list(items)
+    max_workers = min(max_workers or get_max_workers(), len(items))
+    if max_workers <= 1:
+        return [func(item) for item in items]
+
+    executor = create_process_pool(max_workers, initializer)
+    if executor is None:
+        return map_with_pipes(func, items, max_workers, initializer)
+
+    with executor:
+        return list(executor.map(func, items))
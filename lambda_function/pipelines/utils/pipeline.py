@@ -1,18 +1,253 @@
+import os
+import xarray as xr
 from tsdat import IngestPipeline
+from tsdat.qc import QualityManagement
 from tsdat.utils import DSUtil
 from tsdat.io import FileHandler, S3Path
-from typing import Union, List
+from tsdat.io.storage import DisposableStorageTempFileList
+from contextlib import ExitStack, contextmanager
+from typing import Dict, Iterator, Optional, Tuple, Union, List
+
+from pipelines.utils.aggregation import TimeAggregator
+from pipelines.utils.compression import is_compressed
+from pipelines.utils.downsample import downsample
+from pipelines.utils.instrumentation import stage
+from pipelines.utils.qc import QualityEngine
+from pipelines.utils.remote import can_open_remotely, open_s3_file, open_zip_store
+from pipelines.utils.rollup import DailyRollup
+from pipelines.utils.selection import open_lazily, select
 
 class A2ePipeline(IngestPipeline):
 
+    # The most points along each dimension that the plots can show, e.g.
+    # their size in pixels.  If set, run_plots downsamples datasets to this
+    # size before plotting them.
+    plot_sizes: Dict[str, int] = None
+
+    # The variables and the coordinate ranges (see
+    # pipelines.utils.selection.select) that the plots use.  If set,
+    # run_plots only reads these from the processed files.
+    plot_variables: List[str] = None
+    plot_ranges: Dict[str, Tuple[Optional[float], Optional[float]]] = None
+
+    # If set, QC is applied by pipelines.utils.qc.QualityEngine, which has
+    # the same results as tsdat's QualityManagement for tsdat's checkers and
+    # handlers in fewer passes over the data.  Otherwise tsdat's
+    # QualityManagement is used.
+    use_quality_engine: bool = False
+
+    def run(self, filepath: Union[str, List[str]]) -> None:
+        """Runs the IngestPipeline from start to finish, timing each stage
+        with pipelines.utils.instrumentation.  QC is applied by
+        pipelines.utils.qc.QualityEngine if use_quality_engine is set, and
+        by tsdat's QualityManagement otherwise.
+
+        :param filepath:
+            The path or list of paths to the file(s) to run the pipeline on.
+        :type filepath: Union[str, List[str]]
+        """
+        with self.extract_files(filepath) as file_paths:
+            with stage('read'):
+                raw_dataset_mapping = self.read_and_persist_raw_files(file_paths)
+            with stage('customize_raw'):
+                raw_dataset_mapping = self.hook_customize_raw_datasets(raw_dataset_mapping)
+            with stage('standardize'):
+                dataset = self.standardize_dataset(raw_dataset_mapping)
+            with stage('customize'):
+                dataset = self.hook_customize_dataset(dataset, raw_dataset_mapping)
+            with stage('qc'):
+                previous_dataset = self.get_previous_dataset(dataset)
+                if self.use_quality_engine:
+                    dataset = QualityEngine(self.config).run(dataset, previous_dataset)
+                else:
+                    dataset = QualityManagement.run(dataset, self.config, previous_dataset)
+            aggregator = self.create_aggregator()
+            if aggregator is not None:
+                with stage('aggregate'):
+                    aggregator.add(dataset)
+            with stage('finalize'):
+                dataset = self.hook_finalize_dataset(dataset)
+            with stage('store'):
+                dataset = self.store_and_reopen_dataset(dataset)
+            if aggregator is not None:
+                with stage('store_aggregate'):
+                    self.store_aggregate(aggregator)
+            rollup = self.create_rollup()
+            if rollup is not None:
+                with stage('rollup'):
+                    rollup.update(dataset)
+            with stage('plots'):
+                self.hook_generate_and_persist_plots(dataset)
+
+    @contextmanager
+    def extract_files(self, filepath: Union[str, List[str]]) -> Iterator[List[str]]:
+        """Extracts the input files like the storage's extract_files, except
+        that compressed files and archives whose input FileHandler reads
+        them as streams (its `reads_archives` is set, see
+        pipelines.awa_halo_ingest.filehandlers.HplHandler) are passed on
+        whole instead of being extracted to the temp folder.  Files keep
+        their order.
+
+        :param filepath: The path or list of paths to the input file(s).
+        :type filepath: Union[str, List[str]]
+        :return: The paths of the files to read.
+        :rtype: Iterator[List[str]]
+        """
+        files = [filepath] if isinstance(filepath, str) else filepath
+        remove_input_files = self.storage.remove_input_files
+        with ExitStack() as stack:
+            file_paths = []
+            for file in files:
+                if is_compressed(str(file)) and \
+                        getattr(FileHandler._get_handler(os.path.basename(str(file))), 'reads_archives', False):
+                    disposable_files = [file] if remove_input_files else []
+                    extracted = DisposableStorageTempFileList([file], self.storage.tmp,
+                                                              disposable_files=disposable_files)
+                else:
+                    extracted = self.storage.tmp.extract_files(file)
+                file_paths.extend(stack.enter_context(extracted))
+            yield file_paths
+
+    def store_and_reopen_dataset(self, dataset: xr.Dataset) -> xr.Dataset:
+        """Same as IngestPipeline.store_and_reopen_dataset, with writing the
+        outputs and reopening the first one timed separately.
+
+        :param dataset: The dataset to store.
+        :type dataset: xr.Dataset
+        :return: The dataset after it has been saved to disk and reopened.
+        :rtype: xr.Dataset
+        """
+        with stage('save'):
+            saved_paths = self.storage.save(dataset)
+
+        with stage('reopen'), self.storage.tmp.fetch(saved_paths[0]) as tmp_path:
+            return FileHandler.read(tmp_path)
+
+    def create_aggregator(self) -> Optional[TimeAggregator]:
+        """Creates the TimeAggregator for the `aggregation` section of the
+        pipeline config, which computes the statistics of the QC'd data over
+        intervals of time as an additional, smaller output, e.g.:
+
+        .. code-block:: yaml
+
+            aggregation:
+              interval: 10min
+              variables: [doppler, intensity]
+
+        :return: The aggregator, or None if there is no aggregation section.
+        :rtype: Optional[TimeAggregator]
+        """
+        definition = self.config.pipeline_definition.dictionary.get('aggregation')
+        if not definition:
+            return None
+        return TimeAggregator.from_config(definition)
+
+    def get_derived_datastream_name(self, temporal: str, data_level: str = None) -> str:
+        """Gets the name of a datastream derived from the output datastream,
+        with the `temporal` part of its name replaced, e.g.
+        nwtc.z01-lidar-10min.a1.
+
+        :param temporal: The temporal part of the name, e.g. 10min.
+        :type temporal: str
+        :param data_level: The data level, defaults to the output data level.
+        :type data_level: str, optional
+        :return: The datastream name.
+        :rtype: str
+        """
+        pipeline = self.config.pipeline_definition
+        name = f"{pipeline.location_id}.{pipeline.dataset_name}"
+        if pipeline.qualifier:
+            name += f"-{pipeline.qualifier}"
+        return f"{name}-{temporal}.{data_level or pipeline.output_data_level}"
+
+    def get_aggregate_datastream_name(self) -> str:
+        """Gets the name of the aggregated datastream, which is the output
+        datastream with the `temporal` part of its name set to the
+        aggregation interval, e.g. nwtc.z01-lidar-10min.a1.  The
+        aggregation section may set its own `temporal` and `data_level`.
+
+        :return: The datastream name.
+        :rtype: str
+        """
+        definition = self.config.pipeline_definition.dictionary['aggregation']
+        return self.get_derived_datastream_name(definition.get('temporal', definition['interval']),
+                                                definition.get('data_level'))
+
+    def store_aggregate(self, aggregator: TimeAggregator) -> List:
+        """Saves the statistics computed by an aggregator as the aggregated
+        datastream, in every output format.
+
+        :param aggregator: The aggregator the processed data was added to.
+        :type aggregator: TimeAggregator
+        :return: The paths the files were saved to, or an empty list if no
+            data was added.
+        :rtype: List
+        """
+        dataset = aggregator.result()
+        if dataset is None:
+            return []
+        dataset.attrs['datastream_name'] = self.get_aggregate_datastream_name()
+        return self.storage.save(dataset)
+
+    def create_rollup(self) -> Optional[DailyRollup]:
+        """Creates the DailyRollup that adds each processed file to a zarr
+        store of its day, if the pipeline config sets `daily_rollup`.  The
+        stores are the daily datastream, e.g. nwtc.z01-lidar-daily.a1, and
+        keep the statistics of the `aggregation` section for the whole day.
+
+        :return: The rollup, or None if daily_rollup isn't set.
+        :rtype: Optional[DailyRollup]
+        """
+        definition = self.config.pipeline_definition.dictionary
+        if not definition.get('daily_rollup'):
+            return None
+        return DailyRollup(self.storage, self.get_derived_datastream_name('daily'), definition.get('aggregation'))
+
     def run_plots(self, files: Union[List[S3Path], str]):
         """Runs the 'hook_generate_and_persist_plots()` function on the 
-        provided file or list of files. 
+        provided file or list of files.  Each file is opened lazily and only
+        the plot_variables and plot_ranges are read from it.  Zarr zip
+        stores in S3 are read with range requests rather than fetched.
 
         :param files: The files to read in and produce plots for.
         :type files: Union[List[S3Path], str]
         """            
         for _file in files:
-            with self.storage.tmp.fetch(_file) as tmp_file:
-                ds = FileHandler.read(tmp_file)
-                self.hook_generate_and_persist_plots(ds)
+            with ExitStack() as stack:
+                if can_open_remotely(_file):
+                    with stage('open'):
+                        fileobj = stack.enter_context(open_s3_file(self.storage.s3_client, _file))
+                        ds = stack.enter_context(open_zip_store(fileobj))
+                else:
+                    with stage('fetch'):
+                        disposable_file = self.storage.tmp.fetch(_file)
+                    tmp_file = stack.enter_context(disposable_file)
+                    with stage('open'):
+                        ds = stack.enter_context(open_lazily(tmp_file))
+                self.plot_dataset(ds)
+
+    def select_plot_data(self, ds: xr.Dataset) -> xr.Dataset:
+        """Selects the plot_variables and plot_ranges from a dataset.
+
+        :param ds: The dataset.
+        :type ds: xr.Dataset
+        :return: The data the plots use, or the dataset if neither is set.
+        :rtype: xr.Dataset
+        """
+        return select(ds, self.plot_variables, self.plot_ranges)
+
+    def plot_dataset(self, ds: xr.Dataset):
+        """Selects the data the plots use and downsamples it to plot_sizes,
+        if set, and then runs the `hook_generate_and_persist_plots()`
+        function on it.
+
+        :param ds: The dataset to plot.
+        :type ds: xr.Dataset
+        """
+        with stage('select'):
+            ds = self.select_plot_data(ds)
+        if self.plot_sizes:
+            with stage('downsample'):
+                ds = downsample(ds, self.plot_sizes)
+        with stage('plots'):
+            self.hook_generate_and_persist_plots(ds)
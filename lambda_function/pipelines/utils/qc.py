@@ -0,0 +1,380 @@
+import importlib
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import xarray as xr
+from tsdat import Config
+from tsdat.config import QualityManagerDefinition
+from tsdat.constants import VARS
+from tsdat.exceptions import QCError
+from tsdat.qc import QualityChecker, QualityHandler
+from tsdat.utils import DSUtil
+
+# The number of values differenced at once by check_valid_delta, which
+# bounds the size of its temporary arrays
+DELTA_BLOCK_SIZE = 2 ** 20
+
+
+class VectorizedChecker(QualityChecker):
+    """-------------------------------------------------------------------
+    A QualityChecker that QualityEngine can run with the other checks of
+    the same variable in one pass.  Subclasses implement run() as for any
+    QualityChecker, with vectorized numpy operations.
+
+    Set local to False for checks that read other variables of the
+    dataset, so the engine runs them in the order of the config file
+    rather than with the checks of their own variable.
+    -------------------------------------------------------------------"""
+    local = True
+
+
+class VectorizedHandler(QualityHandler):
+    """-------------------------------------------------------------------
+    A QualityHandler that only changes the variable it is run on and its
+    qc variable, so QualityEngine can run it with the other checks of the
+    same variable in one pass.
+    -------------------------------------------------------------------"""
+    local = True
+
+
+def get_values(ds: xr.Dataset, variable_name: str) -> np.ndarray:
+    # The variable's values, loaded into memory and safe to change in place
+    variable = ds[variable_name].variable
+    variable.load()
+    values = variable.data
+    if not values.flags.writeable:
+        values = values.copy()
+        variable.data = values
+    return values
+
+
+def get_previous_row(variable_name: str, dtype: np.dtype, previous_data: xr.Dataset) -> Optional[np.ndarray]:
+    # The last row of the variable in the previous file, as tsdat's checks
+    # take it
+    if previous_data is None or variable_name not in previous_data:
+        return None
+    return np.asarray(previous_data[variable_name].data[-1], dtype=dtype)
+
+
+def check_missing(ds: xr.Dataset, variable_name: str, params: Dict, previous_data: xr.Dataset,
+                  results: np.ndarray, scratch: np.ndarray) -> bool:
+    """-------------------------------------------------------------------
+    tsdat's CheckMissing, with values outside valid_range replaced with the
+    _FillValue in place and no temporary arrays.
+    -------------------------------------------------------------------"""
+    # Dimension coordinates can't be changed in place, so they are only read
+    is_index = variable_name in ds.indexes
+    values = ds[variable_name].values if is_index else get_values(ds, variable_name)
+    if values.dtype.type == np.datetime64:
+        np.isnat(values, out=results)
+        return True
+    if values.dtype.kind not in 'iuf':
+        return None
+
+    fill_value = DSUtil.get_fill_value(ds, variable_name)
+    if fill_value is None:
+        fill_value = -9999
+    fill_value = np.array(fill_value, dtype=values.dtype.type)
+
+    valid_min = DSUtil.get_valid_min(ds, variable_name)
+    valid_max = DSUtil.get_valid_max(ds, variable_name)
+    if valid_min is not None and valid_max is not None:
+        np.less(values, valid_min, out=scratch)
+        np.greater(values, valid_max, out=results)
+        scratch |= results
+        if scratch.any():
+            if is_index:
+                return None
+            np.copyto(values, fill_value, where=scratch)
+
+    np.equal(values, fill_value, out=results)
+    if values.dtype.type in (float, np.float16, np.float32, np.float64):
+        np.isnan(values, out=scratch)
+        results |= scratch
+    return True
+
+
+def check_valid_delta(ds: xr.Dataset, variable_name: str, params: Dict, previous_data: xr.Dataset,
+                      results: np.ndarray, scratch: np.ndarray) -> Optional[bool]:
+    """-------------------------------------------------------------------
+    tsdat's CheckValidDelta, with the differences computed a block of rows
+    at a time instead of on a copy of the whole variable.
+    -------------------------------------------------------------------"""
+    variable = ds[variable_name]
+    valid_delta = variable.attrs.get('valid_delta', None)
+    dim = params.get('dim', None) or (variable.dims[0] if variable.dims else None)
+    if valid_delta is None or dim is None:
+        return False
+
+    values = ds[variable_name].values
+    axis = variable.get_axis_num(dim)
+    previous_row = get_previous_row(variable_name, values.dtype, previous_data)
+    if values.dtype.kind not in 'iuf' or (axis != 0 and previous_row is not None) or values.size == 0:
+        return None
+
+    # Difference along the first axis of views of the arrays
+    values, rows = np.moveaxis(values, axis, 0), np.moveaxis(results, axis, 0)
+    if previous_row is None:
+        rows[0] = False
+    else:
+        np.greater(np.absolute(values[0] - previous_row), valid_delta, out=rows[0])
+
+    block = max(1, DELTA_BLOCK_SIZE // max(1, values[0].size))
+    for start in range(1, len(values), block):
+        stop = min(start + block, len(values))
+        delta = np.subtract(values[start:stop], values[start - 1:stop - 1])
+        np.absolute(delta, out=delta)
+        np.greater(delta, valid_delta, out=rows[start:stop])
+    return True
+
+
+def remove_failed_values(ds: xr.Dataset, variable_name: str, params: Dict, definition: QualityManagerDefinition,
+                         results: np.ndarray) -> Optional[bool]:
+    """-------------------------------------------------------------------
+    tsdat's RemoveFailedValues, replacing the failed values in place.
+    -------------------------------------------------------------------"""
+    if not results.any():
+        return True
+
+    fill_value = DSUtil.get_fill_value(ds, variable_name)
+    if fill_value is None or variable_name in ds.indexes:
+        return None
+
+    values = get_values(ds, variable_name)
+    np.copyto(values, np.array(fill_value).astype(values.dtype), where=results)
+
+    correction = params.get('correction', None)
+    if correction is not None:
+        DSUtil.record_corrections_applied(ds, variable_name, correction)
+    return True
+
+
+def record_quality_results(ds: xr.Dataset, variable_name: str, params: Dict, definition: QualityManagerDefinition,
+                           results: np.ndarray) -> Optional[bool]:
+    """-------------------------------------------------------------------
+    tsdat's RecordQualityResults, setting the test's bit of the qc variable
+    in place.  The qc variable and its attributes are the same as ACT's
+    qcfilter.add_test makes.
+    -------------------------------------------------------------------"""
+    bit, meaning, assessment = params.get('bit'), params.get('meaning'), params.get('assessment')
+    if bit is None or meaning is None or assessment is None:
+        return None
+
+    qc_variable_name = ds.qcfilter.check_for_ancillary_qc(variable_name)
+    qc_values = get_values(ds, qc_variable_name)
+    mask = 1 << bit - 1
+    if qc_values.dtype.kind not in 'iu' or np.iinfo(qc_values.dtype).max < mask:
+        return None
+    np.bitwise_or(qc_values, qc_values.dtype.type(mask), out=qc_values, where=results)
+
+    attrs = ds[qc_variable_name].attrs
+    flag_masks = np.array(attrs['flag_masks'])
+    mask_dtype = flag_masks.dtype.type if np.issubdtype(flag_masks.dtype, np.integer) else np.uint32
+    if np.iinfo(mask_dtype).max - mask <= -1:
+        mask_dtype = LARGER_MASK_DTYPES.get(mask_dtype, mask_dtype)
+    attrs['flag_masks'] = list(np.append(flag_masks.astype(mask_dtype), np.array(mask, dtype=mask_dtype)))
+    attrs['flag_meanings'].append(meaning)
+    attrs['flag_assessments'].append(assessment.capitalize())
+    return True
+
+
+# The flag_masks dtype that ACT changes to when a bit doesn't fit
+LARGER_MASK_DTYPES = {
+    np.int8: np.uint16, np.uint8: np.uint16,
+    np.int16: np.uint32, np.uint16: np.uint32,
+    np.int32: np.uint64, np.uint32: np.uint64,
+}
+
+
+def fail_pipeline(ds: xr.Dataset, variable_name: str, params: Dict, definition: QualityManagerDefinition,
+                  results: np.ndarray) -> bool:
+    # tsdat's FailPipeline
+    if results.any():
+        raise QCError(f"Quality Manager {definition.name} failed for variable {variable_name}")
+    return True
+
+
+# Vectorized versions of tsdat's checkers and handlers, keyed by the
+# classnames used in config files.  Each returns None if it can't handle
+# the variable, which is then passed to the tsdat class.
+CHECKERS: Dict[str, Callable] = {
+    'tsdat.qc.checkers.CheckMissing': check_missing,
+    'tsdat.qc.checkers.CheckValidDelta': check_valid_delta,
+}
+HANDLERS: Dict[str, Callable] = {
+    'tsdat.qc.handlers.RemoveFailedValues': remove_failed_values,
+    'tsdat.qc.handlers.RecordQualityResults': record_quality_results,
+    'tsdat.qc.handlers.FailPipeline': fail_pipeline,
+}
+
+
+def get_class(classname: str) -> type:
+    module_name, class_name = classname.rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+class QualityStep:
+    """-------------------------------------------------------------------
+    One quality manager from the config file: a checker and the handlers
+    that run on its results.  Uses the vectorized versions of tsdat's
+    checkers and handlers where there are any, and instances of the
+    configured classes otherwise.  As in tsdat's QualityManager, a checker
+    instance is shared by the variables of a run and a new handler
+    instance is made for each variable.
+
+    Args:
+        definition (QualityManagerDefinition):  The quality manager.
+    -------------------------------------------------------------------"""
+    def __init__(self, definition: QualityManagerDefinition):
+        self.definition = definition
+        self.checker = definition.checker
+        self.handlers = definition.handlers or []
+
+        classes = [self.checker['classname']] + [handler['classname'] for handler in self.handlers]
+        self.local = all(classname in CHECKERS or classname in HANDLERS or
+                         getattr(get_class(classname), 'local', False) for classname in classes)
+
+        # The instance of the configured checker class for the current run,
+        # made when first needed
+        self.checker_instance = None
+
+    def create_instance(self, description: Dict, ds: xr.Dataset, previous_data: xr.Dataset):
+        class_ = get_class(description['classname'])
+        return class_(ds, previous_data, self.definition, description.get('parameters', {}))
+
+    def get_checker(self, ds: xr.Dataset, previous_data: xr.Dataset) -> QualityChecker:
+        if self.checker_instance is None:
+            self.checker_instance = self.create_instance(self.checker, ds, previous_data)
+        self.checker_instance.ds = ds
+        return self.checker_instance
+
+    def reset(self):
+        # Forget the checker of the last run, which holds its data
+        self.checker_instance = None
+
+    def get_variable_names(self, ds: xr.Dataset) -> List[str]:
+        # The same variables as tsdat's QualityManager, without changing the
+        # definition
+        variable_names = list(self.definition.variables)
+        keywords = [name.upper() for name in variable_names]
+
+        if VARS.COORDS in keywords:
+            variable_names.remove(VARS.COORDS)
+            variable_names.extend(DSUtil.get_coordinate_variable_names(ds))
+        if VARS.DATA_VARS in keywords:
+            variable_names.remove(VARS.DATA_VARS)
+            variable_names.extend(DSUtil.get_non_qc_variable_names(ds))
+        if VARS.ALL in keywords:
+            variable_names.remove(VARS.ALL)
+            variable_names.extend(DSUtil.get_coordinate_variable_names(ds))
+            variable_names.extend(DSUtil.get_non_qc_variable_names(ds))
+
+        variable_names = list(dict.fromkeys(variable_names))
+        for exclude in self.definition.exclude:
+            variable_names.remove(exclude)
+        return variable_names
+
+    def run(self, ds: xr.Dataset, variable_name: str, previous_data: xr.Dataset,
+            buffers: Tuple[np.ndarray, np.ndarray]) -> xr.Dataset:
+        """-------------------------------------------------------------------
+        Check a variable and run the handlers on the results.
+
+        Args:
+            ds (xr.Dataset):            The dataset.
+            variable_name (str):        The variable.
+            previous_data (xr.Dataset): The end of the previous file, or None.
+            buffers (Tuple[np.ndarray, np.ndarray]):
+                Boolean arrays the shape of the variable, for the results
+                and for temporary values, which are overwritten.
+
+        Returns:
+            xr.Dataset: The dataset, which handlers may replace.
+        -------------------------------------------------------------------"""
+        results, scratch = buffers
+        check = CHECKERS.get(self.checker['classname'])
+        performed = None
+        if check is not None:
+            performed = check(ds, variable_name, self.checker.get('parameters', {}), previous_data, results, scratch)
+        if performed is None:
+            checker = self.get_checker(ds, previous_data)
+            checked = checker.run(variable_name)
+            performed = checked is not None
+            if performed:
+                results = checked
+        if not performed:
+            results.fill(False)
+
+        for description in self.handlers:
+            handle = HANDLERS.get(description['classname'])
+            if handle is None or handle(ds, variable_name, description.get('parameters', {}), self.definition,
+                                        results) is None:
+                handler = self.create_instance(description, ds, previous_data)
+                handler.run(variable_name, results)
+                ds = handler.ds
+        return ds
+
+
+class QualityEngine:
+    """-------------------------------------------------------------------
+    Applies the quality managers in a pipeline config file to a dataset,
+    with the same results as tsdat's QualityManagement.
+
+    tsdat runs each quality manager over all of its variables in turn, so
+    the large time x range arrays are read once per manager, and each check
+    and handler allocates full-size arrays.  This engine groups consecutive
+    managers whose checks and handlers only use the variable they run on,
+    and runs all of the checks of each variable in those managers one after
+    the other, while its values are in cache.  tsdat's CheckMissing,
+    CheckValidDelta, RemoveFailedValues, RecordQualityResults and
+    FailPipeline are replaced by vectorized versions that change the
+    values and set the qc bits in place, with the results written to two
+    reused boolean buffers.  Other checkers and handlers run as configured,
+    in the order of the config file.
+
+    Args:
+        config (Config):    The pipeline config.
+    -------------------------------------------------------------------"""
+    def __init__(self, config: Config):
+        self.config = config
+        steps = [QualityStep(definition) for definition in config.quality_managers.values()]
+
+        # Consecutive local steps are run together, and others on their own
+        self.groups: List[List[QualityStep]] = []
+        for step in steps:
+            if step.local and self.groups and self.groups[-1][-1].local:
+                self.groups[-1].append(step)
+            else:
+                self.groups.append([step])
+
+    def run(self, ds: xr.Dataset, previous_data: xr.Dataset) -> xr.Dataset:
+        """-------------------------------------------------------------------
+        Apply the quality managers to a dataset.
+
+        Args:
+            ds (xr.Dataset):            The dataset, which is changed in
+                                        place.
+            previous_data (xr.Dataset): The end of the previous file, or None.
+
+        Returns:
+            xr.Dataset: The dataset with QC applied.
+        -------------------------------------------------------------------"""
+        buffers = {}
+        try:
+            for group in self.groups:
+                variable_steps = OrderedDict()
+                for step in group:
+                    for variable_name in step.get_variable_names(ds):
+                        variable_steps.setdefault(variable_name, []).append(step)
+
+                for variable_name, steps in variable_steps.items():
+                    for step in steps:
+                        shape = ds[variable_name].shape
+                        if shape not in buffers:
+                            buffers[shape] = (np.empty(shape, dtype=bool), np.empty(shape, dtype=bool))
+                        ds = step.run(ds, variable_name, previous_data, buffers[shape])
+        finally:
+            for group in self.groups:
+                for step in group:
+                    step.reset()
+        return ds
@@ -0,0 +1,172 @@
+import io
+import zipfile
+from collections import OrderedDict
+from collections.abc import Mapping
+from typing import Callable, Iterator
+
+import xarray as xr
+import zarr
+from tsdat.io import S3Path
+
+from pipelines.utils.zarr_handler import is_zarr_store, is_zip_store
+
+
+class RangeFile(io.RawIOBase):
+    """-------------------------------------------------------------------
+    A read-only, seekable file whose bytes are fetched on demand in blocks,
+    e.g. with HTTP range requests, so reading part of a large remote file
+    only transfers the blocks around that part.  The most recently used
+    blocks are cached.
+
+    Args:
+        read_range (Callable[[int, int], bytes]):   Returns the bytes from
+                                                    a start offset up to
+                                                    an end offset.
+        size (int):                     The size of the file in bytes.
+        block_size (int, optional):     The number of bytes fetched at once.
+                                        Defaults to 256 KiB.
+        cached_blocks (int, optional):  The number of blocks kept. Defaults
+                                        to 16.
+    -------------------------------------------------------------------"""
+    def __init__(self, read_range: Callable[[int, int], bytes], size: int, block_size: int = 2 ** 18,
+                 cached_blocks: int = 16):
+        super().__init__()
+        self.read_range = read_range
+        self.size = size
+        self.block_size = block_size
+        self.cached_blocks = cached_blocks
+        self.blocks = OrderedDict()
+        self.position = 0
+        self.num_requests = 0
+        self.num_bytes = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError(f'Negative seek position {offset}')
+        self.position = offset
+        return self.position
+
+    def get_block(self, index: int) -> bytes:
+        block = self.blocks.get(index)
+        if block is None:
+            start = index * self.block_size
+            block = self.read_range(start, min(start + self.block_size, self.size))
+            self.num_requests += 1
+            self.num_bytes += len(block)
+            self.blocks[index] = block
+            if len(self.blocks) > self.cached_blocks:
+                self.blocks.popitem(last=False)
+        else:
+            self.blocks.move_to_end(index)
+        return block
+
+    def read(self, size: int = -1) -> bytes:
+        end = self.size if size is None or size < 0 else min(self.position + size, self.size)
+        if end <= self.position:
+            return b''
+
+        # Reads larger than the cache are fetched in one request
+        first, last = self.position // self.block_size, (end - 1) // self.block_size
+        if last - first >= self.cached_blocks:
+            data = self.read_range(self.position, end)
+            self.num_requests += 1
+            self.num_bytes += len(data)
+        else:
+            data = b''.join(self.get_block(index) for index in range(first, last + 1))
+            data = data[self.position - first * self.block_size:end - first * self.block_size]
+
+        self.position = end
+        return data
+
+    def readinto(self, buffer) -> int:
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+class ZipMapping(Mapping):
+    """-------------------------------------------------------------------
+    A read-only mapping of the members of a zip file object, e.g. a
+    RangeFile, to their contents, which only reads the zip's directory and
+    the members that are looked up.  Used as a zarr store.
+
+    Args:
+        fileobj (io.IOBase):    The zip file.
+    -------------------------------------------------------------------"""
+    def __init__(self, fileobj: io.IOBase):
+        self.zip_file = zipfile.ZipFile(fileobj)
+        self.names = {info.filename for info in self.zip_file.infolist() if not info.is_dir()}
+
+    def __getitem__(self, key: str) -> bytes:
+        if key not in self.names:
+            raise KeyError(key)
+        return self.zip_file.read(key)
+
+    def __contains__(self, key) -> bool:
+        return key in self.names
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.names)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def close(self):
+        self.zip_file.close()
+
+
+def can_open_remotely(filepath: str) -> bool:
+    # Zarr zip stores on S3 can be read with range requests.  Other files
+    # (e.g. netCDF) are fetched first.
+    return isinstance(filepath, S3Path) and is_zarr_store(filepath) and is_zip_store(filepath)
+
+
+def open_s3_file(s3_client, filepath: S3Path, **kwargs) -> RangeFile:
+    """-------------------------------------------------------------------
+    Open an S3 object as a RangeFile, which fetches only the byte ranges
+    that are read.
+
+    Args:
+        s3_client:          The boto3 S3 client.
+        filepath (S3Path):  The S3 object.
+        **kwargs:           Passed to RangeFile.
+
+    Returns:
+        RangeFile: The file.
+    -------------------------------------------------------------------"""
+    bucket, key = filepath.bucket_name, filepath.bucket_path
+
+    def read_range(start: int, end: int) -> bytes:
+        response = s3_client.get_object(Bucket=bucket, Key=key, Range=f'bytes={start}-{end - 1}')
+        return response['Body'].read()
+
+    size = s3_client.head_object(Bucket=bucket, Key=key)['ContentLength']
+    return RangeFile(read_range, size, **kwargs)
+
+
+def open_zip_store(fileobj: io.IOBase) -> xr.Dataset:
+    """-------------------------------------------------------------------
+    Lazily open a zarr zip store from a file object.  Only the zip's
+    directory, the consolidated metadata and the chunks of the variables
+    and slices that are used are read.
+
+    Args:
+        fileobj (io.IOBase):    The zip store, e.g. a RangeFile.
+
+    Returns:
+        xr.Dataset: The lazily loaded dataset.
+    -------------------------------------------------------------------"""
+    return xr.open_zarr(zarr.storage.KVStore(ZipMapping(fileobj)), chunks=None)
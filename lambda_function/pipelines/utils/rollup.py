@@ -0,0 +1,456 @@
+import datetime
+import json
+import os
+import posixpath
+import time
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import xarray as xr
+import zarr
+
+from pipelines.utils.aggregation import TimeAggregator
+from pipelines.utils.log_helper import logger
+from pipelines.utils.netcdf import VALUE_ENCODING_KEYS
+from pipelines.utils.zarr_handler import ZarrHandler
+
+# Keys of the daily store that aren't part of the zarr hierarchy
+MANIFEST_KEY = 'manifest.json'
+LOCK_KEY = 'rollup.lock'
+
+# The group of the daily store that holds the aggregated statistics
+AGGREGATE_GROUP = 'aggregate'
+
+# A lock older than this was left by a run that died, e.g. a Lambda
+# function that timed out, which can run for at most 15 minutes
+LOCK_TIMEOUT = 900
+
+ONE_DAY = np.timedelta64(1, 'D')
+
+
+class S3Store(MutableMapping):
+    """-------------------------------------------------------------------
+    A zarr store of one S3 object per key under a prefix, so updating a
+    store only uploads the chunks that changed.
+
+    Args:
+        s3_client:      The boto3 S3 client.
+        bucket (str):   The bucket of the store.
+        prefix (str):   The key of the store, e.g. root/nwtc/.../x.zarr
+    -------------------------------------------------------------------"""
+    def __init__(self, s3_client, bucket: str, prefix: str):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix.rstrip('/')
+
+    def get_key(self, key: str) -> str:
+        return f'{self.prefix}/{key}'
+
+    def __getitem__(self, key: str) -> bytes:
+        try:
+            return self.s3_client.get_object(Bucket=self.bucket, Key=self.get_key(key))['Body'].read()
+        except self.s3_client.exceptions.NoSuchKey:
+            raise KeyError(key)
+
+    def __setitem__(self, key: str, value):
+        self.s3_client.put_object(Bucket=self.bucket, Key=self.get_key(key), Body=bytes(value))
+
+    def __delitem__(self, key: str):
+        if key not in self:
+            raise KeyError(key)
+        self.s3_client.delete_object(Bucket=self.bucket, Key=self.get_key(key))
+
+    def __contains__(self, key) -> bool:
+        response = self.s3_client.list_objects_v2(Bucket=self.bucket, Prefix=self.get_key(key), MaxKeys=1)
+        return any(item['Key'] == self.get_key(key) for item in response.get('Contents', []))
+
+    def __iter__(self) -> Iterator[str]:
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=f'{self.prefix}/'):
+            for item in page.get('Contents', []):
+                yield item['Key'][len(self.prefix) + 1:]
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def create_exclusive(self, key: str, value: bytes) -> bool:
+        # Create an object only if it doesn't exist, with an S3 conditional
+        # write (needs botocore 1.35 or later)
+        from botocore.exceptions import ClientError
+        try:
+            self.s3_client.put_object(Bucket=self.bucket, Key=self.get_key(key), Body=value, IfNoneMatch='*')
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                return False
+            raise
+        return True
+
+
+class LocalStore(zarr.DirectoryStore):
+    """-------------------------------------------------------------------
+    A zarr directory store with the same create_exclusive() as S3Store.
+    -------------------------------------------------------------------"""
+    def create_exclusive(self, key: str, value: bytes) -> bool:
+        os.makedirs(self.path, exist_ok=True)
+        try:
+            fd = os.open(os.path.join(self.path, key), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'wb') as f:
+            f.write(value)
+        return True
+
+
+def open_store(storage, path: str) -> MutableMapping:
+    """-------------------------------------------------------------------
+    Open the zarr store at a path under the root of a pipeline's storage:
+    an S3Store for storages in S3 (e.g. AwsStorage), and a LocalStore
+    under the root_dir of other storages (e.g. FilesystemStorage).
+
+    Args:
+        storage (DatastreamStorage):    The storage.
+        path (str):                     The path of the store in the root.
+
+    Returns:
+        MutableMapping: The store.
+    -------------------------------------------------------------------"""
+    if hasattr(storage, 's3_client'):
+        root = storage.root
+        return S3Store(storage.s3_client, root.bucket_name, posixpath.join(root.bucket_path, path))
+    return LocalStore(os.path.join(storage.parameters['root_dir'], path))
+
+
+@contextmanager
+def lock_store(store: MutableMapping, timeout: float = LOCK_TIMEOUT, poll_interval: float = 1,
+               stale_after: float = LOCK_TIMEOUT):
+    """-------------------------------------------------------------------
+    Hold the lock of a store, so runs that update it at the same time
+    (e.g. two hourly files that arrive together, or backfill workers) take
+    turns.  A lock older than stale_after, left by a run that died, is
+    taken over.
+
+    Args:
+        store (MutableMapping):         An S3Store or LocalStore.
+        timeout (float, optional):      The seconds to wait for the lock.
+                                        Defaults to LOCK_TIMEOUT.
+        poll_interval (float, optional):    The seconds between attempts.
+                                            Defaults to 1.
+        stale_after (float, optional):  The age of a lock that is taken
+                                        over.  Defaults to LOCK_TIMEOUT.
+
+    Raises:
+        TimeoutError: If the lock was held by another run for too long.
+    -------------------------------------------------------------------"""
+    deadline = time.monotonic() + timeout
+    while not store.create_exclusive(LOCK_KEY, json.dumps({'time': time.time()}).encode()):
+        try:
+            locked_at = json.loads(store[LOCK_KEY])['time']
+        except KeyError:
+            continue
+
+        if time.time() - locked_at > stale_after:
+            logger.warning(f'Taking over the lock of {store} from {time.time() - locked_at:.0f} s ago')
+            store.pop(LOCK_KEY, None)
+            continue
+        if time.monotonic() > deadline:
+            raise TimeoutError(f'Timed out waiting {timeout} s for the lock of {store}')
+        time.sleep(poll_interval)
+
+    try:
+        yield
+    finally:
+        store.pop(LOCK_KEY, None)
+
+
+def get_time_index(dims: Tuple[str, ...], rows: slice) -> Tuple[slice, ...]:
+    # Index rows along the time dimension of an array
+    return tuple(rows if dim == 'time' else slice(None) for dim in dims)
+
+
+def move_rows(array: zarr.Array, dims: Tuple[str, ...], start: int, stop: int, destination: int,
+              rows_per_block: int):
+    """-------------------------------------------------------------------
+    Move the rows [start, stop) of a zarr array along time to start at
+    destination, copying the stored values a block of rows at a time.
+    The source and destination may overlap.
+
+    Args:
+        array (zarr.Array):     The array, which must be long enough.
+        dims (Tuple[str, ...]): The dimensions of the array.
+        start (int):            The first row to move.
+        stop (int):             The row after the last row to move.
+        destination (int):      The new index of the first row.
+        rows_per_block (int):   The number of rows copied at once.
+    -------------------------------------------------------------------"""
+    offsets = range(0, stop - start, rows_per_block)
+    # Copy from the end when moving rows later, so rows are read before
+    # they are overwritten
+    if destination > start:
+        offsets = reversed(offsets)
+    for offset in offsets:
+        end = min(offset + rows_per_block, stop - start)
+        array[get_time_index(dims, slice(destination + offset, destination + end))] = \
+            array[get_time_index(dims, slice(start + offset, start + end))]
+
+
+class DailyRollup:
+    """-------------------------------------------------------------------
+    Keeps a zarr store for each day with all of the rays of the day (the
+    processed variables and their QC bits) in time order, and optionally
+    the statistics of each interval of the day (see TimeAggregator) in its
+    `aggregate` group.  Each ingest updates the stores of the days it
+    covers with just its own rays, so the daily stores are always current
+    without reading or reprocessing the other hours.
+
+    Rays are spliced into the store at their time offset.  Hours that
+    arrive in order are appended, so only the chunks at the end of the day
+    are written.  An hour that arrives late moves the stored rays after it
+    along, without decoding them, and an ingest that is run again replaces
+    its rays.  Only the aggregated intervals that the hour overlaps are
+    recomputed, from the rays in the store, so intervals split between two
+    hourly files get the statistics of all of their rays.
+
+    A manifest.json in each store lists the ingests it includes, keyed by
+    their input files, with the time range and number of rays of each.  A
+    lock in the store (see lock_store) keeps concurrent updates apart.
+
+    Stores are named like the other outputs, e.g.
+    nwtc/nwtc.z01-lidar-daily.a1/nwtc.z01-lidar-daily.a1.20210510.000000.zarr,
+    and are opened with xr.open_zarr(store) for the rays and
+    xr.open_zarr(store, group='aggregate') for the statistics.
+
+    Args:
+        storage (DatastreamStorage):    The storage to keep the stores in.
+        datastream_name (str):          The datastream of the stores.
+        aggregation (Dict, optional):   The aggregation section of the
+                                        pipeline config, if the statistics
+                                        should be kept. Defaults to None.
+        rows_per_block (int, optional): The number of rays read, written
+                                        or moved at once. Defaults to 4096.
+    -------------------------------------------------------------------"""
+
+    def __init__(self, storage, datastream_name: str, aggregation: Dict = None, rows_per_block: int = 4096):
+        self.storage = storage
+        self.datastream_name = datastream_name
+        self.aggregation = aggregation
+        self.rows_per_block = rows_per_block
+
+    def get_store_path(self, day: np.datetime64) -> str:
+        # The path of a day's store under the storage root
+        date = str(day.astype('datetime64[D]')).replace('-', '')
+        location_id = self.datastream_name.split('.')[0]
+        return posixpath.join(location_id, self.datastream_name, f'{self.datastream_name}.{date}.000000.zarr')
+
+    def update(self, dataset: xr.Dataset, source: str = None) -> List[str]:
+        """-------------------------------------------------------------------
+        Add the rays of an ingest to the stores of the days it covers, or
+        replace them if the ingest is already in a store.
+
+        Args:
+            dataset (xr.Dataset):   The processed dataset of the ingest, in
+                                    time order.  It may be lazily loaded.
+            source (str, optional): What identifies the ingest in the
+                                    manifest.  Defaults to the
+                                    dataset's input_files attribute.
+
+        Returns:
+            List[str]: The paths of the updated stores.
+        -------------------------------------------------------------------"""
+        source = source or dataset.attrs['input_files']
+        times = dataset['time'].values
+        if not len(times):
+            return []
+
+        paths = []
+        first_day, last_day = times[0].astype('datetime64[D]'), times[-1].astype('datetime64[D]')
+        for day in np.arange(first_day, last_day + ONE_DAY, ONE_DAY):
+            start, stop = np.searchsorted(times, np.array([day, day + ONE_DAY]).astype(times.dtype))
+            if stop > start:
+                path = self.get_store_path(day)
+                self.update_day(open_store(self.storage, path), day, dataset.isel(time=slice(start, stop)), source)
+                paths.append(path)
+        return paths
+
+    def update_day(self, store: MutableMapping, day: np.datetime64, dataset: xr.Dataset, source: str):
+        """-------------------------------------------------------------------
+        Splice the rays of one ingest within one day into the day's store,
+        update the aggregated intervals they overlap and record the ingest
+        in the manifest.
+
+        Args:
+            store (MutableMapping): The day's store.
+            day (np.datetime64):    The day.
+            dataset (xr.Dataset):   The rays of the ingest within the day.
+            source (str):           What identifies the ingest.
+        -------------------------------------------------------------------"""
+        entry = {
+            'start': str(dataset['time'].values[0].astype('datetime64[ns]')),
+            'end': str(dataset['time'].values[-1].astype('datetime64[ns]')),
+            'rays': int(dataset.sizes['time']),
+            'updated': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        }
+
+        with lock_store(store):
+            manifest = json.loads(store[MANIFEST_KEY]) if MANIFEST_KEY in store else {'files': {}}
+            entries = manifest['files']
+            self.check_manifest(store, entries)
+
+            # The rays of an ingest that ran before are replaced
+            previous = entries.pop(source, None)
+            start = self.get_offset(entries, entry['start'])
+            if previous is not None:
+                previous_start = self.get_offset(entries, previous['start'])
+                if previous_start == start:
+                    self.splice(store, start, start + previous['rays'], dataset)
+                else:
+                    self.splice(store, previous_start, previous_start + previous['rays'], None)
+                    self.splice(store, start, start, dataset)
+            elif entries:
+                self.splice(store, start, start, dataset)
+            else:
+                self.create(store, dataset)
+
+            if self.aggregation:
+                starts = [entry['start']] + ([previous['start']] if previous else [])
+                ends = [entry['end']] + ([previous['end']] if previous else [])
+                self.update_aggregate(store, day, np.datetime64(min(starts)), np.datetime64(max(ends)))
+
+            entries[source] = entry
+            manifest['date'] = str(day.astype('datetime64[D]'))
+            manifest['files'] = dict(sorted(entries.items(), key=lambda item: item[1]['start']))
+            zarr.consolidate_metadata(store)
+            store[MANIFEST_KEY] = json.dumps(manifest, indent=2).encode()
+
+    @staticmethod
+    def get_offset(entries: Dict[str, Dict], start: str) -> int:
+        # The number of rays in the store before a time.  Times are ISO
+        # strings of the same precision, so they sort as strings.
+        return sum(entry['rays'] for entry in entries.values() if entry['start'] < start)
+
+    @staticmethod
+    def check_manifest(store: MutableMapping, entries: Dict[str, Dict]):
+        # A run that failed partway through a splice leaves the rays and the
+        # manifest out of step, and the day has to be rebuilt
+        stored_rays = zarr.open_array(store, mode='r', path='time').shape[0] \
+            if zarr.storage.contains_array(store, 'time') else 0
+        listed_rays = sum(entry['rays'] for entry in entries.values())
+        if stored_rays != listed_rays:
+            raise ValueError(f'The daily store {store} has {stored_rays} rays but its manifest lists {listed_rays}. '
+                             f'Delete it and ingest the day again to rebuild it.')
+
+    def create(self, store: MutableMapping, dataset: xr.Dataset):
+        # Write the first ingest of a day.  Times are stored as float
+        # seconds so later ingests with fractional seconds fit.
+        first = dataset.isel(time=slice(0, self.rows_per_block)).load()
+        first.attrs = {key: value for key, value in first.attrs.items() if key not in ['input_files', 'history']}
+        first.attrs['datastream_name'] = self.datastream_name
+
+        encoding = ZarrHandler.get_encoding(first)
+        encoding['time'] = {'units': 'seconds since 1970-01-01T00:00:00', 'dtype': 'float64'}
+        first.to_zarr(store, mode='w-', encoding=encoding, consolidated=False)
+        if dataset.sizes['time'] > first.sizes['time']:
+            self.splice(store, first.sizes['time'], first.sizes['time'],
+                        dataset.isel(time=slice(first.sizes['time'], None)))
+
+    def splice(self, store: MutableMapping, start: int, stop: int, dataset: Optional[xr.Dataset]):
+        """-------------------------------------------------------------------
+        Replace the stored rays [start, stop) with the rays of a dataset,
+        moving the rays after them to make room or close the gap.
+
+        Args:
+            store (MutableMapping):             The day's store.
+            start (int):                        The first ray to replace.
+            stop (int):                         The ray after the last one.
+            dataset (Optional[xr.Dataset]):     The new rays, or None to
+                                                delete rays.
+        -------------------------------------------------------------------"""
+        group = zarr.open_group(store, mode='r+')
+        num_rows = dataset.sizes['time'] if dataset is not None else 0
+        shift = num_rows - (stop - start)
+
+        # The encoding of the stored variables, to encode the new rays with
+        with xr.open_zarr(store, consolidated=False, chunks=None) as stored:
+            variables = {name: (variable.dims, {key: value for key, value in variable.encoding.items()
+                                                if key in VALUE_ENCODING_KEYS})
+                         for name, variable in stored.variables.items() if 'time' in variable.dims}
+            sizes = {dim: size for dim, size in stored.sizes.items() if dim != 'time'}
+
+        if dataset is not None:
+            missing = set(variables) - set(dataset.variables)
+            if missing:
+                raise ValueError(f'Cannot add rays without the variables {sorted(missing)} to {store}')
+            different = {dim: size for dim, size in dataset.sizes.items() if sizes.get(dim, size) != size}
+            if different:
+                raise ValueError(f'Cannot add rays with the sizes {different} to {store} with the sizes {sizes}')
+
+        # Move the rays after the replaced ones, growing the arrays before
+        # moving later or shrinking them after moving earlier
+        for name, (dims, _) in variables.items() if shift else []:
+            array = group[name]
+            length = array.shape[dims.index('time')]
+            new_shape = [length + shift if dim == 'time' else size for dim, size in zip(dims, array.shape)]
+            if shift > 0:
+                array.resize(*new_shape)
+            move_rows(array, dims, stop, length, stop + shift, self.rows_per_block)
+            if shift < 0:
+                array.resize(*new_shape)
+
+        for offset in range(0, num_rows, self.rows_per_block):
+            block = dataset.isel(time=slice(offset, offset + self.rows_per_block))
+            rows = slice(start + offset, start + offset + block.sizes['time'])
+            for name, (dims, encoding) in variables.items():
+                variable = xr.Variable(dims, block[name].transpose(*dims).values, encoding=encoding)
+                encoded = xr.conventions.encode_cf_variable(variable, name=name)
+                group[name][get_time_index(dims, rows)] = encoded.values
+
+    def update_aggregate(self, store: MutableMapping, day: np.datetime64, start: np.datetime64, end: np.datetime64):
+        """-------------------------------------------------------------------
+        Recompute the aggregated intervals of a day that overlap a time
+        range from the rays in the store, creating the aggregate group with
+        every interval of the day the first time.
+
+        Args:
+            store (MutableMapping): The day's store.
+            day (np.datetime64):    The day.
+            start (np.datetime64):  The start of the time range.
+            end (np.datetime64):    The end of the time range (inclusive).
+        -------------------------------------------------------------------"""
+        aggregator = TimeAggregator.from_config(self.aggregation)
+        day = day.astype('datetime64[ns]')
+        step = aggregator.step.astype('timedelta64[ns]')
+        if ONE_DAY % step:
+            raise ValueError(f'The aggregation interval {aggregator.interval} must divide a day')
+
+        bins = np.arange(day, day + ONE_DAY, step)
+        first, last = np.searchsorted(bins, [start, end], side='right') - 1
+        window = slice(max(first, 0), last + 1)
+
+        # Read the rays of the intervals, a block at a time
+        with xr.open_zarr(store, consolidated=False, chunks=None) as rays:
+            times = rays['time'].values
+            begin, finish = np.searchsorted(times, [bins[window][0], bins[window][-1] + step])
+            for offset in range(begin, finish, self.rows_per_block):
+                aggregator.add(rays.isel(time=slice(offset, min(offset + self.rows_per_block, finish))).load())
+
+        result = aggregator.result()
+        if result is None:
+            return
+
+        # Intervals without rays, e.g. after rays were replaced by fewer,
+        # have no statistics
+        exists = zarr.storage.contains_group(store, AGGREGATE_GROUP)
+        result = result.reindex(time=bins[window] if exists else bins)
+        for name in result.data_vars:
+            if name.endswith('_count'):
+                result[name] = result[name].fillna(0).astype(np.int32)
+
+        if not exists:
+            result.attrs['datastream_name'] = self.datastream_name
+            encoding = {'time': {'units': 'seconds since 1970-01-01T00:00:00', 'dtype': 'float64'}}
+            result.to_zarr(store, group=AGGREGATE_GROUP, mode='w-', encoding=encoding, consolidated=False)
+        else:
+            result = result.drop_vars([name for name, variable in result.variables.items()
+                                       if 'time' not in variable.dims])
+            result.to_zarr(store, group=AGGREGATE_GROUP, region={'time': window}, consolidated=False)
@@ -0,0 +1,164 @@
+import os
+import re
+from typing import Dict, Iterable, List, NamedTuple, Optional, Pattern, Tuple
+
+
+class Route(NamedTuple):
+    """-------------------------------------------------------------------
+    A route from file names to a pipeline method.
+
+    Args:
+        pipeline (str): The pipeline folder.
+        method (str):   The pipeline method to call, 'run' or 'run_plots'.
+        pattern (str):  A regular expression that must match the whole
+                        file name.
+        priority (int): Routes with higher priorities win when more than
+                        one pattern matches a file name. Defaults to 0.
+    -------------------------------------------------------------------"""
+    pipeline: str
+    method: str
+    pattern: str
+    priority: int = 0
+
+
+class AmbiguousRouteError(ValueError):
+    """Raised when a file name matches more than one pattern with the same
+    priority."""
+
+
+class CompiledPatterns:
+    """-------------------------------------------------------------------
+    Patterns compiled into one regular expression that finds the highest
+    priority pattern matching a file name in a single match call.
+
+    Each pattern is wrapped in a named group and the groups are joined into
+    one alternation in order of decreasing priority, so the regex engine
+    tries them in priority order and the first alternative that matches
+    the whole name wins.  The other patterns with the winner's priority
+    are compiled the same way, so checking them for ambiguity takes one
+    more match call.
+
+    Args:
+        patterns (List[Tuple[str, int]]):   The patterns and priorities.
+    -------------------------------------------------------------------"""
+    def __init__(self, patterns: List[Tuple[str, int]]):
+        self.patterns = [pattern for pattern, priority in patterns]
+
+        # Stable sort, so patterns with the same priority keep their order
+        order = sorted(range(len(patterns)), key=lambda index: -patterns[index][1])
+        self.regex, self.group_patterns = self.compile(order)
+
+        self.peers = []
+        for index, (pattern, priority) in enumerate(patterns):
+            peers = [other for other in order if other != index and patterns[other][1] == priority]
+            self.peers.append(self.compile(peers) if peers else None)
+
+    def compile(self, indices: List[int]) -> Tuple[Pattern, Dict[int, int]]:
+        # Returns the joined regex and the pattern index of each group
+        regex = re.compile('|'.join(f'(?P<_{index}>{self.patterns[index]})' for index in indices))
+        return regex, {regex.groupindex[f'_{index}']: index for index in indices}
+
+    def match(self, name: str) -> Optional[int]:
+        """-------------------------------------------------------------------
+        Find the pattern that matches a file name.
+
+        Args:
+            name (str): The file name.
+
+        Returns:
+            Optional[int]:  The index of the matching pattern, or None if no
+                            pattern matches.
+
+        Raises:
+            AmbiguousRouteError:    If another pattern with the same
+                                    priority matches.
+        -------------------------------------------------------------------"""
+        match = self.regex.fullmatch(name)
+        if match is None:
+            return None
+
+        # A pattern's group encloses any groups inside the pattern, so it is
+        # the last group to close
+        index = self.group_patterns[match.lastindex]
+
+        peers = self.peers[index]
+        if peers is not None:
+            peer_regex, peer_patterns = peers
+            peer_match = peer_regex.fullmatch(name)
+            if peer_match is not None:
+                other = peer_patterns[peer_match.lastindex]
+                raise AmbiguousRouteError(f'File name "{name}" matches more than one pattern with the same '
+                                          f"priority: '{self.patterns[index]}', '{self.patterns[other]}'")
+        return index
+
+
+class FileRouter:
+    """-------------------------------------------------------------------
+    Routes file names to the pipeline, pipeline method and location that
+    process them.  The routes and the locations are each compiled into a
+    single regular expression, so routing a file name takes at most four
+    match calls however many patterns are registered, and the result
+    doesn't depend on the order the patterns are listed in.
+
+    Args:
+        routes (List[Route]):       The routes to pipeline methods.
+        locations (Dict[str, str]): Patterns matching the whole file name
+                                    keyed by location.  A file name must
+                                    not match more than one location.
+    -------------------------------------------------------------------"""
+    def __init__(self, routes: List[Route], locations: Dict[str, str]):
+        self.routes = list(routes)
+        self.locations = list(locations)
+        self.route_patterns = CompiledPatterns([(route.pattern, route.priority) for route in self.routes])
+        self.location_patterns = CompiledPatterns([(pattern, 0) for pattern in locations.values()])
+
+        # The result for each pattern index, or for None when none matches
+        self.route_targets = {None: (None, 'run')}
+        self.route_targets.update((index, route[:2]) for index, route in enumerate(self.routes))
+        self.location_targets = {None: (None,)}
+        self.location_targets.update((index, (location,)) for index, location in enumerate(self.locations))
+
+    def route(self, name: str) -> Tuple[Optional[str], str, Optional[str]]:
+        """-------------------------------------------------------------------
+        Look up the pipeline, the pipeline method to call and the location
+        for a file name.
+
+        Args:
+            name (str): The name of the file, without its folder.
+
+        Returns:
+            Tuple[Optional[str], str, Optional[str]]:
+                The pipeline folder, the method and the location.  The
+                pipeline or the location is None if no pattern matches, in
+                which case the method is 'run'.
+
+        Raises:
+            AmbiguousRouteError:    If the name matches more than one route
+                                    with the same priority or more than one
+                                    location.
+        -------------------------------------------------------------------"""
+        return (self.route_targets[self.route_patterns.match(name)] +
+                self.location_targets[self.location_patterns.match(name)])
+
+    def route_many(self, paths: Iterable[str]) -> List[Tuple[Optional[str], str, Optional[str]]]:
+        """-------------------------------------------------------------------
+        Route many files at once, e.g. all the keys under an S3 prefix.
+        Equivalent to calling route() on the name of each file, with the
+        lookups bound once outside of the loop.
+
+        Args:
+            paths (Iterable[str]):  The file paths or names.
+
+        Returns:
+            List[Tuple[Optional[str], str, Optional[str]]]:
+                The pipeline folder, method and location of each path, in
+                order.
+
+        Raises:
+            AmbiguousRouteError:    If any name is ambiguous.
+        -------------------------------------------------------------------"""
+        basename = os.path.basename
+        match_route, route_targets = self.route_patterns.match, self.route_targets
+        match_location, location_targets = self.location_patterns.match, self.location_targets
+        return [route_targets[match_route(name)] + location_targets[match_location(name)]
+                for name in [basename(str(path)) for path in paths]]
@@ -0,0 +1,17 @@
+import sys
+
+
+def is_s3_path(path) -> bool:
+    """-------------------------------------------------------------------
+    Check if a path is a tsdat S3Path without importing tsdat, which takes
+    seconds and isn't needed until a pipeline runs.  An S3Path can only
+    exist once tsdat has been imported.
+
+    Args:
+        path:   The path.
+
+    Returns:
+        bool: True if the path is an S3Path.
+    -------------------------------------------------------------------"""
+    aws_storage = sys.modules.get('tsdat.io.aws_storage')
+    return aws_storage is not None and isinstance(path, aws_storage.S3Path)
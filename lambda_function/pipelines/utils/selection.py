@@ -0,0 +1,66 @@
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import xarray as xr
+from tsdat.io import FileHandler
+
+from pipelines.utils.zarr_handler import is_zarr_store, open_zarr
+
+
+def select(dataset: xr.Dataset, variables: List[str] = None,
+           ranges: Dict[str, Tuple[Optional[float], Optional[float]]] = None) -> xr.Dataset:
+    """-------------------------------------------------------------------
+    Select variables and coordinate ranges from a dataset, e.g. the data a
+    plot draws.  Only the selected coordinates are read to find the
+    ranges, so the values of a lazily loaded dataset aren't read until they
+    are used.  Selecting again with the same arguments returns the same
+    data.
+
+    Args:
+        dataset (xr.Dataset):               The dataset.
+        variables (List[str], optional):    The variables to keep, with
+                                            their coordinates, or None for
+                                            all of them. Defaults to None.
+        ranges (Dict[str, Tuple[Optional[float], Optional[float]]], optional):
+            The lower (inclusive) and upper (exclusive) bound of the values
+            to keep along each dimension coordinate, either of which may be
+            None, e.g. {'distance': (None, 5000)}. Defaults to None.
+
+    Returns:
+        xr.Dataset: The selected data, with the attributes of the dataset.
+    -------------------------------------------------------------------"""
+    if variables is not None:
+        dataset = dataset[variables]
+
+    indexers = {}
+    for dim, (lower, upper) in (ranges or {}).items():
+        values = dataset[dim].values
+        keep = np.ones(values.shape, dtype=bool)
+        if lower is not None:
+            keep &= values >= lower
+        if upper is not None:
+            keep &= values < upper
+        if not keep.all():
+            indexers[dim] = np.flatnonzero(keep)
+
+    return dataset.isel(indexers) if indexers else dataset
+
+
+def open_lazily(filename: str) -> xr.Dataset:
+    """-------------------------------------------------------------------
+    Open a processed file without reading its values, which are then only
+    read for the variables and slices that are used.  Zarr stores and
+    netCDF files are opened lazily, and other files are read with the
+    registered FileHandler.  Close the dataset when done with it.
+
+    Args:
+        filename (str): The path to the file.
+
+    Returns:
+        xr.Dataset: The dataset.
+    -------------------------------------------------------------------"""
+    if is_zarr_store(filename):
+        return open_zarr(filename)
+    if filename.endswith('.nc'):
+        return xr.open_dataset(filename)
+    return FileHandler.read(filename)
@@ -0,0 +1,221 @@
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Dict, List, Tuple
+
+from pipelines.utils.log_helper import logger
+
+# Files larger than this are transferred in parts of this size, several
+# parts at a time
+MULTIPART_THRESHOLD = 16 * 2 ** 20
+MULTIPART_CHUNKSIZE = 16 * 2 ** 20
+
+
+def get_io_workers() -> int:
+    """-------------------------------------------------------------------
+    Returns the number of files to transfer at once.  Transfers wait on
+    the network rather than the CPU, so this doesn't depend on the number
+    of CPUs.  Can be overridden with the IO_WORKERS environment variable.
+    -------------------------------------------------------------------"""
+    return int(os.environ.get('IO_WORKERS', 0)) or 8
+
+
+def get_transfer_config():
+    # boto3 takes a while to import, so it is imported by the first transfer
+    from boto3.s3.transfer import TransferConfig
+    return TransferConfig(multipart_threshold=MULTIPART_THRESHOLD, multipart_chunksize=MULTIPART_CHUNKSIZE,
+                          max_concurrency=get_io_workers())
+
+
+def link_or_copy(source: str, destination: str):
+    # Hard links are instant and keep the data after the source is deleted
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+class TransferExecutor:
+    """-------------------------------------------------------------------
+    Runs S3 downloads and uploads in background threads, so a pipeline can
+    keep computing while its inputs download and its outputs upload.
+
+    Uploads are made from a staged hard link (or copy) of the local file,
+    so the pipeline may delete or reuse its temp file as soon as the upload
+    is queued.  Until the upload finishes, fetching the same S3 object is
+    served from the staged file.  Downloads started by prefetch() are kept
+    until a fetch of the same object takes them.  Call wait() before the
+    end of an invocation, since Lambda freezes background threads between
+    invocations.
+
+    The executor is shared by all of the pipelines in a process.  A forked
+    worker process starts with no transfers of its own.
+
+    Args:
+        max_workers (int, optional):    The number of files to transfer at
+                                        once. Defaults to get_io_workers().
+    -------------------------------------------------------------------"""
+    def __init__(self, max_workers: int = None):
+        self.max_workers = max_workers
+        self.reset()
+
+        # Threads and the locks they hold don't survive a fork
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self.reset)
+
+    def reset(self):
+        self.lock = threading.Lock()
+        self.executor = None
+        self.staging_dir = None
+        self.uploads: Dict[Tuple[str, str], Tuple[str, Future]] = {}
+        self.upload_futures: List[Future] = []
+        self.downloads: Dict[Tuple[str, str], Future] = {}
+
+    def submit(self, func, *args) -> Future:
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.max_workers or get_io_workers(),
+                                               thread_name_prefix='transfer')
+        return self.executor.submit(func, *args)
+
+    def get_staging_path(self, key: str) -> str:
+        if self.staging_dir is None or not os.path.isdir(self.staging_dir):
+            self.staging_dir = tempfile.mkdtemp(prefix='transfers-')
+        staging_path = os.path.join(self.staging_dir, uuid.uuid4().hex)
+        os.makedirs(staging_path)
+        return os.path.join(staging_path, os.path.basename(key))
+
+    def upload(self, s3_client, local_path: str, bucket: str, key: str) -> Future:
+        """-------------------------------------------------------------------
+        Queue the upload of a local file.  Files larger than
+        MULTIPART_THRESHOLD are uploaded in parts.
+
+        Args:
+            s3_client:          The boto3 S3 client.
+            local_path (str):   The local file, which may be deleted once
+                                this returns.
+            bucket (str):       The bucket to upload to.
+            key (str):          The key to upload to.
+
+        Returns:
+            Future: The upload, which is done when the object is in S3.
+        -------------------------------------------------------------------"""
+        with self.lock:
+            staged_file = self.get_staging_path(key)
+            link_or_copy(local_path, staged_file)
+
+            def run_upload():
+                try:
+                    s3_client.upload_file(staged_file, bucket, key, Config=get_transfer_config())
+                finally:
+                    with self.lock:
+                        shutil.rmtree(os.path.dirname(staged_file), ignore_errors=True)
+
+            future = self.submit(run_upload)
+            self.uploads[(bucket, key)] = (staged_file, future)
+            self.upload_futures.append(future)
+            return future
+
+    def prefetch(self, s3_client, bucket: str, key: str) -> Future:
+        """-------------------------------------------------------------------
+        Start downloading an S3 object that will be fetched later, unless
+        it is already being downloaded or uploaded.
+
+        Args:
+            s3_client:      The boto3 S3 client.
+            bucket (str):   The bucket of the object.
+            key (str):      The key of the object.
+
+        Returns:
+            Future: The download, whose result is the local file, or None
+            if the object doesn't need to be downloaded.
+        -------------------------------------------------------------------"""
+        with self.lock:
+            if (bucket, key) in self.downloads:
+                return self.downloads[(bucket, key)]
+            if (bucket, key) in self.uploads:
+                return None
+
+            local_path = self.get_staging_path(key)
+
+            def run_download():
+                try:
+                    s3_client.download_file(bucket, key, local_path, Config=get_transfer_config())
+                except Exception:
+                    shutil.rmtree(os.path.dirname(local_path), ignore_errors=True)
+                    raise
+                return local_path
+
+            future = self.submit(run_download)
+            self.downloads[(bucket, key)] = future
+            return future
+
+    def take(self, bucket: str, key: str, local_path: str) -> bool:
+        """-------------------------------------------------------------------
+        Get an S3 object from a pending upload or a prefetched download
+        instead of downloading it, waiting for the download if it hasn't
+        finished.  A download that failed is logged and not used.
+
+        Args:
+            bucket (str):       The bucket of the object.
+            key (str):          The key of the object.
+            local_path (str):   The local file to put the object in.
+
+        Returns:
+            bool: True if the object is in local_path, or False if it has to
+            be downloaded.
+        -------------------------------------------------------------------"""
+        with self.lock:
+            staged_file, upload = self.uploads.get((bucket, key), (None, None))
+            if upload is not None and os.path.isfile(staged_file):
+                link_or_copy(staged_file, local_path)
+                return True
+            download = self.downloads.pop((bucket, key), None)
+
+        if download is None:
+            return False
+        try:
+            prefetched_file = download.result()
+        except Exception as e:
+            logger.warning(f'Prefetching s3://{bucket}/{key} failed, downloading it again: {e}')
+            return False
+
+        shutil.move(prefetched_file, local_path)
+        shutil.rmtree(os.path.dirname(prefetched_file), ignore_errors=True)
+        return True
+
+    def wait(self):
+        """-------------------------------------------------------------------
+        Wait for all of the queued uploads to finish.  If any failed, the
+        first error is raised once they have all finished.  Prefetched
+        downloads are left for later fetches.
+        -------------------------------------------------------------------"""
+        with self.lock:
+            futures, self.upload_futures = self.upload_futures, []
+            self.uploads = {}
+
+        wait(futures)
+        errors = [future.exception() for future in futures if future.exception() is not None]
+        if errors:
+            raise errors[0]
+
+    def discard_prefetched(self):
+        """-------------------------------------------------------------------
+        Cancel the prefetched downloads that no fetch has taken, e.g. for
+        files that were skipped, and delete their local files.
+        -------------------------------------------------------------------"""
+        with self.lock:
+            downloads, self.downloads = self.downloads, {}
+
+        for future in downloads.values():
+            future.cancel()
+        wait(downloads.values())
+        for future in downloads.values():
+            if not future.cancelled() and future.exception() is None:
+                shutil.rmtree(os.path.dirname(future.result()), ignore_errors=True)
+
+
+# The transfers of the pipelines in this process
+transfers = TransferExecutor()
@@ -0,0 +1,217 @@
+import os
+import shutil
+import tempfile
+from typing import Dict
+
+import numcodecs
+import numpy as np
+import xarray as xr
+import zarr
+from tsdat import Config
+from tsdat.io import AbstractFileHandler, FileHandler
+
+from pipelines.utils.netcdf import VALUE_ENCODING_KEYS
+
+
+def is_zip_store(filename: str) -> bool:
+    return filename.endswith('.zip')
+
+
+def is_zarr_store(filename: str) -> bool:
+    return filename.endswith('.zarr') or filename.endswith('.zarr.zip')
+
+
+def open_zarr(filename: str, **kwargs) -> xr.Dataset:
+    """-------------------------------------------------------------------
+    Lazily open a zarr directory or zip store.  Values are only read from
+    the chunks of the variables and slices that are used, and the store is
+    closed when the dataset is closed.
+
+    Args:
+        filename (str): The path to the store.
+
+    Returns:
+        xr.Dataset: The lazily loaded dataset.
+    -------------------------------------------------------------------"""
+    return xr.open_zarr(filename, chunks=None, **kwargs)
+
+
+def zip_directory_store(directory: str, filename: str):
+    """-------------------------------------------------------------------
+    Copy a zarr directory store into a new zip store.
+
+    Args:
+        directory (str):    The path to the directory store.
+        filename (str):     The path of the zip store to write.
+    -------------------------------------------------------------------"""
+    if os.path.exists(filename):
+        os.remove(filename)
+
+    with zarr.ZipStore(filename, mode='w') as store:
+        zarr.copy_store(zarr.DirectoryStore(directory), store)
+
+
+class ZarrHandler(AbstractFileHandler):
+    """-------------------------------------------------------------------
+    FileHandler to read from and write to zarr stores.  Filenames ending in
+    .zip are written as zip stores, a single file that storage can save and
+    fetch like any other output, and other filenames as directory stores.
+
+    Variables are chunked like the netCDF output: the chunk shape comes
+    from the `chunksizes` encoding set by the pipeline's encoding profile,
+    zlib compression and shuffle are applied with the equivalent numcodecs
+    compressor and filter, and packed variables keep their dtype,
+    scale_factor and add_offset.
+
+    Parameters specified in the storage config file should follow the
+    following example:
+
+        parameters:
+          write:
+            to_zarr:
+              # Parameters here will be passed to xr.Dataset.to_zarr()
+          read:
+            open_zarr:
+              # Parameters here will be passed to xr.open_zarr()
+
+    Args:
+        parameters (Dict, optional):    Parameters that were passed to the
+                                        FileHandler when it was registered
+                                        in the storage config file.
+                                        Defaults to {}.
+    -------------------------------------------------------------------"""
+
+    def write(self, ds: xr.Dataset, filename: str, config: Config = None, append_dim: str = None, **kwargs) -> None:
+        """-------------------------------------------------------------------
+        Save the dataset to a zarr store.
+
+        Args:
+            ds (xr.Dataset):            The dataset to save.
+            filename (str):             The path to the store.
+            config (Config, optional):  Optional Config object. Defaults to
+                                        None.
+            append_dim (str, optional): If the store already exists, append
+                                        the dataset to it along this
+                                        dimension instead of replacing it.
+                                        Defaults to None.
+        -------------------------------------------------------------------"""
+        to_zarr_kwargs = self.parameters.get('write', {}).get('to_zarr', {})
+        appending = append_dim is not None and os.path.exists(filename)
+
+        # Zip stores can't be updated in place, so append to an unzipped copy
+        if appending and is_zip_store(filename):
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                directory = os.path.join(tmp_dir, os.path.basename(filename)[:-len('.zip')])
+                with zarr.ZipStore(filename, mode='r') as store:
+                    zarr.copy_store(store, zarr.DirectoryStore(directory))
+                self.write(ds, directory, config, append_dim)
+                zip_directory_store(directory, filename)
+            return
+
+        # Time units have to be in the encoding rather than the attrs, as in
+        # tsdat's NetCdfHandler
+        ds = ds.copy()
+        for variable in ds.variables.values():
+            if variable.dtype.type == np.datetime64 and 'units' in variable.attrs:
+                variable.encoding['units'] = variable.attrs.pop('units')
+
+        if appending:
+            # Appended variables are encoded like those already in the store,
+            # which includes their _FillValue
+            for variable in ds.variables.values():
+                variable.attrs.pop('_FillValue', None)
+            ds.to_zarr(filename, mode='a', append_dim=append_dim, **to_zarr_kwargs)
+            return
+
+        store = zarr.ZipStore(filename, mode='w') if is_zip_store(filename) else filename
+        try:
+            ds.to_zarr(store, mode='w', encoding=self.get_encoding(ds), **to_zarr_kwargs)
+        finally:
+            if is_zip_store(filename):
+                store.close()
+
+    def read(self, filename: str, **kwargs) -> xr.Dataset:
+        """-------------------------------------------------------------------
+        Read a zarr store into memory.
+
+        Args:
+            filename (str): The path to the store.
+
+        Returns:
+            xr.Dataset: The dataset.
+        -------------------------------------------------------------------"""
+        open_zarr_kwargs = self.parameters.get('read', {}).get('open_zarr', {})
+        with open_zarr(filename, **open_zarr_kwargs) as ds:
+            return ds.load()
+
+    @staticmethod
+    def get_encoding(ds: xr.Dataset) -> Dict[str, Dict]:
+        """-------------------------------------------------------------------
+        Translate the netCDF encoding of each variable to zarr encoding.
+
+        Args:
+            ds (xr.Dataset):    The dataset to encode.
+
+        Returns:
+            Dict[str, Dict]: The zarr encoding of each variable.
+        -------------------------------------------------------------------"""
+        encoding = {}
+        for name, variable in ds.variables.items():
+            var_encoding = {key: value for key, value in variable.encoding.items() if key in VALUE_ENCODING_KEYS}
+
+            if variable.encoding.get('chunksizes'):
+                var_encoding['chunks'] = tuple(variable.encoding['chunksizes'])
+
+            if variable.encoding.get('zlib'):
+                var_encoding['compressor'] = numcodecs.Zlib(level=variable.encoding.get('complevel', 4))
+                if variable.encoding.get('shuffle'):
+                    itemsize = np.dtype(var_encoding.get('dtype', variable.dtype)).itemsize
+                    var_encoding['filters'] = [numcodecs.Shuffle(elementsize=itemsize)]
+
+            encoding[name] = var_encoding
+        return encoding
+
+
+class ZarrAppender:
+    """-------------------------------------------------------------------
+    Writes a dataset to a zarr store one block at a time, with the same
+    interface as NetCdfAppender.  Blocks for a zip store are appended to a
+    temporary directory store that is zipped when the appender is closed.
+
+    Args:
+        filename (str):             The path of the store to write.
+        config (Config, optional):  The pipeline config passed to the
+                                    FileHandler. Defaults to None.
+        dim (str, optional):        The dimension to append along. Defaults
+                                    to 'time'.
+    -------------------------------------------------------------------"""
+
+    def __init__(self, filename: str, config: Config = None, dim: str = 'time'):
+        self.filename = filename
+        self.config = config
+        self.dim = dim
+        self.handler = FileHandler._get_handler(filename) or ZarrHandler()
+
+        self.tmp_dir = None
+        self.store_path = filename
+        if is_zip_store(filename):
+            self.tmp_dir = tempfile.mkdtemp()
+            self.store_path = os.path.join(self.tmp_dir, os.path.basename(filename)[:-len('.zip')])
+
+    def append(self, dataset: xr.Dataset):
+        """-------------------------------------------------------------------
+        Append a block to the store, creating the store with the first block.
+
+        Args:
+            dataset (xr.Dataset):   The block to append.
+        -------------------------------------------------------------------"""
+        self.handler.write(dataset, self.store_path, self.config, append_dim=self.dim)
+
+    def close(self):
+        """-------------------------------------------------------------------
+        Finish writing the store.
+        -------------------------------------------------------------------"""
+        if self.tmp_dir is not None:
+            zip_directory_store(self.store_path, self.filename)
+            shutil.rmtree(self.tmp_dir)
+            self.tmp_dir = None
@@ -0,0 +1,93 @@
+import os
+import sys
+import unittest
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+# Add the project directory to the pythonpath
+test_dir = os.path.dirname(os.path.realpath(__file__))
+project_dir = os.path.dirname(test_dir)
+lambda_dir = os.path.join(project_dir, 'lambda_function')
+sys.path.insert(0, lambda_dir)
+
+from pipelines.utils.aggregation import TimeAggregator
+
+
+class TestTimeAggregator(unittest.TestCase):
+    """-------------------------------------------------------------------
+    Tests computing 10 minute statistics of time x distance fields.
+    -------------------------------------------------------------------"""
+    def setUp(self) -> None:
+        rng = np.random.default_rng(0)
+        start = pd.Timestamp('2021-05-10 00:01:25')
+        time = (start + pd.to_timedelta(np.sort(rng.uniform(0, 3600, 2000)), 's')).values
+        doppler = rng.normal(size=(2000, 30)).astype(np.float32)
+        doppler[rng.random(doppler.shape) < 0.1] = np.nan
+        doppler[:5, :] = -9999
+        snr = rng.normal(-15, 10, size=(2000, 30)).astype(np.float32)
+        snr[10, 3] = -np.inf
+        self.dataset = xr.Dataset(
+            {
+                'doppler': (('time', 'distance'), doppler, {'units': 'm/s', '_FillValue': -9999}),
+                'SNR': (('time', 'distance'), snr, {'units': 'dB'}),
+            },
+            coords={'time': ('time', time, {'standard_name': 'time'}), 'distance': np.arange(30) * 18.0},
+            attrs={'datastream_name': 'nwtc.z01-lidar.a1'},
+        )
+
+        # The values the statistics are of, as xarray would resample them
+        self.expected = xr.Dataset({
+            'doppler': self.dataset['doppler'].where(self.dataset['doppler'] != -9999),
+            'SNR': self.dataset['SNR'].where(np.isfinite(self.dataset['SNR'])),
+        })
+        self.expected['doppler_snr_filtered'] = self.expected['doppler'].where(self.dataset['SNR'] >= -20)
+
+    def create_aggregator(self) -> TimeAggregator:
+        return TimeAggregator('10min', ['doppler', 'SNR'],
+                              {'doppler_snr_filtered': {'variable': 'doppler', 'where': 'SNR', 'min': -20}})
+
+    def test_same_as_resample(self):
+        aggregator = self.create_aggregator()
+        aggregator.add(self.dataset)
+        result = aggregator.result()
+
+        resampled = self.expected.resample(time='10min')
+        mean, std, count = resampled.mean(), resampled.std(), resampled.count()
+        np.testing.assert_array_equal(result['time'].values, mean['time'].values)
+        for name in ['doppler', 'SNR', 'doppler_snr_filtered']:
+            np.testing.assert_allclose(result[f'{name}_mean'], mean[name], rtol=1e-5, atol=1e-6)
+            np.testing.assert_allclose(result[f'{name}_std'], std[name], rtol=1e-5, atol=1e-6)
+            np.testing.assert_array_equal(result[f'{name}_count'], count[name])
+
+        self.assertEqual(result['doppler_mean'].dtype, np.float32)
+        self.assertEqual(result['doppler_mean'].attrs['units'], 'm/s')
+        self.assertEqual(result['time'].attrs['standard_name'], 'time')
+        self.assertEqual(result.attrs['averaging_interval'], '10min')
+        np.testing.assert_array_equal(result['distance'], self.dataset['distance'])
+
+    def test_blocks(self):
+        whole = self.create_aggregator()
+        whole.add(self.dataset)
+
+        # Blocks that split intervals, out of order, with empty blocks
+        blocks = self.create_aggregator()
+        for start, end in [(700, 1500), (0, 333), (2000, 2000), (1500, 2000), (333, 700)]:
+            blocks.add(self.dataset.isel(time=slice(start, end)))
+        xr.testing.assert_allclose(blocks.result(), whole.result(), rtol=1e-5, atol=1e-6)
+
+        # Times out of order within a block
+        shuffled = self.create_aggregator()
+        shuffled.add(self.dataset.isel(time=np.random.default_rng(1).permutation(2000)))
+        xr.testing.assert_allclose(shuffled.result(), whole.result(), rtol=1e-5, atol=1e-6)
+
+    def test_no_data(self):
+        aggregator = self.create_aggregator()
+        self.assertIsNone(aggregator.result())
+        aggregator.add(self.dataset.isel(time=slice(0, 0)))
+        self.assertIsNone(aggregator.result())
+
+
+if __name__ == '__main__':
+    unittest.main()
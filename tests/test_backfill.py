@@ -0,0 +1,101 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+# Add the project directory to the pythonpath
+test_dir = os.path.dirname(os.path.realpath(__file__))
+project_dir = os.path.dirname(test_dir)
+lambda_dir = os.path.join(project_dir, 'lambda_function')
+data_dir = os.path.join(project_dir, 'data')
+sys.path.insert(0, lambda_dir)
+
+from pipelines.backfill import main, read_checkpoint, walk_files
+from pipelines.runner import pipeline_cache
+
+
+storage_config = """
+storage:
+  classname: ${STORAGE_CLASSNAME}
+  parameters:
+    retain_input_files: ${RETAIN_INPUT_FILES}
+    root_dir: ${ROOT_DIR}
+
+  file_handlers:
+    input:
+      hpl:
+        file_pattern: '.*\\.hpl$'
+        classname: pipelines.awa_halo_ingest.filehandlers.HplHandler
+
+    output:
+      netcdf:
+        file_extension: '.nc'
+        classname: tsdat.io.filehandlers.NetCdfHandler
+"""
+
+
+class TestBackfill(unittest.TestCase):
+    """-------------------------------------------------------------------
+    Tests backfilling a directory of raw files on the local filesystem.
+    -------------------------------------------------------------------"""
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.raw_dir = os.path.join(self.tmp_dir.name, 'raw')
+        self.root_dir = os.path.join(self.tmp_dir.name, 'storage')
+        os.makedirs(os.path.join(self.raw_dir, '.hidden'))
+
+        shutil.copy(os.path.join(data_dir, 'awa_halo_ingest/test.nwtc.hpl'), self.raw_dir)
+        for name in ['test.nwtc.hpl.idx.npz', '.partial.nwtc.hpl', '.hidden/other.nwtc.hpl', 'notes.txt']:
+            open(os.path.join(self.raw_dir, name), 'w').close()
+        with open(os.path.join(self.raw_dir, 'bad.nwtc.hpl'), 'w') as f:
+            f.write('not an hpl file')
+
+        self.storage_config = os.path.join(self.tmp_dir.name, 'storage_config.yml')
+        with open(self.storage_config, 'w') as f:
+            f.write(storage_config)
+
+    def tearDown(self) -> None:
+        pipeline_cache.clear()
+        self.tmp_dir.cleanup()
+
+    def test_walk_files_skips_hidden_and_sidecar_files(self):
+        names = [os.path.basename(filename) for filename in walk_files(self.raw_dir)]
+        self.assertEqual(names, ['bad.nwtc.hpl', 'notes.txt', 'test.nwtc.hpl'])
+
+    def test_backfill_resumes_from_checkpoint(self):
+        args = [self.raw_dir, '--root-dir', self.root_dir, '--storage-config', self.storage_config, '--workers', '1']
+        self.assertEqual(main(args), 1)
+
+        records = read_checkpoint(os.path.join(self.root_dir, 'backfill_checkpoint.jsonl'))
+        statuses = {os.path.basename(filename): record['status'] for filename, record in records.items()}
+        self.assertEqual(statuses, {'bad.nwtc.hpl': 'failed', 'test.nwtc.hpl': 'success'})
+        self.assertTrue(os.path.isdir(os.path.join(self.root_dir, 'nwtc/nwtc.z01-lidar.a1')))
+
+        # Only the failed file is run again
+        main(args)
+        with open(os.path.join(self.root_dir, 'backfill_summary.json')) as f:
+            summary = json.load(f)
+        self.assertEqual((summary['files'], summary['failed'], summary['already_done']), (1, 1, 1))
+
+    def test_ambiguous_file_skipped(self):
+        # The name matches both the humboldt and the nwtc locations
+        os.remove(os.path.join(self.raw_dir, 'bad.nwtc.hpl'))
+        ambiguous = os.path.join(self.raw_dir, 'odd.z05.nwtc.hpl')
+        shutil.copy(os.path.join(self.raw_dir, 'test.nwtc.hpl'), ambiguous)
+
+        args = [self.raw_dir, '--root-dir', self.root_dir, '--storage-config', self.storage_config, '--workers', '1']
+        with self.assertLogs(level='ERROR'):
+            self.assertEqual(main(args), 0)
+
+        records = read_checkpoint(os.path.join(self.root_dir, 'backfill_checkpoint.jsonl'))
+        self.assertEqual(records[ambiguous]['status'], 'skipped')
+        self.assertEqual(records[os.path.join(self.raw_dir, 'test.nwtc.hpl')]['status'], 'success')
+        with open(os.path.join(self.root_dir, 'backfill_summary.json')) as f:
+            summary = json.load(f)
+        self.assertEqual((summary['succeeded'], summary['skipped']), (1, [ambiguous]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import os
+import sys
+import unittest
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+# Add the project directory to the pythonpath
+test_dir = os.path.dirname(os.path.realpath(__file__))
+project_dir = os.path.dirname(test_dir)
+lambda_dir = os.path.join(project_dir, 'lambda_function')
+sys.path.insert(0, lambda_dir)
+
+from pipelines.utils.downsample import aggregate, downsample
+
+
+class TestDownsample(unittest.TestCase):
+    """-------------------------------------------------------------------
+    Tests reducing time x distance fields to plot resolution.
+    -------------------------------------------------------------------"""
+    def setUp(self) -> None:
+        rng = np.random.default_rng(0)
+        time = pd.date_range('2021-05-10', periods=1000, freq='790ms').values
+        doppler = rng.normal(size=(1000, 30)).astype(np.float32)
+        doppler[:10, :] = np.nan
+        self.dataset = xr.Dataset(
+            {
+                'doppler': (('time', 'distance'), doppler),
+                'qc_doppler': (('time', 'distance'), rng.integers(0, 4, size=(1000, 30), dtype=np.int32)),
+                'azimuth': ('time', rng.uniform(0, 360, 1000)),
+                'gate_length': ((), 30.0),
+            },
+            coords={'time': time, 'distance': np.arange(30) * 30.0 + 15},
+        )
+
+    def test_aggregate(self):
+        values = np.array([[1, np.nan, 3], [np.nan, np.nan, 5]])
+        np.testing.assert_array_equal(aggregate(values, (2, 2)), [[1, 4]])
+        np.testing.assert_array_equal(aggregate(values, (1, 2), 'max'), [[1, 3], [np.nan, 5]])
+        np.testing.assert_array_equal(aggregate(np.array([1, 7, 2], dtype=np.int8), (2,)), [7, 2])
+
+        times = np.array(['2021-05-10T00:00:00', '2021-05-10T00:00:02', 'NaT'], dtype='datetime64[ns]')
+        np.testing.assert_array_equal(aggregate(times, (2,)),
+                                      np.array(['2021-05-10T00:00:01', 'NaT'], dtype='datetime64[ns]'))
+
+    def test_downsample(self):
+        downsampled = downsample(self.dataset, {'time': 300, 'distance': 30})
+
+        self.assertEqual(dict(downsampled.sizes), {'time': 250, 'distance': 30})
+        self.assertEqual(downsampled['doppler'].dtype, np.float32)
+        self.assertEqual(downsampled['gate_length'], 30.0)
+        self.assertTrue(np.isnan(downsampled['doppler'].values[:2]).all())
+        np.testing.assert_allclose(downsampled['doppler'].values[3], self.dataset['doppler'].values[12:16].mean(axis=0),
+                                   rtol=1e-6)
+        np.testing.assert_array_equal(downsampled['qc_doppler'].values[3],
+                                      self.dataset['qc_doppler'].values[12:16].max(axis=0))
+        self.assertEqual(downsampled['time'].values[0], self.dataset['time'].values[:4].astype(np.int64).mean()
+                         .astype('datetime64[ns]'))
+
+        # Computing the output in blocks gives the same result
+        xr.testing.assert_identical(downsample(self.dataset, {'time': 300}, rows_per_block=7),
+                                    downsample(self.dataset, {'time': 300}))
+
+    def test_small_dataset_unchanged(self):
+        self.assertIs(downsample(self.dataset, {'time': 1000, 'distance': 800}), self.dataset)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,290 @@
+import gzip
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import unittest
+import zipfile
+
+import numpy as np
+import xarray as xr
+
+# Add the project directory to the pythonpath
+test_dir = os.path.dirname(os.path.realpath(__file__))
+project_dir = os.path.dirname(test_dir)
+lambda_dir = os.path.join(project_dir, 'lambda_function')
+data_dir = os.path.join(project_dir, 'data')
+sys.path.insert(0, lambda_dir)
+sys.path.insert(0, os.path.join(project_dir, 'benchmarks'))
+
+from pipelines.awa_halo_ingest.filehandlers import (
+    HplHandler, RayBuffer, decimal_hours_to_datetime64, get_index_filename, load_ray_index, read_rays
+)
+from synthetic_hpl import make_rays, write_hpl
+
+
+hpl_file = os.path.join(data_dir, 'awa_halo_ingest/test.nwtc.hpl')
+
+
+def read_gates_line_by_line(filename, num_gates):
+    """Reference reader that converts every gate line with float()."""
+    with open(filename, 'r') as f:
+        lines = f.readlines()[17:]
+
+    ray_size = num_gates + 1
+    num_rays = len(lines) // ray_size
+    gates = np.full((num_rays, num_gates, 3), np.nan)
+    for ray in range(num_rays):
+        for line in lines[ray * ray_size + 1:(ray + 1) * ray_size]:
+            b = line.split()
+            gates[ray, int(b[0])] = [float(b[1]), float(b[2]), float(b[3])]
+    return gates
+
+
+class TestHplHandler(unittest.TestCase):
+    """-------------------------------------------------------------------
+    Tests reading Halo Photonics *.hpl files.
+    -------------------------------------------------------------------"""
+
+    def test_read_matches_line_by_line(self):
+        ds = HplHandler().read(hpl_file)
+        expected = read_gates_line_by_line(hpl_file, ds.dims['range_gate'])
+
+        self.assertEqual(ds.dims['time'], expected.shape[0])
+        for i, name in enumerate(['Doppler', 'Intensity', 'Beta']):
+            np.testing.assert_array_equal(ds[name].values, expected[:, :, i])
+
+    def test_read_rays_in_small_chunks(self):
+        ds = HplHandler().read(hpl_file)
+        with open(hpl_file, 'r') as f:
+            for line_num in range(17):
+                f.readline()
+            buffer = read_rays(f, ds.dims['range_gate'], rays_per_chunk=2)
+
+        self.assertEqual(buffer.capacity, ds.dims['time'])
+        np.testing.assert_array_equal(buffer.doppler, ds['Doppler'].values)
+        np.testing.assert_array_equal(buffer.rays[:, 0], ds['Decimal time (hours)'].values)
+
+    def test_ray_buffer_grows_and_trims(self):
+        buffer = RayBuffer(num_gates=3, capacity=1)
+        for ray in range(5):
+            gates = np.full((1, 3, 4), float(ray))
+            buffer.append(np.full((1, 5), float(ray)), gates)
+        buffer.trim()
+
+        self.assertEqual(buffer.capacity, 5)
+        np.testing.assert_array_equal(buffer.beta[:, 0], np.arange(5))
+
+    def test_ray_buffer_views_survive_resize(self):
+        buffer = RayBuffer(num_gates=3, capacity=2)
+        buffer.append(np.ones((2, 5)), np.ones((2, 3, 4)))
+        rays, doppler = buffer.rays[:2], buffer.doppler[:2]
+
+        buffer.append(np.full((100, 5), 2.0), np.full((100, 3, 4), 2.0))
+        buffer.trim()
+        np.testing.assert_array_equal(rays, 1.0)
+        np.testing.assert_array_equal(doppler, 1.0)
+        np.testing.assert_array_equal(buffer.doppler[2:], 2.0)
+
+    def test_read_blocks_matches_read(self):
+        handler = HplHandler()
+        blocks = list(handler.read_blocks(hpl_file, rays_per_block=3))
+
+        self.assertEqual([block.dims['time'] for block in blocks], [3, 3, 1])
+        xr.testing.assert_identical(xr.concat(blocks, dim='time'), handler.read(hpl_file))
+
+    def test_read_with_dtypes(self):
+        dtypes = {'Doppler': np.float32, 'Intensity': np.float32, 'Azimuth (degrees)': np.float32}
+        ds = HplHandler().read(hpl_file, dtypes=dtypes)
+        full = HplHandler().read(hpl_file)
+
+        for name, dtype in dtypes.items():
+            self.assertEqual(ds[name].dtype, dtype)
+            np.testing.assert_array_equal(ds[name].values, full[name].values.astype(dtype))
+        self.assertEqual(ds['Beta'].dtype, np.float64)
+        np.testing.assert_array_equal(ds['time'].values, full['time'].values)
+
+    def test_corrupt_gate_line(self):
+        with open(hpl_file, 'r') as f:
+            lines = f.readlines()
+        lines[20] = lines[20].replace('.', ',', 1)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            filename = os.path.join(tmp_dir, 'corrupt.nwtc.hpl')
+            with open(filename, 'w') as f:
+                f.writelines(lines)
+            with self.assertRaises(ValueError):
+                HplHandler().read(filename)
+
+    def test_range_gate_column(self):
+        with open(hpl_file, 'r') as f:
+            lines = f.readlines()
+        full = HplHandler().read(hpl_file)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # Gates written out of order are put back in order
+            filename = os.path.join(tmp_dir, 'reordered.nwtc.hpl')
+            reordered = lines[:18] + [lines[20], lines[18], lines[19]] + lines[21:]
+            with open(filename, 'w') as f:
+                f.writelines(reordered)
+            xr.testing.assert_identical(HplHandler().read(filename), full)
+
+            # A gate written twice in place of another can't be placed
+            filename = os.path.join(tmp_dir, 'repeated.nwtc.hpl')
+            repeated = lines[:19] + [lines[18]] + lines[20:]
+            with open(filename, 'w') as f:
+                f.writelines(repeated)
+            with self.assertRaises(ValueError):
+                HplHandler().read(filename)
+
+    def test_timestamps_roll_over_midnight(self):
+        start_time = np.datetime64('2021-05-10T23:59:30.00')
+        hours = np.array([23.9950, 23.9999, 0.0001, 0.0050])
+        timestamps = decimal_hours_to_datetime64(hours, start_time)
+
+        expected = np.array([
+            '2021-05-10T23:59:42', '2021-05-10T23:59:59.64',
+            '2021-05-11T00:00:00.36', '2021-05-11T00:00:18'], dtype='datetime64[us]')
+        np.testing.assert_array_equal(timestamps, expected)
+
+    def test_first_ray_after_midnight(self):
+        start_time = np.datetime64('2021-05-10T23:59:59.90')
+        timestamps = decimal_hours_to_datetime64(np.array([0.0001]), start_time)
+        self.assertEqual(timestamps[0], np.datetime64('2021-05-11T00:00:00.36'))
+
+
+class TestCompressedHpl(unittest.TestCase):
+    """-------------------------------------------------------------------
+    Tests reading *.hpl files from gzip, zip and tar files without
+    extracting them.
+    -------------------------------------------------------------------"""
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.full = HplHandler().read(hpl_file)
+
+        name = os.path.basename(hpl_file)
+        self.compressed_files = [os.path.join(self.tmp_dir.name, f'{name}{extension}')
+                                 for extension in ['.gz', '.zip', '.tar.gz']]
+        with open(hpl_file, 'rb') as f, gzip.open(self.compressed_files[0], 'wb') as gz:
+            shutil.copyfileobj(f, gz)
+        with zipfile.ZipFile(self.compressed_files[1], 'w', zipfile.ZIP_DEFLATED) as zip_file:
+            zip_file.writestr('notes.txt', 'not an hpl file')
+            zip_file.write(hpl_file, name)
+        with tarfile.open(self.compressed_files[2], 'w:gz') as tar:
+            tar.add(hpl_file, f'hourly/{name}')
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def test_read(self):
+        handler = HplHandler()
+        for filename in self.compressed_files:
+            xr.testing.assert_identical(handler.read(filename), self.full)
+            xr.testing.assert_identical(xr.concat(list(handler.read_blocks(filename, rays_per_block=3)), dim='time'),
+                                        self.full)
+
+        # Nothing is extracted or indexed
+        self.assertEqual(sorted(os.listdir(self.tmp_dir.name)),
+                         sorted(os.path.basename(filename) for filename in self.compressed_files))
+
+    def test_read_window(self):
+        # The windowed read of the plain file writes its ray index beside it
+        plain_file = os.path.join(self.tmp_dir.name, os.path.basename(hpl_file))
+        shutil.copy(hpl_file, plain_file)
+        times = self.full['time'].values
+        expected = HplHandler().read(plain_file, time_range=(times[2], times[5]), gate_range=(10, 20))
+
+        for filename in self.compressed_files:
+            ds = HplHandler().read(filename, time_range=(times[2], times[5]), gate_range=(10, 20))
+            xr.testing.assert_identical(ds, expected)
+        ds = HplHandler().read(self.compressed_files[0], time_range=(times[-1] + 1, times[-1] + 2))
+        self.assertEqual(ds.dims['time'], 0)
+
+
+class TestSyntheticHpl(unittest.TestCase):
+    """-------------------------------------------------------------------
+    Tests that synthetic *.hpl files for benchmarks read like the lidar's.
+    -------------------------------------------------------------------"""
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.hpl_file = os.path.join(self.tmp_dir.name, 'synthetic.nwtc.hpl')
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def test_read_synthetic_file(self):
+        write_hpl(self.hpl_file, 200, 30, start_time='2021-05-10 23:59:00.25', seed=1)
+        ds = HplHandler().read(self.hpl_file)
+
+        self.assertEqual(dict(ds.sizes), {'time': 200, 'range_gate': 30})
+        np.testing.assert_array_equal(ds[['Doppler', 'Intensity', 'Beta']].to_array('name').transpose(
+            'time', 'range_gate', 'name').values, read_gates_line_by_line(self.hpl_file, 30))
+
+        # The values are written at the precision of the lidar's files
+        seconds, angles, doppler, intensity, beta = make_rays(200, 30, seed=1)
+        np.testing.assert_allclose(ds['Doppler'].values, doppler, atol=5e-5)
+        np.testing.assert_allclose(ds['Intensity'].values, intensity, atol=5e-7)
+        np.testing.assert_allclose(ds['Roll (degrees)'].values, angles[:, 3], atol=5e-3)
+
+        # The rays cross midnight
+        timestamps = ds['Timestamp'].values
+        self.assertTrue((np.diff(timestamps) > np.timedelta64(0)).all())
+        self.assertEqual(str(timestamps[0])[:10], '2021-05-10')
+        self.assertEqual(str(timestamps[-1])[:10], '2021-05-11')
+
+    def test_same_layout_as_lidar_files(self):
+        write_hpl(self.hpl_file, 3, 720)
+        with open(self.hpl_file, 'rb') as f, open(hpl_file, 'rb') as sample:
+            lines, sample_lines = f.read().split(b'\r\n'), sample.read().split(b'\r\n')
+
+        self.assertEqual(len(lines), 17 + 3 * 721)
+        for line, sample_line in zip(lines[:17], sample_lines):
+            self.assertEqual(line.split(b'\t')[0], sample_line.split(b'\t')[0])
+        self.assertEqual([len(line.split()) for line in lines[17:19]], [5, 4])
+        self.assertNotIn(b'E-0', lines[18])
+
+        # The same seed gives the same file
+        with open(self.hpl_file, 'rb') as f:
+            content = f.read()
+        write_hpl(self.hpl_file, 3, 720)
+        with open(self.hpl_file, 'rb') as f:
+            self.assertEqual(f.read(), content)
+
+
+class TestHplRayIndex(unittest.TestCase):
+    """-------------------------------------------------------------------
+    Tests windowed reads of *.hpl files through the sidecar ray index.
+    -------------------------------------------------------------------"""
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.hpl_file = os.path.join(self.tmp_dir.name, os.path.basename(hpl_file))
+        shutil.copy(hpl_file, self.hpl_file)
+        self.full = HplHandler().read(self.hpl_file)
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def test_read_window(self):
+        times = self.full['time'].values
+        ds = HplHandler().read(self.hpl_file, time_range=(times[2], times[5]), gate_range=(10, 20))
+
+        xr.testing.assert_identical(ds, self.full.isel(time=slice(2, 5), range_gate=slice(10, 20)))
+        self.assertTrue(os.path.isfile(get_index_filename(self.hpl_file)))
+
+    def test_index_invalidated_when_file_changes(self):
+        offsets, hours = load_ray_index(self.hpl_file, 720)
+        self.assertEqual(len(hours), 7)
+        self.assertEqual(len(offsets), 8)
+
+        # Drop the last ray; the index must be rebuilt rather than reused
+        with open(self.hpl_file, 'rb+') as f:
+            f.truncate(offsets[-2])
+        offsets, hours = load_ray_index(self.hpl_file, 720)
+        self.assertEqual(len(hours), 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
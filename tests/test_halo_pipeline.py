@@ -0,0 +1,156 @@
+import glob
+import os
+import sys
+import tarfile
+import tempfile
+import unittest
+import zipfile
+from unittest import mock
+
+import numpy as np
+import xarray as xr
+import yaml
+
+# Add the project directory to the pythonpath
+test_dir = os.path.dirname(os.path.realpath(__file__))
+project_dir = os.path.dirname(test_dir)
+lambda_dir = os.path.join(project_dir, 'lambda_function')
+sys.path.insert(0, lambda_dir)
+sys.path.insert(0, os.path.join(project_dir, 'benchmarks'))
+
+from pipelines.awa_halo_ingest.pipeline import Pipeline
+from synthetic_hpl import write_hpl
+
+pipeline_config = os.path.join(lambda_dir, 'pipelines/awa_halo_ingest/config/pipeline_config_nwtc.yml')
+
+storage_config = """
+storage:
+  classname: ${STORAGE_CLASSNAME}
+  parameters:
+    retain_input_files: ${RETAIN_INPUT_FILES}
+    root_dir: ${ROOT_DIR}
+
+  file_handlers:
+    input:
+      hpl:
+        file_pattern: '.*\\.hpl(?:\\.zip|\\.tar\\.gz)?$'
+        classname: pipelines.awa_halo_ingest.filehandlers.HplHandler
+
+    output:
+      netcdf:
+        file_extension: '.nc'
+        classname: tsdat.io.filehandlers.NetCdfHandler
+"""
+
+
+class TestHaloPipeline(unittest.TestCase):
+    """-------------------------------------------------------------------
+    Tests reading .hpl files into the Halo pipeline.
+    -------------------------------------------------------------------"""
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.storage_config = os.path.join(self.tmp_dir.name, 'storage_config.yml')
+        with open(self.storage_config, 'w') as f:
+            f.write(storage_config)
+
+        # Two workers, so the files are parsed in parallel
+        self.environ = mock.patch.dict(os.environ, {
+            'STORAGE_CLASSNAME': 'tsdat.io.FilesystemStorage',
+            'RETAIN_INPUT_FILES': 'True',
+            'ROOT_DIR': os.path.join(self.tmp_dir.name, 'storage'),
+            'MAX_WORKERS': '2',
+        })
+        self.environ.start()
+
+        self.hpl_files = []
+        for hour, seed in [(0, 0), (1, 1)]:
+            filename = os.path.join(self.tmp_dir.name, f'hour{hour}.nwtc.hpl')
+            write_hpl(filename, 120, 40, start_time=f'2021-05-10 0{hour}:01:25.78', seed=seed)
+            self.hpl_files.append(filename)
+
+    def tearDown(self) -> None:
+        self.environ.stop()
+        self.tmp_dir.cleanup()
+
+    def create_pipeline(self, **options) -> Pipeline:
+        # The nwtc pipeline, with options added to its pipeline section
+        with open(pipeline_config) as f:
+            config = yaml.safe_load(f)
+        config['pipeline'].update(options)
+        config_file = os.path.join(self.tmp_dir.name, 'pipeline_config.yml')
+        with open(config_file, 'w') as f:
+            yaml.safe_dump(config, f)
+        return Pipeline(config_file, self.storage_config)
+
+    def read(self, file_paths, **options):
+        pipeline = self.create_pipeline(**options)
+        raw_mapping = pipeline.read_and_persist_raw_files(file_paths)
+        return pipeline.reduce_raw_datasets(raw_mapping, pipeline.config.dataset_definition)
+
+    def test_read_several_files(self):
+        datasets = self.read(self.hpl_files[::-1])
+        self.assertEqual(len(datasets), 1)
+
+        expected = xr.concat([self.read([filename])[0] for filename in self.hpl_files], dim='time')
+        self.assertEqual(datasets[0].sizes['time'], 240)
+        self.assertTrue((datasets[0]['time'].diff('time').values > np.timedelta64(0)).all())
+        xr.testing.assert_equal(datasets[0], expected)
+
+    def test_read_in_process(self):
+        # One file, or one worker, is parsed without a worker process
+        with mock.patch('pipelines.awa_halo_ingest.pipeline.map_in_processes') as map_in_processes:
+            datasets = self.read(self.hpl_files[:1])
+            with mock.patch.dict(os.environ, {'MAX_WORKERS': '1'}):
+                self.read(self.hpl_files)
+        map_in_processes.assert_not_called()
+        self.assertEqual(datasets[0].sizes['time'], 120)
+
+    def test_unreadable_file(self):
+        filename = os.path.join(self.tmp_dir.name, 'notes.txt')
+        with open(filename, 'w') as f:
+            f.write('not a .hpl file')
+
+        with self.assertWarnsRegex(UserWarning, "Couldn't use extracted raw file"):
+            datasets = self.read([self.hpl_files[0], filename])
+        self.assertEqual(datasets[0].sizes['time'], 120)
+
+    def test_raw_dtype(self):
+        full = self.read(self.hpl_files[:1])[0]
+        self.assertEqual(full['doppler'].dtype, np.float64)
+        self.assertEqual(full['intensity'].dtype, np.float64)
+
+        compact = self.read(self.hpl_files[:1], raw_dtype='float32')[0]
+        for name in ['doppler', 'intensity', 'azimuth']:
+            self.assertEqual(compact[name].dtype, np.float32)
+            np.testing.assert_array_equal(compact[name].values, full[name].values.astype(np.float32))
+        np.testing.assert_array_equal(compact['time'].values, full['time'].values)
+
+    def test_run_archives(self):
+        # The .hpl file is under a folder, which tsdat wouldn't find if it
+        # extracted the archives
+        name = os.path.basename(self.hpl_files[0])
+        archives = [self.hpl_files[0] + '.zip', self.hpl_files[0] + '.tar.gz']
+        with zipfile.ZipFile(archives[0], 'w') as zip_file:
+            zip_file.write(self.hpl_files[0], f'hourly/{name}')
+        with tarfile.open(archives[1], 'w:gz') as tar:
+            tar.add(self.hpl_files[0], f'hourly/{name}')
+
+        for archive in archives:
+            for options in [{}, {'rays_per_block': 50}]:
+                self.create_pipeline(**options).run(archive)
+                outputs = glob.glob(os.path.join(os.environ['ROOT_DIR'], 'nwtc/nwtc.z01-lidar.a1/*.nc'))
+                self.assertEqual(len(outputs), 1)
+                with xr.open_dataset(outputs[0]) as output:
+                    self.assertEqual(output.sizes['time'], 120)
+                os.remove(outputs[0])
+
+    def test_different_range_gates(self):
+        filename = os.path.join(self.tmp_dir.name, 'hour2.nwtc.hpl')
+        write_hpl(filename, 120, 50, start_time='2021-05-10 02:01:25.78')
+
+        with self.assertRaises(ValueError):
+            self.read([self.hpl_files[0], filename])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+import os
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+# Add the project directory to the pythonpath
+test_dir = os.path.dirname(os.path.realpath(__file__))
+project_dir = os.path.dirname(test_dir)
+lambda_dir = os.path.join(project_dir, 'lambda_function')
+sys.path.insert(0, lambda_dir)
+
+from pipelines.awa_halo_ingest.pipeline import PLOTS, get_cell_edges, render_plot
+
+
+class TestHaloPlots(unittest.TestCase):
+    """-------------------------------------------------------------------
+    Tests rendering the Halo lidar plots.
+    -------------------------------------------------------------------"""
+    def test_cell_edges(self):
+        np.testing.assert_allclose(get_cell_edges([1, 2, 4]), [0.5, 1.5, 3, 5])
+
+    def test_render_plot(self):
+        time = pd.date_range('2021-05-10', periods=20, freq='3min').values
+        distance = np.arange(10) * 30.0 + 15
+        values = np.random.default_rng(0).normal(size=(20, 10)).astype(np.float32)
+        data = xr.Dataset({'doppler': (('time', 'distance'), values), 'SNR': (('time', 'distance'), values)},
+                          coords={'time': time, 'distance': distance})
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for method in ['pcolormesh', 'contourf']:
+                for name, title, variable, label, kwargs in PLOTS:
+                    tmp_path = os.path.join(tmp_dir, f'{method}.{name}.png')
+                    self.assertEqual(render_plot((tmp_path, title, variable, label, kwargs, method, data)), tmp_path)
+                    self.assertGreater(os.path.getsize(tmp_path), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
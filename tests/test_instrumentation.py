@@ -0,0 +1,82 @@
+import os
+import sys
+import time
+import unittest
+
+# Add the project directory to the pythonpath
+test_dir = os.path.dirname(os.path.realpath(__file__))
+project_dir = os.path.dirname(test_dir)
+lambda_dir = os.path.join(project_dir, 'lambda_function')
+sys.path.insert(0, lambda_dir)
+
+import numpy as np
+
+from pipelines.utils.instrumentation import get_rss_mb, instrument, stage
+
+
+class TestInstrumentation(unittest.TestCase):
+    """-------------------------------------------------------------------
+    Tests timing the stages of a pipeline run.
+    -------------------------------------------------------------------"""
+    def run_stages(self, trace_memory=False):
+        with instrument('awa_halo_ingest.run', trace_memory) as instrumentation:
+            with stage('run'):
+                for i in range(3):
+                    with stage('read'):
+                        time.sleep(0.01)
+                with stage('store'):
+                    data = bytearray(8 * 2 ** 20)
+                    del data
+        return instrumentation
+
+    def test_record(self):
+        record = self.run_stages(trace_memory=True).get_record()
+
+        stages = {summary['Stage']: summary for summary in record['Stages']}
+        self.assertEqual(list(stages), ['run', 'run/read', 'run/store'])
+        self.assertEqual(stages['run/read']['Count'], 3)
+        self.assertGreaterEqual(stages['run/read']['Wall_Seconds'], 0.03)
+        self.assertGreaterEqual(record['Wall_Seconds'], stages['run']['Wall_Seconds'])
+
+        if sys.version_info >= (3, 9):
+            self.assertGreaterEqual(stages['run/store']['Traced_Peak_MB'], 8)
+            self.assertGreaterEqual(stages['run']['Traced_Peak_MB'], 8)
+            self.assertLess(stages['run/read']['Traced_Peak_MB'], 8)
+
+    @unittest.skipIf(get_rss_mb() is None, 'Resident memory is not available')
+    def test_peak_rss_per_stage(self):
+        # A peak set before the run, e.g. by an earlier invocation of a warm
+        # Lambda container, doesn't count towards the stages
+        data = np.ones(32 * 2 ** 20)
+        del data
+
+        with instrument('awa_halo_ingest.run') as instrumentation:
+            with stage('read'):
+                data = np.ones(16 * 2 ** 20)
+                time.sleep(0.05)
+                del data
+            with stage('store'):
+                time.sleep(0.05)
+        record = instrumentation.get_record()
+
+        stages = {summary['Stage']: summary for summary in record['Stages']}
+        self.assertGreaterEqual(stages['read']['Peak_Rss_MB'], stages['store']['Peak_Rss_MB'] + 100)
+        self.assertGreaterEqual(record['Peak_Rss_MB'], stages['read']['Peak_Rss_MB'])
+        self.assertGreaterEqual(record['Process_Max_Rss_MB'], stages['read']['Peak_Rss_MB'] + 100)
+
+    def test_chrome_trace(self):
+        events = self.run_stages().get_chrome_trace()['traceEvents']
+
+        self.assertEqual([event['name'] for event in events], ['run', 'read', 'read', 'read', 'store'])
+        run, store = events[0], events[-1]
+        self.assertEqual(run['ph'], 'X')
+        self.assertLessEqual(run['ts'], store['ts'])
+        self.assertGreaterEqual(run['ts'] + run['dur'], store['ts'] + store['dur'])
+
+    def test_stage_without_instrumentation(self):
+        with stage('read') as measurements:
+            self.assertIsNone(measurements)
+
+
+if __name__ == '__main__':
+    unittest.main()
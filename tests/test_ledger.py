@@ -0,0 +1,96 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+# Add the project directory to the pythonpath
+test_dir = os.path.dirname(os.path.realpath(__file__))
+project_dir = os.path.dirname(test_dir)
+lambda_dir = os.path.join(project_dir, 'lambda_function')
+data_dir = os.path.join(project_dir, 'data')
+sys.path.insert(0, lambda_dir)
+
+from tsdat.io import S3Path
+
+from pipelines import runner
+from pipelines.runner import pipeline_cache, run_pipeline
+from pipelines.utils.ledger import SqliteLedger, get_ledger_key
+
+
+storage_config = """
+storage:
+  classname: ${STORAGE_CLASSNAME}
+  parameters:
+    retain_input_files: ${RETAIN_INPUT_FILES}
+    root_dir: ${ROOT_DIR}
+
+  file_handlers:
+    input:
+      hpl:
+        file_pattern: '.*\\.hpl$'
+        classname: pipelines.awa_halo_ingest.filehandlers.HplHandler
+
+    output:
+      netcdf:
+        file_extension: '.nc'
+        classname: tsdat.io.filehandlers.NetCdfHandler
+"""
+
+
+class TestLedger(unittest.TestCase):
+    """-------------------------------------------------------------------
+    Tests skipping files that are delivered more than once.
+    -------------------------------------------------------------------"""
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.input_file = os.path.join(self.tmp_dir.name, 'test.nwtc.hpl')
+        shutil.copy(os.path.join(data_dir, 'awa_halo_ingest/test.nwtc.hpl'), self.input_file)
+
+        self.storage_config = os.path.join(self.tmp_dir.name, 'storage_config.yml')
+        with open(self.storage_config, 'w') as f:
+            f.write(storage_config)
+
+        self.environ = mock.patch.dict(os.environ, {
+            'STORAGE_CLASSNAME': 'tsdat.io.FilesystemStorage',
+            'RETAIN_INPUT_FILES': 'True',
+            'ROOT_DIR': os.path.join(self.tmp_dir.name, 'storage'),
+            'LEDGER_CLASSNAME': 'pipelines.utils.ledger.SqliteLedger',
+            'LEDGER_PATH': os.path.join(self.tmp_dir.name, 'ledger.sqlite'),
+        })
+        self.environ.start()
+
+    def tearDown(self) -> None:
+        self.environ.stop()
+        pipeline_cache.clear()
+        self.tmp_dir.cleanup()
+
+    def test_ledger_key(self):
+        key = get_ledger_key([self.input_file], 'awa_halo_ingest.run', [self.storage_config])
+        self.assertEqual(key, get_ledger_key([self.input_file], 'awa_halo_ingest.run', [self.storage_config]))
+
+        with open(self.storage_config, 'a') as f:
+            f.write('\n')
+        self.assertNotEqual(key, get_ledger_key([self.input_file], 'awa_halo_ingest.run', [self.storage_config]))
+
+        s3_path = S3Path('bucket', 'raw/test.nwtc.hpl')
+        s3_path.etag = '84703366a2bac7da56749b6cdbe37de1'
+        quoted_path = S3Path('bucket', 'raw/test.nwtc.hpl')
+        quoted_path.etag = '"84703366a2bac7da56749b6cdbe37de1"'
+        self.assertEqual(get_ledger_key([s3_path], 'run', []), get_ledger_key([quoted_path], 'run', []))
+
+    def test_duplicate_delivery_skipped(self):
+        self.assertTrue(run_pipeline([self.input_file], self.storage_config))
+
+        with mock.patch.object(runner, 'get_pipeline') as get_pipeline:
+            self.assertTrue(run_pipeline([self.input_file], self.storage_config))
+        get_pipeline.assert_not_called()
+
+        records = SqliteLedger(os.environ['LEDGER_PATH'])
+        with records.connect() as connection:
+            self.assertEqual(connection.execute('SELECT pipeline FROM runs').fetchall(), [('awa_halo_ingest.run',)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+import os
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+# Add the project directory to the pythonpath
+test_dir = os.path.dirname(os.path.realpath(__file__))
+project_dir = os.path.dirname(test_dir)
+lambda_dir = os.path.join(project_dir, 'lambda_function')
+sys.path.insert(0, lambda_dir)
+
+from tsdat.io import FileHandler
+from tsdat.io.filehandlers import NetCdfHandler
+from pipelines.utils.netcdf import NetCdfAppender, apply_encoding_profile
+
+
+class TestNetCdfAppender(unittest.TestCase):
+    """-------------------------------------------------------------------
+    Tests writing netCDF files one block at a time.
+    -------------------------------------------------------------------"""
+    def setUp(self) -> None:
+        FileHandler.register_file_handler('.*\\.nc', NetCdfHandler())
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def test_append_blocks(self):
+        time = pd.date_range('2021-05-10', periods=7, freq='790ms').values
+        expected = xr.Dataset(
+            {
+                'doppler': (('time', 'distance'), np.random.default_rng(0).normal(size=(7, 4))),
+                'qc_doppler': (('time', 'distance'), np.arange(28, dtype=np.int32).reshape(7, 4)),
+            },
+            coords={'time': time, 'distance': np.arange(4) * 18.0},
+        )
+        expected['time'].attrs['units'] = 'seconds since 1970-01-01T00:00:00'
+        expected['doppler'][2, 1] = np.nan
+
+        filename = os.path.join(self.tmp_dir.name, 'blocks.nc')
+        appender = NetCdfAppender(filename)
+        for start in range(0, 7, 3):
+            appender.append(expected.isel(time=slice(start, start + 3)).copy(deep=True))
+
+        single_filename = os.path.join(self.tmp_dir.name, 'single.nc')
+        FileHandler.write(expected.copy(deep=True), single_filename)
+
+        with xr.open_dataset(filename) as written, xr.open_dataset(single_filename) as single:
+            xr.testing.assert_identical(written, single)
+
+
+class TestEncodingProfile(unittest.TestCase):
+    """-------------------------------------------------------------------
+    Tests chunking, compressing and packing output variables.
+    -------------------------------------------------------------------"""
+    profile = {
+        'chunks': {'time': 4, 'distance': 8},
+        'zlib': True,
+        'complevel': 4,
+        'shuffle': True,
+        'pack': {'doppler': {'dtype': 'int16', 'scale_factor': 0.002}},
+    }
+
+    def setUp(self) -> None:
+        FileHandler.register_file_handler('.*\\.nc', NetCdfHandler())
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmp_dir.name, 'encoded.nc')
+
+        doppler = np.random.default_rng(0).uniform(-20, 20, size=(6, 5)).astype(np.float32)
+        doppler[2, 1] = -9999
+        self.dataset = xr.Dataset(
+            {
+                'doppler': (('time', 'distance'), doppler, {'_FillValue': -9999}),
+                'qc_doppler': (('time', 'distance'), np.zeros((6, 5), dtype=np.int32)),
+            },
+            coords={'time': np.arange(6), 'distance': np.arange(5) * 18.0},
+        )
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def test_encoding_profile(self):
+        FileHandler.write(apply_encoding_profile(self.dataset.copy(deep=True), self.profile), self.filename)
+
+        with xr.open_dataset(self.filename) as written:
+            encoding = written['qc_doppler'].encoding
+            self.assertEqual(encoding['chunksizes'], (4, 5))
+            self.assertTrue(encoding['zlib'] and encoding['shuffle'])
+            self.assertEqual(written['doppler'].encoding['dtype'], np.int16)
+            self.assertEqual(written['doppler'].dtype, np.float32)
+
+            expected = self.dataset['doppler'].where(self.dataset['doppler'] != -9999)
+            np.testing.assert_allclose(written['doppler'].values, expected.values, atol=0.001)
+            self.assertTrue(np.isnan(written['doppler'].values[2, 1]))
+
+    def test_pack_out_of_range(self):
+        self.dataset['doppler'][0, 0] = 70
+        self.dataset['doppler'][1, 0] = -70
+        with self.assertLogs(level='WARNING'):
+            apply_encoding_profile(self.dataset, self.profile)
+        FileHandler.write(self.dataset, self.filename)
+
+        with xr.open_dataset(self.filename) as written:
+            self.assertTrue(np.isnan(written['doppler'].values[:2, 0]).all())
+            self.assertTrue(np.isnan(written['doppler'].values[2, 1]))
+            self.assertEqual(np.count_nonzero(np.isnan(written['doppler'].values)), 3)
+
+    def test_append_encoded_blocks(self):
+        dataset = self.dataset.copy(deep=True)
+        dataset.encoding['unlimited_dims'] = {'time'}
+
+        appender = NetCdfAppender(self.filename)
+        for start in range(0, 6, 2):
+            appender.append(apply_encoding_profile(dataset.isel(time=slice(start, start + 2)), self.profile))
+
+        with xr.open_dataset(self.filename) as written:
+            self.assertEqual(written['doppler'].encoding['chunksizes'], (4, 5))
+            np.testing.assert_allclose(written['doppler'].values[3:], self.dataset['doppler'].values[3:], atol=0.001)
+            self.assertTrue(np.isnan(written['doppler'].values[2, 1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
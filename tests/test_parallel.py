@@ -0,0 +1,58 @@
+import os
+import sys
+import unittest
+from unittest import mock
+
+# Add the project directory to the pythonpath
+test_dir = os.path.dirname(os.path.realpath(__file__))
+project_dir = os.path.dirname(test_dir)
+lambda_dir = os.path.join(project_dir, 'lambda_function')
+sys.path.insert(0, lambda_dir)
+
+from pipelines.utils import parallel
+
+
+def square(x):
+    return x * x
+
+
+def fail_on_two(x):
+    if x == 2:
+        raise ValueError('two')
+    return x
+
+
+def get_pid(x):
+    return os.getpid()
+
+
+class TestParallel(unittest.TestCase):
+    """-------------------------------------------------------------------
+    Tests running work in worker processes.
+    -------------------------------------------------------------------"""
+
+    def test_map_in_processes_keeps_order(self):
+        self.assertEqual(parallel.map_in_processes(square, range(10), max_workers=2), [x * x for x in range(10)])
+
+    def test_iterate_in_processes_yields_every_item(self):
+        self.assertEqual(sorted(parallel.iterate_in_processes(square, range(5), max_workers=2)),
+                         [(x, x * x) for x in range(5)])
+        self.assertEqual(sorted(parallel.iterate_with_pipes(square, range(5), max_workers=2)),
+                         [(x, x * x) for x in range(5)])
+
+    def test_uses_pipes_without_process_pools(self):
+        # AWS Lambda raises OSError when the pool's semaphores are created
+        with mock.patch.object(parallel, 'ProcessPoolExecutor', side_effect=OSError(38, 'Function not implemented')):
+            self.assertEqual(parallel.map_in_processes(square, [1, 2, 3], max_workers=2), [1, 4, 9])
+            self.assertNotIn(os.getpid(), parallel.map_in_processes(get_pid, [1, 2], max_workers=2))
+
+    def test_map_with_pipes_raises_worker_errors(self):
+        with self.assertRaises(ValueError):
+            parallel.map_with_pipes(fail_on_two, [1, 2, 3], max_workers=2)
+
+    def test_runs_serially_with_one_worker(self):
+        self.assertEqual(parallel.map_in_processes(get_pid, [1, 2], max_workers=1), [os.getpid()] * 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
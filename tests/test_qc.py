@@ -0,0 +1,158 @@
+import os
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+# Add the project directory to the pythonpath
+test_dir = os.path.dirname(os.path.realpath(__file__))
+project_dir = os.path.dirname(test_dir)
+lambda_dir = os.path.join(project_dir, 'lambda_function')
+sys.path.insert(0, lambda_dir)
+
+from tsdat import Config
+from tsdat.exceptions import QCError
+from tsdat.qc import QualityHandler, QualityManagement
+
+from pipelines.awa_halo_ingest.pipeline import Pipeline
+from pipelines.utils.log_helper import logger
+from pipelines.utils.pipeline import A2ePipeline
+from pipelines.utils.qc import QualityEngine
+
+pipeline_config = os.path.join(lambda_dir, 'pipelines/awa_halo_ingest/config/pipeline_config_nwtc.yml')
+
+
+class CountVariables(QualityHandler):
+    """A handler that keeps state between runs, which tsdat makes for each
+    variable."""
+    def run(self, variable_name: str, results_array: np.ndarray):
+        self.count = getattr(self, 'count', 0) + 1
+        self.ds[variable_name].attrs['handler_runs'] = self.count
+
+
+class TestQualityEngine(unittest.TestCase):
+    """-------------------------------------------------------------------
+    Tests that the fused QC engine gives the same results as tsdat's
+    QualityManagement with the Halo lidar quality managers.
+    -------------------------------------------------------------------"""
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+        rng = np.random.default_rng(0)
+        shape = (50, 40)
+        doppler = np.cumsum(rng.normal(0, 0.6, shape), axis=0).astype(np.float32)
+        doppler[3, 5] = -9999
+        intensity = rng.uniform(0.99, 1.2, shape).astype(np.float32)
+        intensity[7, 2] = np.nan
+        with np.errstate(invalid='ignore'):
+            snr = (10 * np.log10(intensity - 1)).astype(np.float32)
+
+        variables = {name: (('time',), rng.uniform(0, 90, shape[0]).astype(np.float32),
+                            {'_FillValue': -9999, 'long_name': name.title(), 'units': 'deg'})
+                     for name in ['azimuth', 'elevation', 'pitch', 'roll']}
+        variables['azimuth'][1][4] = np.nan
+        variables.update({
+            'doppler': (('time', 'distance'), doppler,
+                        {'_FillValue': -9999, 'long_name': 'Doppler', 'units': 'm/s', 'valid_delta': 1}),
+            'intensity': (('time', 'distance'), intensity,
+                          {'_FillValue': -9999, 'long_name': 'Intensity', 'units': 'mag', 'valid_range': [1, 1.15]}),
+            'SNR': (('time', 'distance'), snr, {'_FillValue': np.nan}),
+        })
+        self.dataset = xr.Dataset(
+            variables,
+            coords={
+                'time': ('time', pd.date_range('2021-05-10', periods=shape[0], freq='790ms').values,
+                         {'long_name': 'Time (UTC)', 'units': 'seconds since 1970-01-01T00:00:00'}),
+                'distance': ('distance', np.arange(shape[1]) * 18.0),
+            },
+        )
+
+        # The last ray of the previous block
+        self.previous_data = self.dataset.isel(time=[-1]).copy(deep=True)
+        self.previous_data['doppler'].values[:] = doppler[0] + 5
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def write_config(self, uncomment_low_snr: bool, extra_managers: str = '') -> str:
+        with open(pipeline_config) as f:
+            config = f.read()
+        if uncomment_low_snr:
+            start = config.index('  # manage_low_snr:')
+            config = config[:start] + config[start:].replace('  # ', '  ')
+        config += extra_managers
+        filename = os.path.join(self.tmp_dir.name, 'pipeline_config.yml')
+        with open(filename, 'w') as f:
+            f.write(config)
+        return filename
+
+    def assert_same_as_tsdat(self, config_file: str, previous_data: xr.Dataset = None) -> xr.Dataset:
+        # tsdat changes the variable lists of the config, so each gets a copy
+        expected = QualityManagement.run(self.dataset.copy(deep=True), Config.load([config_file]), previous_data)
+        result = QualityEngine(Config.load([config_file])).run(self.dataset.copy(deep=True), previous_data)
+
+        self.assertTrue(result.identical(expected))
+        for name in result.variables:
+            self.assertEqual(result[name].dtype, expected[name].dtype)
+        return result
+
+    def test_same_as_tsdat(self):
+        result = self.assert_same_as_tsdat(self.write_config(False))
+
+        self.assertEqual(result['qc_doppler'].attrs['flag_masks'], [2, 1])
+        self.assertTrue(result['qc_doppler'].values[3, 5] & 1)
+        self.assertTrue(result['qc_intensity'].values.any())
+
+        result = self.assert_same_as_tsdat(self.write_config(False), self.previous_data)
+        self.assertTrue((result['qc_doppler'].values[0] & 2).all())
+
+    def test_groups(self):
+        engine = QualityEngine(Config.load([self.write_config(True)]))
+
+        # The checks of each variable in the valid delta and missing values
+        # managers run together, and the others run on their own
+        names = [[step.definition.name for step in group] for group in engine.groups]
+        self.assertEqual(names, [['manage_missing_coordinates'], ['manage_coordinate_monotonicity'],
+                                 ['manage_valid_delta', 'manage_missing_values'], ['manage_low_snr']])
+
+    def test_low_snr(self):
+        with self.assertLogs(logger, level='WARNING') as logs:
+            result = self.assert_same_as_tsdat(self.write_config(True))
+
+        low_snr = ~(self.dataset['SNR'].values >= -20)
+        np.testing.assert_array_equal(result['qc_doppler'].values & 4 > 0, low_snr)
+        self.assertIn(f'failed for {low_snr.sum()} of {low_snr.size} values', logs.output[-1])
+
+    def test_handler_per_variable(self):
+        result = self.assert_same_as_tsdat(self.write_config(False, f"""
+  count_variables:
+    checker:
+      classname: tsdat.qc.checkers.CheckMissing
+    handlers:
+      - classname: {__name__}.CountVariables
+    variables:
+      - doppler
+      - intensity
+"""))
+        self.assertEqual(result['doppler'].attrs['handler_runs'], 1)
+        self.assertEqual(result['intensity'].attrs['handler_runs'], 1)
+
+    def test_opt_in(self):
+        self.assertFalse(A2ePipeline.use_quality_engine)
+        self.assertTrue(Pipeline.use_quality_engine)
+
+    def test_fail_pipeline(self):
+        time = self.dataset.time.values.copy()
+        time[10] = np.datetime64('NaT')
+        self.dataset = self.dataset.assign_coords(time=time)
+
+        with self.assertRaises(QCError):
+            QualityEngine(Config.load([self.write_config(False)])).run(self.dataset, None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,235 @@
+import io
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+# Add the project directory to the pythonpath
+test_dir = os.path.dirname(os.path.realpath(__file__))
+project_dir = os.path.dirname(test_dir)
+lambda_dir = os.path.join(project_dir, 'lambda_function')
+sys.path.insert(0, lambda_dir)
+
+from botocore.exceptions import ClientError
+from tsdat.io import FilesystemStorage, S3Path
+
+from pipelines.utils.aggregation import TimeAggregator
+from pipelines.utils.rollup import LOCK_KEY, MANIFEST_KEY, DailyRollup, S3Store, lock_store, open_store
+
+AGGREGATION = {
+    'interval': '10min',
+    'variables': ['doppler', 'SNR'],
+    'filtered': {'doppler_snr_filtered': {'variable': 'doppler', 'where': 'SNR', 'min': -20}},
+}
+
+
+class DictS3Client:
+    """-------------------------------------------------------------------
+    A stand-in for the boto3 S3 client that keeps objects in a dict.
+    -------------------------------------------------------------------"""
+    class exceptions:
+        class NoSuchKey(Exception):
+            pass
+
+    def __init__(self):
+        self.objects = {}
+        self.puts = []
+
+    def get_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise self.exceptions.NoSuchKey(Key)
+        return {'Body': io.BytesIO(self.objects[(Bucket, Key)])}
+
+    def put_object(self, Bucket, Key, Body, IfNoneMatch=None):
+        if IfNoneMatch == '*' and (Bucket, Key) in self.objects:
+            raise ClientError({'Error': {'Code': 'PreconditionFailed'}}, 'PutObject')
+        self.objects[(Bucket, Key)] = bytes(Body)
+        self.puts.append(Key)
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop((Bucket, Key), None)
+
+    def list_objects_v2(self, Bucket, Prefix, MaxKeys=1000):
+        keys = sorted(key for bucket, key in self.objects if bucket == Bucket and key.startswith(Prefix))
+        return {'Contents': [{'Key': key} for key in keys[:MaxKeys]]}
+
+    def get_paginator(self, operation):
+        client = self
+
+        class Paginator:
+            def paginate(self, Bucket, Prefix):
+                yield client.list_objects_v2(Bucket, Prefix)
+        return Paginator()
+
+
+def make_hour(start: str, num_rays: int = 300, seed: int = 0, tmp_dir: str = None) -> xr.Dataset:
+    """Makes an hour of processed lidar data, written to netCDF with packed
+    doppler and read back, like the output the pipeline reopens."""
+    rng = np.random.default_rng(seed)
+    time = pd.Timestamp(start) + pd.to_timedelta(np.sort(rng.uniform(0, 3599, num_rays)), 's')
+    doppler = rng.normal(size=(num_rays, 20)).astype(np.float32)
+    doppler[rng.random(doppler.shape) < 0.05] = np.nan
+    dataset = xr.Dataset(
+        {
+            'doppler': (('time', 'distance'), doppler, {'units': 'm/s'}),
+            'qc_doppler': (('time', 'distance'), np.isnan(doppler).astype(np.int32) * 2),
+            'SNR': (('time', 'distance'), rng.normal(-15, 10, size=(num_rays, 20)).astype(np.float32),
+                    {'_FillValue': np.nan}),
+            'azimuth': ('time', rng.uniform(0, 360, num_rays).astype(np.float32)),
+        },
+        coords={'time': time.values, 'distance': np.arange(20) * 18.0},
+        attrs={'datastream_name': 'nwtc.z01-lidar.a1', 'input_files': f'raw.{start}.hpl', 'history': 'test'},
+    )
+    dataset['doppler'].encoding = {'dtype': 'int16', 'scale_factor': 0.002, '_FillValue': -32768}
+    dataset['time'].encoding = {'units': 'seconds since 1970-01-01T00:00:00', 'dtype': 'float64'}
+
+    filename = os.path.join(tmp_dir, f'hour.{time[0]:%Y%m%d%H%M%S}.{seed}.nc')
+    dataset.to_netcdf(filename)
+    return xr.open_dataset(filename).load()
+
+
+class TestDailyRollup(unittest.TestCase):
+    """-------------------------------------------------------------------
+    Tests keeping daily stores of hourly ingests up to date.
+    -------------------------------------------------------------------"""
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.storage = FilesystemStorage({'root_dir': os.path.join(self.tmp_dir.name, 'storage')})
+        self.hours = [make_hour(f'2021-05-10 0{hour}:01:25', seed=hour, tmp_dir=self.tmp_dir.name)
+                      for hour in range(3)]
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def create_rollup(self) -> DailyRollup:
+        # Small blocks, so rays are moved in several blocks
+        return DailyRollup(self.storage, 'nwtc.z01-lidar-daily.a1', AGGREGATION, rows_per_block=64)
+
+    def open_day(self, rollup: DailyRollup, day: str = '2021-05-10'):
+        store = open_store(self.storage, rollup.get_store_path(np.datetime64(day)))
+        return store, xr.open_zarr(store, chunks=None), xr.open_zarr(store, group='aggregate', chunks=None)
+
+    def assert_day(self, rollup: DailyRollup, hours):
+        expected = xr.concat(hours, dim='time')
+        store, rays, aggregate = self.open_day(rollup)
+
+        # The rays and QC bits of every hour in time order
+        for name in ['doppler', 'qc_doppler', 'SNR', 'azimuth', 'time']:
+            np.testing.assert_array_equal(rays[name].values, expected[name].values)
+        self.assertEqual(rays['doppler'].encoding['dtype'], np.int16)
+        self.assertEqual(rays.attrs['datastream_name'], 'nwtc.z01-lidar-daily.a1')
+
+        # Statistics of every interval of the day, including the intervals
+        # split between two hours
+        aggregator = TimeAggregator.from_config(AGGREGATION)
+        aggregator.add(expected)
+        statistics = aggregator.result()
+        self.assertEqual(aggregate.sizes['time'], 144)
+        xr.testing.assert_allclose(aggregate.sel(time=statistics['time']).drop_vars('distance'),
+                                   statistics.drop_vars('distance'), rtol=1e-5)
+        self.assertEqual(int(aggregate['doppler_count'].sum()), int(statistics['doppler_count'].sum()))
+
+        manifest = json.loads(store[MANIFEST_KEY])
+        self.assertEqual(list(manifest['files']), [hour.attrs['input_files'] for hour in hours])
+        self.assertEqual([entry['rays'] for entry in manifest['files'].values()], [hour.sizes['time'] for hour in hours])
+        self.assertNotIn(LOCK_KEY, store)
+        return store
+
+    def test_in_order(self):
+        rollup = self.create_rollup()
+        for hour in self.hours:
+            rollup.update(hour)
+        self.assert_day(rollup, self.hours)
+
+    def test_out_of_order(self):
+        rollup = self.create_rollup()
+        for i in [2, 0, 1]:
+            rollup.update(self.hours[i])
+        self.assert_day(rollup, self.hours)
+
+    def test_ingest_again(self):
+        rollup = self.create_rollup()
+        for hour in self.hours:
+            rollup.update(hour)
+
+        # The same ingest with different rays replaces its rays
+        replacement = make_hour('2021-05-10 01:01:25', seed=7, tmp_dir=self.tmp_dir.name)
+        replacement.attrs['input_files'] = self.hours[1].attrs['input_files']
+        rollup.update(replacement)
+        self.assert_day(rollup, [self.hours[0], replacement, self.hours[2]])
+
+        # Fewer rays at a later time
+        later = make_hour('2021-05-10 03:01:25', num_rays=200, seed=8, tmp_dir=self.tmp_dir.name)
+        later.attrs['input_files'] = self.hours[1].attrs['input_files']
+        rollup.update(later)
+        self.assert_day(rollup, [self.hours[0], self.hours[2], later])
+
+    def test_midnight(self):
+        rollup = self.create_rollup()
+        hour = make_hour('2021-05-10 23:30:00', tmp_dir=self.tmp_dir.name)
+        paths = rollup.update(hour)
+        self.assertEqual([os.path.basename(path) for path in paths],
+                         ['nwtc.z01-lidar-daily.a1.20210510.000000.zarr', 'nwtc.z01-lidar-daily.a1.20210511.000000.zarr'])
+
+        _, first_day, _ = self.open_day(rollup, '2021-05-10')
+        _, second_day, aggregate = self.open_day(rollup, '2021-05-11')
+        self.assertEqual(first_day.sizes['time'] + second_day.sizes['time'], 300)
+        self.assertTrue((second_day['time'] >= np.datetime64('2021-05-11')).all())
+        self.assertEqual(aggregate['time'].values[0], np.datetime64('2021-05-11'))
+
+    def test_inconsistent_store(self):
+        rollup = self.create_rollup()
+        rollup.update(self.hours[0])
+        store, _, _ = self.open_day(rollup)
+        manifest = json.loads(store[MANIFEST_KEY])
+        manifest['files'] = {}
+        store[MANIFEST_KEY] = json.dumps(manifest).encode()
+
+        with self.assertRaises(ValueError):
+            rollup.update(self.hours[1])
+
+    def test_s3_store(self):
+        s3_client = DictS3Client()
+
+        class Storage:
+            root = S3Path('bucket', 'root')
+
+        storage = Storage()
+        storage.s3_client = s3_client
+        rollup = DailyRollup(storage, 'nwtc.z01-lidar-daily.a1', AGGREGATION)
+        rollup.update(self.hours[0])
+
+        # The next hour only writes the chunks it changed
+        s3_client.puts.clear()
+        rollup.update(self.hours[1])
+        chunks = [key for key in s3_client.puts if not os.path.basename(key).startswith('.')]
+        self.assertLess(len(chunks), 20)
+
+        store = open_store(storage, rollup.get_store_path(np.datetime64('2021-05-10')))
+        self.assertIsInstance(store, S3Store)
+        np.testing.assert_array_equal(xr.open_zarr(store, chunks=None)['doppler'].values,
+                                      xr.concat(self.hours[:2], dim='time')['doppler'].values)
+        self.assertEqual(len(json.loads(store[MANIFEST_KEY])['files']), 2)
+
+    def test_lock(self):
+        store = open_store(self.storage, 'locked.zarr')
+        with lock_store(store):
+            with self.assertRaises(TimeoutError):
+                with lock_store(store, timeout=0.2, poll_interval=0.05):
+                    pass
+        self.assertNotIn(LOCK_KEY, store)
+
+        # A lock left by a run that died is taken over
+        store[LOCK_KEY] = json.dumps({'time': 0}).encode()
+        with self.assertLogs(level='WARNING'):
+            with lock_store(store, timeout=60, stale_after=60):
+                pass
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,212 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+# Add the project directory to the pythonpath
+test_dir = os.path.dirname(os.path.realpath(__file__))
+project_dir = os.path.dirname(test_dir)
+lambda_dir = os.path.join(project_dir, 'lambda_function')
+data_dir = os.path.join(project_dir, 'data')
+sys.path.insert(0, lambda_dir)
+
+from tsdat.io import S3Path
+
+from pipelines import runner
+from pipelines.runner import (get_pipeline, group_input_files, is_routed, pack_input_file, pipeline_cache,
+                              reset_pipeline, router, run_pipeline, run_pipelines, unpack_input_file)
+from pipelines.utils.router import AmbiguousRouteError, FileRouter, Route
+
+
+pipeline_config = os.path.join(lambda_dir, 'pipelines/awa_halo_ingest/config/pipeline_config_nwtc.yml')
+
+storage_config = """
+storage:
+  classname: ${STORAGE_CLASSNAME}
+  parameters:
+    retain_input_files: ${RETAIN_INPUT_FILES}
+    root_dir: ${ROOT_DIR}
+
+  file_handlers:
+    input:
+      hpl:
+        file_pattern: '.*\\.hpl$'
+        classname: pipelines.awa_halo_ingest.filehandlers.HplHandler
+
+    output:
+      netcdf:
+        file_extension: '.nc'
+        classname: tsdat.io.filehandlers.NetCdfHandler
+"""
+
+
+class TestPipelineCache(unittest.TestCase):
+    """-------------------------------------------------------------------
+    Tests reusing pipelines across runs in the same process.
+    -------------------------------------------------------------------"""
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        os.environ['STORAGE_CLASSNAME'] = 'tsdat.io.FilesystemStorage'
+        os.environ['RETAIN_INPUT_FILES'] = 'True'
+        os.environ['ROOT_DIR'] = os.path.join(self.tmp_dir.name, 'storage')
+
+        self.storage_config = os.path.join(self.tmp_dir.name, 'storage_config.yml')
+        with open(self.storage_config, 'w') as f:
+            f.write(storage_config)
+
+    def tearDown(self) -> None:
+        pipeline_cache.clear()
+        self.tmp_dir.cleanup()
+
+    def get_pipeline(self):
+        return get_pipeline('awa_halo_ingest', 'nwtc', pipeline_config, self.storage_config)
+
+    def test_pipeline_reused(self):
+        self.assertIs(self.get_pipeline(), self.get_pipeline())
+
+    def test_pipeline_rebuilt_when_config_changes(self):
+        pipeline = self.get_pipeline()
+        stat = os.stat(self.storage_config)
+        os.utime(self.storage_config, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+        rebuilt = self.get_pipeline()
+
+        self.assertIsNot(rebuilt, pipeline)
+        self.assertEqual(len(pipeline_cache), 1)
+
+        os.environ['ROOT_DIR'] = os.path.join(self.tmp_dir.name, 'other_storage')
+        self.assertIsNot(self.get_pipeline(), rebuilt)
+
+    def test_reset_removes_temp_files(self):
+        pipeline = self.get_pipeline()
+        with open(pipeline.storage.tmp.get_temp_filepath('leftover.txt', disposable=False), 'w') as f:
+            f.write('leftover')
+
+        reset_pipeline(pipeline)
+        self.assertEqual(os.listdir(pipeline.storage.tmp.local_temp_folder), [])
+
+
+class TestFileRouter(unittest.TestCase):
+    """-------------------------------------------------------------------
+    Tests routing file names to pipelines with priorities.
+    -------------------------------------------------------------------"""
+    def test_route(self):
+        self.assertEqual(router.route('buoy.z05.00.20201201.000000.waves.csv'), ('a2e_waves_ingest', 'run', 'humboldt'))
+        self.assertEqual(router.route('buoy.z06.00.20201201.000000.csv'), ('a2e_buoy_ingest', 'run', 'morro'))
+        self.assertEqual(router.route('buoy.z05.a0.20201201.000000.10m.a2e.nc'),
+                         ('a2e_buoy_ingest', 'run_plots', 'humboldt'))
+
+        for extension in ['.gz', '.zip', '.tar', '.tar.gz']:
+            self.assertEqual(router.route(f'test.nwtc.hpl{extension}'), ('awa_halo_ingest', 'run', 'nwtc'))
+
+        # Patterns must match the whole name
+        self.assertEqual(router.route('test.nwtc.hpl.idx.npz'), (None, 'run', 'nwtc'))
+        self.assertTrue(is_routed('test.nwtc.hpl'))
+        self.assertFalse(is_routed('test.nwtc.hpl.idx.npz'))
+
+    def test_ambiguous_route(self):
+        router = FileRouter([Route('a', 'run', r'.*\.csv'), Route('b', 'run', r'buoy\..*')], {'nwtc': '.*nwtc.*'})
+        with self.assertRaises(AmbiguousRouteError):
+            router.route('buoy.nwtc.csv')
+        self.assertEqual(router.route_many(['/raw/x.nwtc.csv', 'buoy.nwtc.txt', 'other.txt']),
+                         [('a', 'run', 'nwtc'), ('b', 'run', 'nwtc'), (None, 'run', None)])
+
+
+class TestGroupInputFiles(unittest.TestCase):
+    """-------------------------------------------------------------------
+    Tests grouping mixed batches of input files by pipeline.
+    -------------------------------------------------------------------"""
+    input_files = [
+        '/raw/a.nwtc.hpl',
+        S3Path('bucket', 'raw/buoy.z05.00.20201201.000000.zip'),
+        '/raw/unknown.nwtc.txt',
+        '/raw/b.nwtc.hpl',
+        '/out/buoy.z05.a0.20201201.000000.10m.a2e.nc',
+    ]
+
+    def test_group_input_files(self):
+        groups = group_input_files(self.input_files)
+
+        self.assertEqual(list(groups), [
+            ('awa_halo_ingest', 'run', 'nwtc', ()),
+            ('a2e_buoy_ingest', 'run', 'humboldt', ('buoy.z05.00.', '20201201')),
+            ('a2e_buoy_ingest', 'run_plots', 'humboldt', ('buoy.z05.a0.', '20201201')),
+        ])
+        self.assertEqual(groups[('awa_halo_ingest', 'run', 'nwtc', ())], ['/raw/a.nwtc.hpl', '/raw/b.nwtc.hpl'])
+
+    def test_group_by_day_and_datastream(self):
+        input_files = [
+            '/raw/Stare_142_20210510_23.nwtc.hpl',
+            '/raw/Stare_142_20210511_00.nwtc.hpl',
+            '/raw/Stare_142_20210510_22.nwtc.hpl',
+            '/raw/VAD_142_20210510_23.nwtc.hpl',
+        ]
+        groups = group_input_files(input_files)
+
+        self.assertEqual(list(groups.values()), [
+            ['/raw/Stare_142_20210510_23.nwtc.hpl', '/raw/Stare_142_20210510_22.nwtc.hpl'],
+            ['/raw/Stare_142_20210511_00.nwtc.hpl'],
+            ['/raw/VAD_142_20210510_23.nwtc.hpl'],
+        ])
+        self.assertEqual(len(group_input_files(input_files[:2])), 2)
+
+    def test_pack_s3_path(self):
+        s3_path = unpack_input_file(pack_input_file(S3Path('bucket', 'raw/a.nwtc.hpl', 'us-west-2')))
+        self.assertEqual((s3_path.bucket_name, s3_path.bucket_path, s3_path.region_name),
+                         ('bucket', 'raw/a.nwtc.hpl', 'us-west-2'))
+
+    def test_groups_dispatched_to_workers(self):
+        with mock.patch.object(runner, 'map_in_processes') as map_in_processes:
+            runner.run_pipelines(self.input_files, max_workers=2)
+
+        func, groups = map_in_processes.call_args[0]
+        self.assertIs(func.func, runner.run_group)
+        self.assertEqual(len(groups), 3)
+        self.assertEqual(groups[1], [('bucket', 'raw/buoy.z05.00.20201201.000000.zip', None, None)])
+
+
+
+class TestRunPipelines(unittest.TestCase):
+    """-------------------------------------------------------------------
+    Tests that each group of files succeeds or fails on its own.
+    -------------------------------------------------------------------"""
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.root_dir = os.path.join(self.tmp_dir.name, 'storage')
+        self.input_file = os.path.join(self.tmp_dir.name, 'test.nwtc.hpl')
+        shutil.copy(os.path.join(data_dir, 'awa_halo_ingest/test.nwtc.hpl'), self.input_file)
+
+        self.storage_config = os.path.join(self.tmp_dir.name, 'storage_config.yml')
+        with open(self.storage_config, 'w') as f:
+            f.write(storage_config)
+
+        self.environ = mock.patch.dict(os.environ, {
+            'STORAGE_CLASSNAME': 'tsdat.io.FilesystemStorage',
+            'RETAIN_INPUT_FILES': 'True',
+            'ROOT_DIR': self.root_dir,
+        })
+        self.environ.start()
+
+    def tearDown(self) -> None:
+        self.environ.stop()
+        pipeline_cache.clear()
+        self.tmp_dir.cleanup()
+
+    def test_failing_group(self):
+        # There is no Halo pipeline config for humboldt (z05)
+        missing_config = os.path.join(self.tmp_dir.name, 'test.z05.hpl')
+        with self.assertLogs(level='ERROR'):
+            run_pipelines([missing_config, self.input_file], max_workers=1, storage_config=self.storage_config)
+
+        outputs = os.listdir(os.path.join(self.root_dir, 'nwtc', 'nwtc.z01-lidar.a1'))
+        self.assertTrue(any(output.endswith('.nc') for output in outputs))
+
+    def test_pipeline_not_built(self):
+        with mock.patch.object(runner, 'get_pipeline', side_effect=ValueError('Invalid config')):
+            with self.assertLogs(level='ERROR'):
+                self.assertFalse(run_pipeline([self.input_file], self.storage_config))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import os
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+# Add the project directory to the pythonpath
+test_dir = os.path.dirname(os.path.realpath(__file__))
+project_dir = os.path.dirname(test_dir)
+lambda_dir = os.path.join(project_dir, 'lambda_function')
+sys.path.insert(0, lambda_dir)
+
+from pipelines.utils.remote import RangeFile, open_zip_store
+from pipelines.utils.selection import open_lazily, select
+from pipelines.utils.zarr_handler import ZarrHandler
+
+
+class TestSelection(unittest.TestCase):
+    """-------------------------------------------------------------------
+    Tests reading only the variables and ranges that plots use.
+    -------------------------------------------------------------------"""
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+        rng = np.random.default_rng(0)
+        shape = (400, 200)
+        self.dataset = xr.Dataset(
+            {
+                'doppler': (('time', 'distance'), rng.uniform(-20, 20, size=shape).astype(np.float32)),
+                'SNR': (('time', 'distance'), rng.uniform(-30, 0, size=shape).astype(np.float32)),
+                'intensity': (('time', 'distance'), rng.uniform(1, 2, size=shape).astype(np.float32)),
+            },
+            coords={'time': pd.date_range('2021-05-10', periods=shape[0], freq='s').values,
+                    'distance': (np.arange(shape[1]) + 0.5) * 50.0},
+            attrs={'location_meaning': 'NWTC'},
+        )
+        for variable in self.dataset.data_vars.values():
+            variable.encoding['chunksizes'] = (100, 50)
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def test_select(self):
+        selected = select(self.dataset, ['doppler'], {'distance': (None, 5000)})
+
+        self.assertEqual(list(selected.data_vars), ['doppler'])
+        self.assertEqual(selected.attrs, self.dataset.attrs)
+        self.assertTrue((selected.distance.values < 5000).all())
+        self.assertEqual(selected.sizes['distance'], (self.dataset.distance.values < 5000).sum())
+
+        # Selecting again changes nothing, and nothing selects everything
+        self.assertIs(select(selected, None, {'distance': (None, 5000)}), selected)
+        self.assertIs(select(self.dataset), self.dataset)
+
+        between = select(self.dataset, ranges={'distance': (1000, 2000)})
+        self.assertEqual(between.distance.values.min(), 1025)
+        self.assertEqual(between.distance.values.max(), 1975)
+
+    def test_open_lazily(self):
+        filename = os.path.join(self.tmp_dir.name, 'test.nc')
+        self.dataset.to_netcdf(filename)
+
+        with open_lazily(filename) as dataset:
+            self.assertFalse(dataset['doppler'].variable._in_memory)
+            selected = select(dataset, ['SNR'], {'distance': (None, 5000)}).load()
+
+        expected = self.dataset['SNR'].values[:, self.dataset.distance.values < 5000]
+        np.testing.assert_array_equal(selected['SNR'].values, expected)
+
+    def test_zip_store_range_reads(self):
+        filename = os.path.join(self.tmp_dir.name, 'test.zarr.zip')
+        ZarrHandler().write(self.dataset, filename)
+        with open(filename, 'rb') as f:
+            content = f.read()
+
+        ranges = []
+
+        def read_range(start, end):
+            ranges.append((start, end))
+            return content[start:end]
+
+        fileobj = RangeFile(read_range, len(content), block_size=4096)
+        with open_zip_store(fileobj) as dataset:
+            selected = select(dataset, ['doppler'], {'distance': (None, 5000)}).load()
+
+        expected = self.dataset['doppler'].values[:, self.dataset.distance.values < 5000]
+        np.testing.assert_array_equal(selected['doppler'].values, expected)
+
+        # Only the chunks of one of the three variables at half of the ranges
+        # are read, with ranges inside the file
+        self.assertLess(fileobj.num_bytes, len(content) / 4)
+        self.assertEqual(sum(end - start for start, end in ranges), fileobj.num_bytes)
+        self.assertTrue(all(end <= len(content) for _, end in ranges))
+
+    def test_range_file(self):
+        content = bytes(range(256)) * 100
+        fileobj = RangeFile(lambda start, end: content[start:end], len(content), block_size=1000, cached_blocks=2)
+
+        fileobj.seek(-10, 2)
+        self.assertEqual(fileobj.read(), content[-10:])
+        fileobj.seek(1500)
+        self.assertEqual(fileobj.read(1000), content[1500:2500])
+        self.assertEqual(fileobj.tell(), 2500)
+        self.assertEqual(fileobj.read(10), content[2500:2510])
+        self.assertEqual(fileobj.num_requests, 3)
+
+        # Reads larger than the cache are one request
+        fileobj.seek(0)
+        self.assertEqual(fileobj.read(5000), content[:5000])
+        self.assertEqual(fileobj.num_requests, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
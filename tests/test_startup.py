@@ -0,0 +1,32 @@
+import os
+import sys
+import unittest
+
+# Add the project directory to the pythonpath
+test_dir = os.path.dirname(os.path.realpath(__file__))
+project_dir = os.path.dirname(test_dir)
+sys.path.insert(0, os.path.join(project_dir, 'benchmarks'))
+
+from lambda_startup import time_import
+
+# The most seconds importing the Lambda handler may take on a cold start
+STARTUP_BUDGET_SECONDS = float(os.environ.get('STARTUP_BUDGET_SECONDS', 0.5))
+
+
+class TestStartup(unittest.TestCase):
+    """-------------------------------------------------------------------
+    Tests that the Lambda handler imports quickly on a cold start, without
+    importing the modules that only running a pipeline needs.
+    -------------------------------------------------------------------"""
+
+    def test_import_lambda_function(self):
+        # The fastest of a few imports, so a busy machine doesn't fail it
+        results = [time_import() for _ in range(3)]
+
+        for result in results:
+            self.assertEqual(result['imported'], [])
+        self.assertLess(min(result['seconds'] for result in results), STARTUP_BUDGET_SECONDS)
+
+
+if __name__ == '__main__':
+    unittest.main()
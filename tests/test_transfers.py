@@ -0,0 +1,172 @@
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+# Add the project directory to the pythonpath
+test_dir = os.path.dirname(os.path.realpath(__file__))
+project_dir = os.path.dirname(test_dir)
+lambda_dir = os.path.join(project_dir, 'lambda_function')
+sys.path.insert(0, lambda_dir)
+
+from tsdat.io import S3Path
+from tsdat.io.aws_storage import AwsTemporaryStorage
+
+from pipelines import runner
+from pipelines.utils.aws_storage import AsyncAwsStorage
+from pipelines.utils.transfers import transfers
+
+
+class FilesystemS3Client:
+    """-------------------------------------------------------------------
+    A stand-in for the boto3 S3 client that keeps objects in a local
+    folder.  Uploads wait until upload_gate is set, and uploads to the keys
+    in failing_keys raise an error.
+    -------------------------------------------------------------------"""
+    def __init__(self, root: str):
+        self.root = root
+        self.upload_gate = threading.Event()
+        self.upload_gate.set()
+        self.failing_keys = set()
+        self.downloaded = []
+        self.uploaded = []
+
+    def get_path(self, bucket: str, key: str) -> str:
+        return os.path.join(self.root, bucket, key)
+
+    def put(self, bucket: str, key: str, content: bytes):
+        os.makedirs(os.path.dirname(self.get_path(bucket, key)), exist_ok=True)
+        with open(self.get_path(bucket, key), 'wb') as f:
+            f.write(content)
+
+    def upload_file(self, Filename, Bucket, Key, Config=None):
+        self.upload_gate.wait()
+        if Key in self.failing_keys:
+            raise OSError(f'Failed to upload {Key}')
+        with open(Filename, 'rb') as f:
+            self.put(Bucket, Key, f.read())
+        self.uploaded.append(Key)
+
+    def download_file(self, Bucket, Key, Filename, Config=None):
+        shutil.copyfile(self.get_path(Bucket, Key), Filename)
+        self.downloaded.append(Key)
+
+
+class TestAsyncAwsStorage(unittest.TestCase):
+    """-------------------------------------------------------------------
+    Tests uploading in the background and prefetching with AsyncAwsStorage
+    against a filesystem-backed S3 stand-in.
+    -------------------------------------------------------------------"""
+    filename = 'NWTC.test_01-lidar-10min.a1.20210510.000000.nc'
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.s3_client = FilesystemS3Client(os.path.join(self.tmp_dir.name, 's3'))
+        self.storage = AsyncAwsStorage({'bucket_name': 'bucket', 'root_dir': 'root'})
+        self.storage._s3_client = self.s3_client
+
+        self.local_file = os.path.join(self.tmp_dir.name, self.filename)
+        with open(self.local_file, 'wb') as f:
+            f.write(b'processed data')
+
+    def tearDown(self) -> None:
+        self.s3_client.upload_gate.set()
+        try:
+            transfers.wait()
+        except OSError:
+            pass
+        transfers.discard_prefetched()
+        self.tmp_dir.cleanup()
+
+    def test_upload_in_background(self):
+        self.s3_client.upload_gate.clear()
+        s3_path = self.storage.save(self.local_file)[0]
+        os.remove(self.local_file)
+        self.assertEqual(self.s3_client.uploaded, [])
+
+        # Reopening the pending upload uses the local copy
+        with self.storage.tmp.fetch(s3_path) as tmp_path:
+            with open(tmp_path, 'rb') as f:
+                self.assertEqual(f.read(), b'processed data')
+        self.assertEqual(self.s3_client.downloaded, [])
+
+        self.s3_client.upload_gate.set()
+        self.storage.wait()
+        self.assertEqual(self.s3_client.uploaded, [s3_path.bucket_path])
+        with open(self.s3_client.get_path('bucket', s3_path.bucket_path), 'rb') as f:
+            self.assertEqual(f.read(), b'processed data')
+        self.assertEqual(os.listdir(transfers.staging_dir), [])
+
+    def test_wait_raises_upload_errors(self):
+        s3_path = self.storage.save(self.local_file)[0]
+        self.s3_client.failing_keys.add(s3_path.bucket_path)
+        self.storage.save(self.local_file)
+
+        with self.assertRaises(OSError):
+            self.storage.wait()
+        self.storage.wait()
+        self.assertEqual(os.listdir(transfers.staging_dir), [])
+
+    def test_input_kept_when_upload_fails(self):
+        self.s3_client.put('raw', 'hpl/a.nwtc.hpl', b'raw a')
+        input_file = S3Path('raw', 'hpl/a.nwtc.hpl')
+        self.assertTrue(self.storage.remove_input_files)
+
+        def delete(tmp_storage, filepath):
+            self.assertEqual(self.s3_client.uploaded, [saved.bucket_path])
+            os.remove(self.s3_client.get_path(filepath.bucket_name, filepath.bucket_path))
+
+        with mock.patch.object(AwsTemporaryStorage, 'delete', delete):
+            # The input is deleted once the output is uploaded
+            with self.storage.tmp.extract_files(input_file):
+                saved = self.storage.save(self.local_file)[0]
+            self.assertFalse(os.path.exists(self.s3_client.get_path('raw', 'hpl/a.nwtc.hpl')))
+
+            # The input is kept when the upload of the output fails
+            self.s3_client.put('raw', 'hpl/a.nwtc.hpl', b'raw a')
+            self.s3_client.failing_keys.add(saved.bucket_path)
+            with self.assertRaises(OSError):
+                with self.storage.tmp.extract_files(input_file):
+                    self.storage.save(self.local_file)
+        self.assertTrue(os.path.exists(self.s3_client.get_path('raw', 'hpl/a.nwtc.hpl')))
+
+    def test_prefetch(self):
+        self.s3_client.put('raw', 'hpl/a.nwtc.hpl', b'raw a')
+        self.s3_client.put('raw', 'hpl/b.nwtc.hpl', b'raw b')
+        self.storage.prefetch([S3Path('raw', 'hpl/a.nwtc.hpl'), S3Path('raw', 'hpl/b.nwtc.hpl'), self.local_file])
+
+        with self.storage.tmp.fetch(S3Path('raw', 'hpl/a.nwtc.hpl')) as tmp_path:
+            with open(tmp_path, 'rb') as f:
+                self.assertEqual(f.read(), b'raw a')
+        self.assertEqual(os.path.basename(tmp_path), 'a.nwtc.hpl')
+
+        # Unused prefetches are discarded, and missing objects are
+        # downloaded again
+        transfers.discard_prefetched()
+        self.assertEqual(os.listdir(transfers.staging_dir), [])
+        prefetched = transfers.prefetch(self.s3_client, 'raw', 'hpl/missing.nwtc.hpl')
+        self.assertIsInstance(prefetched.exception(), FileNotFoundError)
+        self.s3_client.put('raw', 'hpl/missing.nwtc.hpl', b'late')
+        with self.assertLogs(level='WARNING'):
+            with self.storage.tmp.fetch(S3Path('raw', 'hpl/missing.nwtc.hpl')) as tmp_path:
+                with open(tmp_path, 'rb') as f:
+                    self.assertEqual(f.read(), b'late')
+        self.assertEqual(sorted(self.s3_client.downloaded),
+                         ['hpl/a.nwtc.hpl', 'hpl/b.nwtc.hpl', 'hpl/missing.nwtc.hpl'])
+
+    def test_run_pipelines_prefetches_next_group(self):
+        input_files = [S3Path('raw', 'hpl/a.nwtc.hpl'), S3Path('raw', 'buoy.z05.00.20201201.000000.zip')]
+        with mock.patch.object(runner, 'run_pipeline') as run_pipeline:
+            runner.run_pipelines(input_files, max_workers=1)
+
+        self.assertEqual(run_pipeline.call_args_list, [
+            mock.call([input_files[0]], None, [input_files[1]]),
+            mock.call([input_files[1]], None, None),
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import os
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+# Add the project directory to the pythonpath
+test_dir = os.path.dirname(os.path.realpath(__file__))
+project_dir = os.path.dirname(test_dir)
+lambda_dir = os.path.join(project_dir, 'lambda_function')
+sys.path.insert(0, lambda_dir)
+
+from pipelines.utils.netcdf import apply_encoding_profile
+from pipelines.utils.zarr_handler import ZarrAppender, ZarrHandler, open_zarr
+
+
+class TestZarrHandler(unittest.TestCase):
+    """-------------------------------------------------------------------
+    Tests writing zarr directory and zip stores.
+    -------------------------------------------------------------------"""
+    profile = {
+        'chunks': {'time': 4, 'distance': 8},
+        'zlib': True,
+        'complevel': 4,
+        'shuffle': True,
+        'pack': {'doppler': {'dtype': 'int16', 'scale_factor': 0.002}},
+    }
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+        time = pd.date_range('2021-05-10', periods=7, freq='790ms').values
+        doppler = np.random.default_rng(0).uniform(-20, 20, size=(7, 5)).astype(np.float32)
+        doppler[2, 1] = -9999
+        self.dataset = xr.Dataset(
+            {
+                'doppler': (('time', 'distance'), doppler, {'_FillValue': -9999}),
+                'qc_doppler': (('time', 'distance'), np.arange(35, dtype=np.int32).reshape(7, 5)),
+            },
+            coords={'time': time, 'distance': np.arange(5) * 18.0},
+        )
+        self.dataset['time'].attrs['units'] = 'seconds since 1970-01-01T00:00:00'
+        self.dataset['time'].encoding['dtype'] = 'int64'
+        self.dataset['time'].encoding['units'] = 'microseconds since 1970-01-01T00:00:00'
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def test_write_zip_store(self):
+        filename = os.path.join(self.tmp_dir.name, 'test.zarr.zip')
+        ZarrHandler().write(apply_encoding_profile(self.dataset.copy(deep=True), self.profile), filename)
+
+        with open_zarr(filename) as written:
+            self.assertEqual(written['qc_doppler'].encoding['chunks'], (4, 5))
+            self.assertEqual(written['doppler'].encoding['dtype'], np.int16)
+            np.testing.assert_array_equal(written['time'].values, self.dataset['time'].values)
+            np.testing.assert_array_equal(written['qc_doppler'].values, self.dataset['qc_doppler'].values)
+
+            expected = self.dataset['doppler'].where(self.dataset['doppler'] != -9999)
+            np.testing.assert_allclose(written['doppler'].values, expected.values, atol=0.001)
+
+    def test_append_blocks(self):
+        for store_name in ['test.zarr', 'test.zarr.zip']:
+            filename = os.path.join(self.tmp_dir.name, store_name)
+            appender = ZarrAppender(filename)
+            for start in range(0, 7, 3):
+                block = self.dataset.isel(time=slice(start, start + 3)).copy(deep=True)
+                appender.append(apply_encoding_profile(block, self.profile))
+            appender.close()
+
+            single_filename = os.path.join(self.tmp_dir.name, 'single_' + store_name)
+            ZarrHandler().write(apply_encoding_profile(self.dataset.copy(deep=True), self.profile), single_filename)
+
+            xr.testing.assert_identical(ZarrHandler().read(filename), ZarrHandler().read(single_filename))
+
+
+if __name__ == '__main__':
+    unittest.main()